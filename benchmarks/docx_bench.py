@@ -0,0 +1,130 @@
+"""
+DOCX 读取耗时的基准测试，比较 python-docx 按下标访问段落（旧实现）和 DocxStreamReader 流式读取
+生成包含标题、正文、列表和表格的合成文档，段落数最多 10 万
+旧实现的耗时随段落数平方增长，只测较小的文档
+
+用法：python benchmarks/docx_bench.py
+"""
+import os
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+
+from file_parsers.docx_reader import DocxStreamReader, W_NS
+
+OLD_MAX_PARAGRAPHS = 5_000
+TABLE_EVERY = 200
+
+
+def make_docx(path, paragraphs):
+    # 用 python-docx 生成带默认样式的模板，再替换 document.xml
+    template = path + '.template.docx'
+    Document().save(template)
+
+    body = []
+    for i in range(paragraphs):
+        if i % 100 == 0:
+            body.append(f'<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr><w:r><w:t>第 {i} 章</w:t></w:r></w:p>')
+        elif i % 10 == 0:
+            body.append(f'<w:p><w:pPr><w:pStyle w:val="ListBullet"/><w:numPr><w:ilvl w:val="0"/><w:numId w:val="1"/></w:numPr></w:pPr><w:r><w:t>列表项 {i}</w:t></w:r></w:p>')
+        else:
+            body.append(f'<w:p><w:r><w:t xml:space="preserve">正文段落 {i}，</w:t></w:r><w:r><w:tab/><w:t>这是一段用于测试的文字。</w:t></w:r></w:p>')
+        if i % TABLE_EVERY == TABLE_EVERY - 1:
+            rows = ''.join(
+                '<w:tr>' + ''.join(f'<w:tc><w:p><w:r><w:t>{r}-{c}</w:t></w:r></w:p></w:tc>' for c in range(4)) + '</w:tr>'
+                for r in range(5)
+            )
+            body.append(f'<w:tbl><w:tblGrid>{"<w:gridCol/>" * 4}</w:tblGrid>{rows}</w:tbl>')
+    document = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:document xmlns:w="{W_NS}"><w:body>{"".join(body)}<w:sectPr/></w:body></w:document>'
+    )
+
+    with zipfile.ZipFile(template) as src, zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as dst:
+        for item in src.infolist():
+            if item.filename == 'word/document.xml':
+                dst.writestr(item, document)
+            else:
+                dst.writestr(item, src.read(item.filename))
+    os.remove(template)
+
+
+def bench_old(path):
+    # 旧实现：遍历 body，通过 doc.paragraphs[i]、doc.tables[i] 取对象，每次访问都会重建列表
+    import resource
+    t = time.perf_counter()
+    doc = Document(path)
+    count = 0
+    para_ind = 0
+    tbl_ind = 0
+    for element in doc.element.body:
+        if element.tag.endswith('p'):
+            paragraph = doc.paragraphs[para_ind]
+            paragraph.text.strip()
+            paragraph.style.name
+            paragraph.style.font.size
+            para_ind += 1
+            count += 1
+        elif element.tag.endswith('tbl'):
+            table = doc.tables[tbl_ind]
+            for row in table.rows:
+                [cell.text.strip() for cell in row.cells]
+            tbl_ind += 1
+            count += 1
+    return time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, count
+
+
+def bench_stream(path):
+    import resource
+    t = time.perf_counter()
+    reader = DocxStreamReader(path)
+    count = 0
+    for kind, element in reader.iter_body():
+        if kind == 'p':
+            reader.paragraph_text(element).strip()
+            reader.paragraph_style(element)
+            reader.paragraph_ilvl(element)
+            reader.paragraph_images(element)
+        else:
+            [[cell.strip() for cell in row] for row in reader.table_rows(element)]
+        count += 1
+    reader.close()
+    return time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, count
+
+
+def run_isolated(func, *args):
+    # 每次测试在新进程中运行，峰值内存互不影响
+    # Linux 下 exec 后的进程会继承父进程的峰值内存，所以生成文档也放在子进程中
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+if __name__ == '__main__':
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print(f'{"段落数":>8} {"文件 (KB)":>10} {"旧实现 (s)":>12} {"旧内存 (MB)":>12} {"流式 (s)":>10} {"流式内存 (MB)":>14}')
+        for paragraphs in [1_000, 5_000, 20_000, 100_000]:
+            path = os.path.join(tmp_dir, f'bench_{paragraphs}.docx')
+            run_isolated(make_docx, path, paragraphs)
+            size_kb = os.path.getsize(path) / 1024
+
+            if paragraphs <= OLD_MAX_PARAGRAPHS:
+                old_cost, old_mem, old_count = run_isolated(bench_old, path)
+                old_cost, old_mem = f'{old_cost:.2f}', f'{old_mem:.0f}'
+            else:
+                old_cost, old_mem, old_count = '-', '-', None
+            stream_cost, stream_mem, stream_count = run_isolated(bench_stream, path)
+            if old_count is not None and old_count != stream_count:
+                print(f'元素数不一致：旧实现 {old_count}，流式 {stream_count}')
+
+            print(f'{paragraphs:>8} {size_kb:>10.0f} {old_cost:>12} {old_mem:>12} {stream_cost:>10.2f} {stream_mem:>14.0f}')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -0,0 +1,72 @@
+"""
+PDF 标题级别替换的基准测试，比较逐个标题 re.sub（旧实现）和按 id 一次替换
+旧实现的耗时随标题数平方增长，只测较小的文档；未替换为替换后仍残留的标题 id 数
+合成文档中每个标题后面有若干段正文，标题中包含 (、+、* 等正则特殊字符
+
+用法：python benchmarks/heading_rewrite_bench.py
+"""
+import os
+import re
+import sys
+import time
+import uuid
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_parsers.pdf_parser import PDFParser
+
+PARAGRAPHS_PER_HEADING = 5
+OLD_MAX_HEADINGS = 2_000
+
+
+def make_doc(heading_count):
+    headings = {}
+    levels = []
+    parts = []
+    for i in range(heading_count):
+        heading_id = str(uuid.uuid4())[:8]
+        content = f'{i}. 第 {i} 节 (C++ *重点*)' if i % 3 == 0 else f'{i}. 第 {i} 节'
+        headings[heading_id] = content
+        levels.append({'content': content, 'level': i % 3 + 1, 'id': heading_id})
+        parts.append('# ' + content + f'@=@{heading_id}' + '\n\n')
+        for j in range(PARAGRAPHS_PER_HEADING):
+            parts.append(f'这是第 {i} 节的第 {j} 段正文，用来模拟较长的文档内容。' * 3 + '\n')
+    return ''.join(parts), headings, levels
+
+
+def bench_per_heading(md_content, levels):
+    # 旧实现：每个标题对整篇内容执行一次 re.sub，标题内容没有转义
+    t = time.perf_counter()
+    errors = 0
+    for heading in levels:
+        reg = r'#+ ' + heading['content'] + '@=@' + heading['id'] + r'[\s\n]+'
+        corret_heading = '#'*heading['level']+' '+heading['content'] + '\n\n'
+        try:
+            md_content = re.sub(reg, corret_heading, md_content)
+        except re.error:
+            errors += 1
+    return time.perf_counter() - t, md_content.count('@=@'), errors
+
+
+def bench_single_pass(md_content, headings, levels):
+    # _replace_heading 只用到这几个属性，不需要打开 pdf
+    parser = types.SimpleNamespace(md_content=md_content, headings=headings, heading_reg=PDFParser.heading_reg)
+
+    t = time.perf_counter()
+    PDFParser._replace_heading(parser, levels)
+    return time.perf_counter() - t, parser.md_content.count('@=@')
+
+
+if __name__ == '__main__':
+    print(f'{"标题数":>8} {"文档 (MB)":>10} {"逐个替换 (s)":>14} {"未替换":>8} {"一次替换 (s)":>14} {"未替换":>8}')
+    for heading_count in [500, 1_000, 2_000, 5_000]:
+        md_content, headings, levels = make_doc(heading_count)
+        size_mb = len(md_content.encode('utf8')) / 1024 / 1024
+        if heading_count <= OLD_MAX_HEADINGS:
+            old_cost, old_left, _ = bench_per_heading(md_content, levels)
+            old_cost = f'{old_cost:.3f}'
+        else:
+            old_cost, old_left = '-', '-'
+        new_cost, new_left = bench_single_pass(md_content, headings, levels)
+        print(f'{heading_count:>8} {size_mb:>10.2f} {old_cost:>14} {old_left:>8} {new_cost:>14.4f} {new_left:>8}')
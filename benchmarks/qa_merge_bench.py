@@ -0,0 +1,86 @@
+"""
+QA 合并耗时的基准测试，验证知识库变大时，替换单个文件 QA 的耗时保持不变
+
+用法：python benchmarks/qa_merge_bench.py
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.qa_manage import QA_Manager, QATable
+
+ROWS_PER_FILE = 20
+MERGES = 200
+
+
+def make_qa(file_ind, run):
+    return [
+        {
+            'simple_title': f'title {file_ind}-{i}',
+            'full_title': f'doc-title {file_ind}-{i}',
+            'content': f'content {run} ' * 20,
+        }
+        for i in range(ROWS_PER_FILE)
+    ]
+
+
+def bench_list(kb_rows):
+    # 旧实现：每次合并都用列表推导式重建整个列表
+    file_count = kb_rows // ROWS_PER_FILE
+    qa = []
+    for i in range(file_count):
+        for row in make_qa(i, 0):
+            row['knowledge_path'] = f'f{i}'
+            qa.append(row)
+
+    t = time.perf_counter()
+    for run in range(MERGES):
+        rel_path = f'f{random.randrange(file_count)}'
+        qa_to_merge = make_qa(rel_path, run)
+        for row in qa_to_merge:
+            row['knowledge_path'] = rel_path
+        qa = [x for x in qa if x['knowledge_path'] != rel_path]
+        qa.extend(qa_to_merge)
+    return (time.perf_counter() - t) / MERGES
+
+
+def bench_table(kb_rows):
+    file_count = kb_rows // ROWS_PER_FILE
+    table = QATable()
+    for i in range(file_count):
+        table.replace(f'f{i}', make_qa(i, 0))
+
+    t = time.perf_counter()
+    for run in range(MERGES):
+        rel_path = f'f{random.randrange(file_count)}'
+        table.replace(rel_path, make_qa(rel_path, run))
+    return (time.perf_counter() - t) / MERGES
+
+
+def bench_manager(kb_rows):
+    # QA_Manager 包含写入 qa_store 和 fsync 的耗时
+    file_count = kb_rows // ROWS_PER_FILE
+    with tempfile.TemporaryDirectory() as kb_dir:
+        manager = QA_Manager({}, '/docs', kb_dir)
+        manager.load_table()
+        for i in range(file_count):
+            manager.table.replace(f'f{i}', make_qa(i, 0))
+
+        t = time.perf_counter()
+        for run in range(MERGES):
+            file_path = f'/docs/f{random.randrange(file_count)}'
+            manager.merge_qa(make_qa(file_path, run), file_path)
+        cost = (time.perf_counter() - t) / MERGES
+        manager.close()
+    return cost
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    print(f'{"KB 行数":>10} {"list (ms)":>12} {"QATable (ms)":>14} {"QA_Manager (ms)":>16}')
+    for kb_rows in [1_000, 10_000, 100_000, 300_000]:
+        print(f'{kb_rows:>10} {bench_list(kb_rows)*1000:>12.3f} {bench_table(kb_rows)*1000:>14.3f} {bench_manager(kb_rows)*1000:>16.3f}')
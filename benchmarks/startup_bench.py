@@ -0,0 +1,77 @@
+"""
+main.py 启动耗时的基准测试
+在临时目录中准备一个只包含 markdown 文件的文档目录，用 python -X importtime 运行 main.py，输出总耗时和导入耗时最多的模块
+
+用法：python benchmarks/startup_bench.py [--top N]
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def prepare(work_dir):
+    docs_dir = os.path.join(work_dir, 'docs')
+    os.makedirs(docs_dir)
+    with open(os.path.join(docs_dir, 'readme.md'), 'w', encoding='utf-8') as f:
+        f.write('# 标题\n\n正文\n')
+
+    # main.py 从当前目录读取 config.ini
+    with open(os.path.join(REPO_DIR, 'config example.ini'), 'r', encoding='utf-8') as f:
+        config = f.read()
+    config = config.replace('LOG_TO_FILE=True', 'LOG_TO_FILE=False').replace('LOG_TO_CONSOLE=True', 'LOG_TO_CONSOLE=False')
+    # 仓库中的 path_ignore 包含 tmp.*，会忽略临时目录下的所有文件，这里使用空的忽略规则
+    path_ignore = os.path.join(work_dir, 'path_ignore')
+    open(path_ignore, 'w').close()
+    config = config.replace('PATH_IGNORE=./path_ignore', f'PATH_IGNORE={path_ignore}')
+    with open(os.path.join(work_dir, 'config.ini'), 'w', encoding='utf-8') as f:
+        f.write(config)
+
+    return docs_dir
+
+
+def parse_importtime(stderr):
+    """
+    解析 -X importtime 的输出，返回 [(cumulative_us, self_us, module)]
+    """
+    result = []
+    for line in stderr.splitlines():
+        m = re.match(r'import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)', line)
+        if m:
+            result.append((int(m.group(2)), int(m.group(1)), len(m.group(3)), m.group(4)))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='main.py 启动耗时')
+    parser.add_argument('--top', type=int, default=15, help='输出导入耗时最多的模块数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        docs_dir = prepare(work_dir)
+        cmd = [sys.executable, '-X', 'importtime', os.path.join(REPO_DIR, 'main.py'), docs_dir, '-o', os.path.join(work_dir, 'output')]
+
+        t = time.perf_counter()
+        proc = subprocess.run(cmd, cwd=work_dir, capture_output=True, text=True)
+        wall = time.perf_counter() - t
+
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:])
+        sys.exit(proc.returncode)
+
+    imports = parse_importtime(proc.stderr)
+    # 只统计顶层导入，避免重复计算
+    top_level = [x for x in imports if x[2] == 1]
+    total_import = sum(x[0] for x in top_level)
+
+    print(f'总耗时: {wall*1000:.0f} ms')
+    print(f'导入耗时: {total_import/1000:.0f} ms，共导入 {len(imports)} 个模块')
+    print()
+    print(f'{"cumulative (ms)":>16} {"self (ms)":>10}  module')
+    for cumulative, self_us, _, module in sorted(top_level, reverse=True)[:args.top]:
+        print(f'{cumulative/1000:>16.1f} {self_us/1000:>10.1f}  {module}')
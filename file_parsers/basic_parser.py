@@ -1,5 +1,9 @@
 import os
+import logging
 import tempfile
+from tools.request_engine import get_engine
+from tools.image_prep import ImagePrep
+
 class BasicParser:
 
     # suffix = 'txt'
@@ -59,6 +63,11 @@ class BasicParser:
         else:
             self.logger = logger
 
+        # 模型请求统一通过进程内共享的 engine 发出
+        self.engine = get_engine(cfg, self.logger)
+        # 发送给模型的图片统一压缩
+        self.image_prep = ImagePrep(cfg, self.logger)
+
         self.qa_info =[]
 
         # 创建 temp_dir
@@ -66,8 +75,8 @@ class BasicParser:
         self.temp_dir_obj = tempfile.TemporaryDirectory(prefix=dir_prefix)
         self.temp_dir = self.temp_dir_obj.name
 
-        logger.info('======')
-        logger.info(f'Parser {self.__class__.__name__} initialized: {file_path}')
+        self.logger.info('======')
+        self.logger.info(f'Parser {self.__class__.__name__} initialized: {file_path}')
 
     def parse(self):
         self.qa_info.append({
@@ -107,6 +116,80 @@ class BasicParser:
         :param section_path: 资源路径
         '''
         return self.add_tag(content,'section', f'{self.knowledge_path}: {section_path_in_file}')
-    
+
+
+    def iter_sections(self, lines, line_handler=None):
+        '''
+        按标题切分 markdown，每切出一段就返回，不保存整篇内容
+        代码块中以 # 开头的行不作为标题，``` 所在的行不保留，代码块内容保留在当前段落中
+        标题级别跳跃时修正为上一级加 1；标题路径重复时分别返回，不覆盖前一段
+        没有任何标题时，整篇内容以文件名作为标题返回；title_prefix 不为空时加在标题路径前
+        :param lines: 行的迭代器，可以是文件对象、splitlines() 的结果或生成器
+        :param line_handler: 处理正文行的函数（不处理标题和代码块），返回处理后的行
+        :return: 生成器，返回 (标题路径, 添加了 @section 标签的内容)
+        '''
+        headers = []
+        current_header_path = ''
+        current_content = []
+
+        is_in_code = False
+        for line in lines:
+            line = line.rstrip('\r\n')
+
+            # 处理代码
+            if line.startswith('```'):
+                is_in_code = not is_in_code
+                continue
+            if is_in_code:
+                current_content.append(line)
+                continue
+
+            # 处理正文
+            if not line.startswith('#'):
+                if line_handler is not None:
+                    line = line_handler(line)
+                current_content.append(line)
+                continue
+
+            # 处理当前标题内容
+            if current_header_path and ''.join(current_content) != '':
+                position = "-".join(headers)
+                yield current_header_path, self.add_section_tag('\n'.join(current_content).strip(), position)
+                current_content = []
+
+            # 解析新标题级别和文本
+            level = line.count('#')
+            header_text = line.strip('#').strip()
+
+            # 标题级别错误处理
+            if level > len(headers) + 1:
+                self.logger.warning(f'标题级别跳跃: 当前标题级别 {level}, 上一级标题级别 {len(headers)}。标题: {header_text}')
+                # 尝试修正标题级别，设置为上一级标题级别加 1
+                level = len(headers) + 1
+
+            # 调整标题层级
+            if level > len(headers):
+                headers.append(header_text)
+            elif level == len(headers):
+                headers[-1] = header_text
+            else:
+                headers = headers[:level - 1]
+                headers.append(header_text)
+
+            if self.title_prefix == '':
+                current_header_path = '-'.join(headers)
+            else:
+                current_header_path = '-'.join([self.title_prefix] + headers)
+
+        # 处理最后一个标题内容
+        if ''.join(current_content) == '':
+            return
+        if current_header_path:
+            position = "-".join(headers)
+            yield current_header_path, self.add_section_tag('\n'.join(current_content).strip(), position)
+        else:
+            position = self.file_basename
+            yield self.file_basename, self.add_section_tag('\n'.join(current_content).strip(), position)
+
     def __del__(self):
         self.temp_dir_obj.cleanup()
\ No newline at end of file
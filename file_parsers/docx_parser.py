@@ -1,12 +1,11 @@
 import os
 import re
 import io
-import base64
-from docx import Document
+import json
 from PIL import Image
-from openai import OpenAI
 
 from .basic_parser import BasicParser
+from .docx_reader import DocxStreamReader
 
 img_parse_prompt = '''
 你是一个图像识别助手，识别图片中的内容，并返回详细描述，格式如下：
@@ -25,14 +24,11 @@ class DOCXParser(BasicParser):
         if not file_path.lower().endswith('.docx'):
             raise ValueError("file type error, not a docx file")
 
-        # 获取图像识别模型的相关算法配置
-        self.img_parse_url = cfg['IMG_RECONGNIZE_MODEL']['url']
-        self.img_parse_key = cfg['IMG_RECONGNIZE_MODEL']['api_key']
-        self.img_parse_model = cfg['IMG_RECONGNIZE_MODEL']['model_name']
-        self.openai_client = OpenAI(api_key=self.img_parse_key, base_url=self.img_parse_url)
-
         super().__init__(file_path, root_path, cfg, title_prefix, logger, output_dir)
 
+        # 图片描述请求先提交，转换完成后再统一取回结果
+        self.pending_images = {}
+
         # 检查是否是临时文件
         file_fullname = os.path.basename(file_path)
         if file_fullname.startswith('~') or file_fullname.startswith('.'):
@@ -41,14 +37,6 @@ class DOCXParser(BasicParser):
                 return []
             self.parse = parse
 
-    def _is_list(self, ele):
-
-        if ele.pPr is not None and ele.pPr.numPr is not None and ele.pPr.numPr.ilvl is not None:
-            return ele.pPr.numPr.ilvl.val
-        else:
-            return False
-
-
     def save_img(self, img_data, img_path):
 
         image = Image.open(io.BytesIO(img_data))
@@ -63,144 +51,175 @@ class DOCXParser(BasicParser):
         image.save(img_path, 'JPEG', quality=95)
         
         
+    def submit_image_description(self, img_path):
+        # 提交图像识别请求，返回 future
+        prepared = self.image_prep.prepare(img_path)
+        self.image_prep.log(prepared, img_path)
+        return self.engine.submit('IMG_RECONGNIZE_MODEL', [
+            {"role": "system", "content": img_parse_prompt},
+            {"role": "user", "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": prepared.data_url}
+                },
+            ]}
+        ])
+
     def get_image_description(self, img_path):
         # 调用 OpenAI 的 API 进行图像识别
-        b64_img = base64.b64encode(open(img_path, 'rb').read()).decode()
-        response = self.openai_client.chat.completions.create(
-            model=self.img_parse_model,
-            messages=[
-                {"role": "system", "content": img_parse_prompt},
-                {"role": "user", "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"}
-                    },
-                ]}
-            ]
-        )
         try:
-            result = response.choices[0].message.content
-            return result
+            return self.submit_image_description(img_path).result()
         except Exception as e:
             self.logger.error(f'image path: {img_path} parse error')
             self.logger.error(f'error: {e}')
-            self.logger.error(f'response: {result}')
+
+    def resolve_image_descriptions(self, md_content):
+        """
+        把 md_content 中的图片占位符替换为图片描述
+        """
+        def replace(match):
+            img_filename = match.group(1)
+            img_path, future = self.pending_images.pop(img_filename)
+            try:
+                image_description = future.result()
+            except Exception as e:
+                self.logger.error(f'image path: {img_path} parse error')
+                self.logger.error(f'error: {e}')
+                image_description = None
+
+            if not image_description:
+                return ''
+            img_position = f'{self.knowledge_path}: {img_filename}'
+            return f"\n\n@resource: {img_position}\n\n{image_description}\n@endresource\n"
+
+        return re.sub(r'@=@image_desc:([^@\n]+)@=@', replace, md_content)
 
     def docx_to_markdown(self):
         """
-        将 docx 文件转换为 Markdown，处理文本、表格和图片
-        :param docx_path: 输入的 docx 文件路径
-        :param output_md_path: 输出的 Markdown 文件路径
-        :param image_output_dir: 图片保存目录
+        将 docx 文件转换为 Markdown，处理文本、表格和图片，结果写入 output.md
+        流式读取 body 下的段落和表格，每一段的结果先逐行写入临时文件；按字号判断的标题要等统计完字号后才能确定级别
+        第二遍读取临时文件，确定标题级别、填入图片描述后写入 output.md，内存占用与文档长度无关
         """
-        doc = self.doc
-        markdown_lines = []
+        self.font_size_text_len = {}
         
         # 创建图片输出目录
         image_output_dir = os.path.join(self.output_dir, 'images')
         if not os.path.exists(image_output_dir):
             os.makedirs(image_output_dir)
+        self.image_count = 0
+
+        # 遍历所有段落和表格，每个元素的结果为一行 json：字符串，或 [字号, 作为标题时的文本, 不是标题时的文本]
+        parts_path = os.path.join(self.temp_dir, 'parts.jsonl')
+        with open(parts_path, 'w', encoding='utf-8') as f:
+            for kind, element in self.reader.iter_body():
+                # 处理段落
+                if kind == 'p':
+                    line = self.process_docx_paragraph(element, image_output_dir)
+                
+                # 处理表格
+                else:
+                    line = self.process_docx_table(element)
+                f.write(json.dumps(line, ensure_ascii=False) + '\n')
 
-        # 遍历所有段落和表格
-        para_ind = 0
-        tbl_ind = 0
-        for element in doc.element.body:
-            # 处理段落
-            if element.tag.endswith('p'):
-                paragraph = doc.paragraphs[para_ind]  # 计算段落索引
-                para_ind += 1
-                markdown_text = self.process_docx_paragraph(paragraph, image_output_dir)
-                if markdown_text.strip():  # 避免空行
-                    markdown_lines.append(markdown_text)
-            
-            # 处理表格
-            elif element.tag.endswith('tbl'):
-                table = doc.tables[tbl_ind]  # 计算表格索引
-                tbl_ind += 1
-                markdown_table = self.process_docx_table(table)
-                markdown_lines.append(markdown_table)
-        
-        # 写入 Markdown 文件
-        md_content = '\n'.join(markdown_lines)
-        self.md_content = md_content
-        output_md_path = os.path.join(self.output_dir, 'output.md')
-        with open(output_md_path, 'w', encoding='utf-8') as f:
-            f.write(md_content)
-        return md_content
+        # 确定字号对应的标题级别
+        self.get_title_level_by_font_size()
+
+        # 写入 Markdown 文件，各部分之间用换行连接，空行不写入
+        # 同时记录开头是否为一级标题、一级标题的个数，供 split_md 使用
+        self.output_md_path = os.path.join(self.output_dir, 'output.md')
+        self.starts_with_h1 = None
+        self.h1_count = 0
+        with open(parts_path, 'r', encoding='utf-8') as parts, open(self.output_md_path, 'w', encoding='utf-8') as f:
+            for part in parts:
+                line = json.loads(part)
+                if isinstance(line, list):
+                    size, heading_text, markdown_text = line
+                    if self.heading_sizes != None and size in self.heading_sizes:
+                        level = self.heading_sizes.index(size) + 1
+                        markdown_text = '#' * level +'' + heading_text
+                    line = markdown_text
+                if not line.strip():  # 避免空行
+                    continue
+
+                line = self.resolve_image_descriptions(line)
+                if self.starts_with_h1 is None:
+                    self.starts_with_h1 = line.lstrip().startswith('# ')
+                else:
+                    line = '\n' + line
+                self.h1_count += line.count('\n# ')
+                f.write(line)
+        os.remove(parts_path)
 
     def process_docx_paragraph(self, paragraph, image_output_dir):
         """
         处理段落文本，包括普通文本和图片
-        :param paragraph: docx Paragraph 对象
+        :param paragraph: w:p 节点
         :param image_output_dir: 图片保存目录
-        :return: Markdown 格式的文本
+        :return: Markdown 格式的文本；可能按字号成为标题的段落返回 (字号, 作为标题时的文本, 不是标题时的文本)
         """
-        text = paragraph.text.strip()
+        raw_text = self.reader.paragraph_text(paragraph)
+        text = raw_text.strip()
+        style = self.reader.paragraph_style(paragraph)
+
+        # 统计各字号的字数
+        size = style['size']
+        if size is not None:
+            self.font_size_text_len[size] = self.font_size_text_len.get(size, 0) + len(raw_text)
+
+        # 检查是否有图片
+        images_text = ''
+        for image_data in self.reader.paragraph_images(paragraph):
+            # 保存图片
+            self.image_count += 1
+            image_filename = f"image_{self.image_count}.jpg"
+            image_path = os.path.join(image_output_dir, image_filename)
+            self.save_img(image_data, image_path)
+            
+            # 提交图片描述请求，先用占位符占位
+            self.pending_images[image_filename] = (image_path, self.submit_image_description(image_path))
+            images_text += f'@=@image_desc:{image_filename}@=@'
 
         # 根据段落样式添加标题级别
-        is_heading = False
-        style_name = paragraph.style.name.lower()
+        style_name = style['name'].lower()
         if 'heading' in style_name and text != '':
             level = int(re.search(r'heading (\d+)', style_name).group(1)) if re.search(r'heading (\d+)', style_name) else 1
-            text = '#' * level + ' ' + text
-            is_heading = True
-        # 根据字体大小添加标题级别
-        elif self.heading_sizes !=None and text != '':
-            s = paragraph.style.font.size
-            if s != None and s.pt!= None and s.pt in self.heading_sizes:
-                level = self.heading_sizes.index(s.pt) + 1
-                text = '#' * level +'' + text
-                is_heading = True
+            return '#' * level + ' ' + text + images_text + '\n'
 
         # 检查是否为列表
         is_list = False
-        if is_heading is False and text!= '':
-            if self._is_list(paragraph._p) is not False:
-                # 检查是否为有序列表
-                level = paragraph._p.pPr.numPr.ilvl.val
-                text = '    ' * (level - 1) + '* ' + text
+        markdown_text = text
+        if text!= '':
+            level = self.reader.paragraph_ilvl(paragraph)
+            if level is not None:
+                markdown_text = '    ' * (level - 1) + '* ' + text
                 is_list = True
-            elif self._is_list(paragraph.style.paragraph_format.element) is not False:
-                level = paragraph.style.paragraph_format.element.pPr.numPr.ilvl.val
-                text ='  '* (level - 1) + '* '+ text
+            elif style['ilvl'] is not None:
+                level = style['ilvl']
+                markdown_text ='  '* (level - 1) + '* '+ text
                 is_list = True
 
-        # 检查是否有图片
-        for run in paragraph.runs:
-            if run._element.xpath('.//pic:pic'):
-                for shape in run._element.xpath('.//pic:pic'):
-                    blip = shape.xpath('.//a:blip/@r:embed')[0]
-                    image_part = paragraph.part.related_parts[blip]
-                    image_data = image_part.blob
-                    
-                    # 保存图片
-                    image_filename = f"image_{len(os.listdir(image_output_dir)) + 1}.jpg"
-                    image_path = os.path.join(image_output_dir, image_filename)
-                    self.save_img(image_data, image_path)
-                    
-                    # 获取图片描述
-                    image_description = self.get_image_description(image_path)
-                    
-                    # 添加图片描述
-                    if image_description:
-                        img_position = f'{self.knowledge_path}: {image_filename}'
-                        text += f"\n\n@resource: {img_position}\n\n{image_description}\n@endresource\n"
-        
+        markdown_text += images_text
         if is_list is False:
-            text = text + '\n'
-        return text
+            markdown_text = markdown_text + '\n'
+
+        # 根据字体大小添加标题级别，遍历结束后再确定
+        if size is not None and text != '':
+            return (size, text + images_text + '\n', markdown_text)
+        return markdown_text
 
     def process_docx_table(self, table):
         """
         将 docx 表格转换为 Markdown 表格
-        :param table: docx Table 对象
+        :param table: w:tbl 节点
         :return: Markdown 格式的表格
         """
         markdown_lines = []
-        rows = table.rows
+        rows = self.reader.table_rows(table)
+        if rows == []:
+            return ''
         
         # 表头
-        header = [cell.text.strip() for cell in rows[0].cells]
+        header = [cell.strip() for cell in rows[0]]
         markdown_lines.append('| ' + ' | '.join(header) + ' |')
         
         # 分隔行
@@ -208,77 +227,32 @@ class DOCXParser(BasicParser):
         
         # 数据行
         for row in rows[1:]:
-            row_data = [cell.text.strip() for cell in row.cells]
+            row_data = [cell.strip() for cell in row]
             markdown_lines.append('| ' + ' | '.join(row_data) + ' |')
         
         return '\n'.join(markdown_lines)
 
 
-    def split_md(self):
-        # 若 md 开头不是一级标题，添加一级标题为文件名
-        if not self.md_content.lstrip().startswith('# '):
-            self.md_content = f'# {self.file_basename}\n{self.md_content}'
+    def read_lines(self):
+        # 逐行读取 output.md，若开头不是一级标题，添加一级标题为文件名
+        if not self.starts_with_h1:
+            yield f'# {self.file_basename}'
+        with open(self.output_md_path, 'r', encoding='utf-8') as f:
+            yield from f
+
 
+    def split_md(self):
         # 如果 md 中含有多个一级标题，那么 self.title_prefix 保留文件名
-        if self.md_content.count('\n# ') > 1:
+        if self.h1_count > 1:
             if self.file_basename not in self.title_prefix:
                 self.title_prefix += '-' + self.file_basename
 
-        result = {}
-        headers = []
-        current_header_path = ''
-        current_content = []
-
-        # 按行遍历 Markdown 内容
-        for line in self.md_content.splitlines():
-            if line.startswith('#'):
-                # 处理当前标题内容
-                if current_header_path and current_content and ''.join(current_content) != '':
-                    position = f'{self.knowledge_path}: {"-".join(headers)}'
-                    result[current_header_path] = f'\n@section: {position}\n\n' + '\n'.join(current_content).strip() + '\n@endsection\n'
-                    current_content = []
-
-                # 解析新标题级别和文本
-                level = line.count('#')
-                header_text = line.strip('#').strip()
-
-                # 标题级别错误处理
-                if level > len(headers) + 1:
-                    self.logger.warning(f'标题级别跳跃: 当前标题级别 {level}, 上一级标题级别 {len(headers)}。标题: {header_text}')
-                    # 尝试修正标题级别，设置为上一级标题级别加 1
-                    level = len(headers) + 1
-
-                # 调整标题层级
-                if level > len(headers):
-                    headers.append(header_text)
-                elif level == len(headers):
-                    headers[-1] = header_text
-                else:
-                    headers = headers[:level - 1]
-                    headers.append(header_text)
-
-                # current_header_path = '-'.join([self.title_prefix] + headers)
-                if self.title_prefix == '':
-                    current_header_path = '-'.join(headers)
-                else:
-                    current_header_path = '-'.join([self.title_prefix] + headers)
-            else:
-                current_content.append(line)
-
-        # 处理最后一个标题内容
-        if current_header_path and current_content:
-            position = f'{self.knowledge_path}: {"-".join(headers)}'
-            result[current_header_path] = f'\n@section: {position}\n\n' + '\n'.join(current_content).strip() + '\n@endsection\n'
-        elif current_content:
-            position = self.file_basename
-            result[self.file_basename] = self.add_section_tag('\n'.join(current_content).strip(), position)
-
-        self.content_dict = result
+        self.sections = self.iter_sections(self.read_lines())
 
     def assemble_qa_info(self):
         qa_info = []
 
-        for title, content in self.content_dict.items():
+        for title, content in self.sections:
             qa_info.append({
                 'simple_title': title,
                 'full_title': title,
@@ -290,12 +264,15 @@ class DOCXParser(BasicParser):
     def parse(self):
 
         try:
-            self.doc = Document(self.file_path)
+            self.reader = DocxStreamReader(self.file_path)
         except Exception as e:
-            print(type(e), e)
+            self.logger.error(f'{self.file_path} 打开失败：{type(e)} {e}')
+            return []
 
-        self.get_title_level_by_font_size()
-        self.docx_to_markdown()
+        try:
+            self.docx_to_markdown()
+        finally:
+            self.reader.close()
         self.split_md()
         self.assemble_qa_info()
 
@@ -303,28 +280,13 @@ class DOCXParser(BasicParser):
 
     def get_title_level_by_font_size(self):
         # 逻辑：字数最多的字体大小应该是正文，比这个字体大的就是逐级标题
+        # 各字号的字数在 docx_to_markdown 遍历时统计
 
-        heading_sizes = {}
-        heading_numbers = 0
-        all_text_len = 0
-        for p in self.doc.paragraphs:
-            # 如果 p 的 style.name 以 Heading 开头，跳过
-            if p.style.name.lower().startswith('Heading'):
-                heading_numbers += 1
-                continue
-
-            s = p.style.font.size
-            if s is None: continue
-
-            text_len = len(p.text)
-            all_text_len += text_len
-
-            if s.pt not in heading_sizes.keys(): heading_sizes[s.pt] = 0
-            heading_sizes[s.pt] += text_len
+        heading_sizes = self.font_size_text_len
 
-        # if heading_numbers > 1: # 有标题
-        #     self.heading_sizes = None
-        # else:
+        if heading_sizes == {}:
+            self.heading_sizes = None
+            return
 
         # 取 value 最大的 heading_sizes
         max_value = max(heading_sizes.values())
@@ -0,0 +1,233 @@
+import zipfile
+import posixpath
+
+from lxml import etree
+
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+R_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+PIC_NS = 'http://schemas.openxmlformats.org/drawingml/2006/picture'
+A_NS = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+
+NSMAP = {'w': W_NS, 'r': R_NS, 'pic': PIC_NS, 'a': A_NS}
+
+
+def w(tag):
+    return f'{{{W_NS}}}{tag}'
+
+
+class DocxStreamReader:
+    """
+    直接从 zip 中用 iterparse 流式读取 word/document.xml，不构建 python-docx 的对象
+    每处理完一个 body 下的段落或表格就释放对应的 xml 节点，内存占用与文档长度无关
+    样式按 basedOn 继承链解析，结果缓存
+    """
+
+    def __init__(self, file_path):
+        self.zip = zipfile.ZipFile(file_path)
+        self.document_path = 'word/document.xml'
+        self.styles = {}
+        self.default_style = None
+        self.default_size = None
+        self._resolved = {}
+        self.rels = {}
+
+        self._load_styles()
+        self._load_rels()
+
+
+    def _read_xml(self, name):
+        if name not in self.zip.namelist():
+            return None
+        with self.zip.open(name) as f:
+            return etree.parse(f).getroot()
+
+
+    def _load_styles(self):
+        root = self._read_xml('word/styles.xml')
+        if root is None:
+            return
+
+        # 文档默认字号
+        sz = root.find(f'{w("docDefaults")}/{w("rPrDefault")}/{w("rPr")}/{w("sz")}')
+        if sz is not None:
+            self.default_size = int(sz.get(w('val'))) / 2
+
+        for style in root.iter(w('style')):
+            if style.get(w('type')) != 'paragraph':
+                continue
+            style_id = style.get(w('styleId'))
+            name = style.find(w('name'))
+            based_on = style.find(w('basedOn'))
+            sz = style.find(f'{w("rPr")}/{w("sz")}')
+            ilvl = style.find(f'{w("pPr")}/{w("numPr")}/{w("ilvl")}')
+            self.styles[style_id] = {
+                'name': name.get(w('val')) if name is not None else style_id,
+                'based_on': based_on.get(w('val')) if based_on is not None else None,
+                'size': int(sz.get(w('val'))) / 2 if sz is not None else None,
+                'ilvl': int(ilvl.get(w('val'))) if ilvl is not None else None,
+            }
+            if style.get(w('default')) in ('1', 'true'):
+                self.default_style = style_id
+
+
+    def _load_rels(self):
+        root = self._read_xml('word/_rels/document.xml.rels')
+        if root is None:
+            return
+        for rel in root.iter(f'{{{REL_NS}}}Relationship'):
+            if rel.get('TargetMode') == 'External':
+                continue
+            target = rel.get('Target')
+            if target.startswith('/'):
+                path = target.lstrip('/')
+            else:
+                path = posixpath.normpath(posixpath.join('word', target))
+            self.rels[rel.get('Id')] = path
+
+
+    def resolve_style(self, style_id):
+        """
+        按 basedOn 继承链解析样式，返回 {'name', 'size', 'ilvl'}
+        """
+        if style_id not in self.styles:
+            style_id = self.default_style
+        if style_id in self._resolved:
+            return self._resolved[style_id]
+
+        resolved = {'name': '', 'size': None, 'ilvl': None}
+        chain = []
+        current = style_id
+        # 防止样式循环引用
+        while current in self.styles and current not in chain:
+            chain.append(current)
+            current = self.styles[current]['based_on']
+
+        for sid in reversed(chain):
+            style = self.styles[sid]
+            for k in ('size', 'ilvl'):
+                if style[k] is not None:
+                    resolved[k] = style[k]
+        if chain != []:
+            resolved['name'] = self.styles[chain[0]]['name']
+        if resolved['size'] is None:
+            resolved['size'] = self.default_size
+
+        self._resolved[style_id] = resolved
+        return resolved
+
+
+    def paragraph_style(self, p):
+        style = p.find(f'{w("pPr")}/{w("pStyle")}')
+        return self.resolve_style(style.get(w('val')) if style is not None else None)
+
+
+    @staticmethod
+    def paragraph_ilvl(p):
+        ilvl = p.find(f'{w("pPr")}/{w("numPr")}/{w("ilvl")}')
+        if ilvl is None:
+            return None
+        return int(ilvl.get(w('val')))
+
+
+    @staticmethod
+    def run_text(r):
+        # 与 python-docx 的 Run.text 一致
+        text = []
+        for e in r:
+            tag = e.tag
+            if tag == w('t'):
+                text.append(e.text or '')
+            elif tag in (w('tab'), w('ptab')):
+                text.append('\t')
+            elif tag == w('br'):
+                if e.get(w('type')) in (None, 'textWrapping'):
+                    text.append('\n')
+            elif tag == w('cr'):
+                text.append('\n')
+            elif tag == w('noBreakHyphen'):
+                text.append('-')
+        return ''.join(text)
+
+
+    @classmethod
+    def paragraph_text(cls, p):
+        # 与 python-docx 的 Paragraph.text 一致，包含超链接中的文字
+        text = []
+        for e in p:
+            if e.tag == w('r'):
+                text.append(cls.run_text(e))
+            elif e.tag == w('hyperlink'):
+                text.extend(cls.run_text(r) for r in e.iterchildren(w('r')))
+        return ''.join(text)
+
+
+    def paragraph_images(self, p):
+        """
+        段落中的图片，返回图片内容的 bytes 列表
+        """
+        images = []
+        for r in p.iterchildren(w('r')):
+            for blip in r.xpath('.//pic:pic//a:blip/@r:embed', namespaces=NSMAP):
+                path = self.rels.get(blip)
+                if path is None or path not in self.zip.namelist():
+                    continue
+                images.append(self.zip.read(path))
+        return images
+
+
+    def table_rows(self, tbl):
+        """
+        表格的单元格文字，与 python-docx 的 row.cells 一致：横向合并的单元格重复，纵向合并的单元格取上方单元格的文字
+        """
+        rows = []
+        above = {}
+        for tr in tbl.iterchildren(w('tr')):
+            row = []
+            col = 0
+            for tc in tr.iterchildren(w('tc')):
+                tc_pr = tc.find(w('tcPr'))
+                span = 1
+                v_merge = None
+                if tc_pr is not None:
+                    grid_span = tc_pr.find(w('gridSpan'))
+                    if grid_span is not None:
+                        span = int(grid_span.get(w('val')))
+                    v_merge_elem = tc_pr.find(w('vMerge'))
+                    if v_merge_elem is not None:
+                        v_merge = v_merge_elem.get(w('val'), 'continue')
+
+                if v_merge == 'continue' and col in above:
+                    text = above[col]
+                else:
+                    text = '\n'.join(self.paragraph_text(p) for p in tc.iterchildren(w('p')))
+
+                for i in range(span):
+                    above[col + i] = text
+                    row.append(text)
+                col += span
+            rows.append(row)
+        return rows
+
+
+    def iter_body(self):
+        """
+        按顺序返回 body 下的段落和表格：('p', element) 或 ('tbl', element)
+        返回的 element 在下一次迭代时会被释放
+        """
+        with self.zip.open(self.document_path) as f:
+            for event, elem in etree.iterparse(f, events=('end',), tag=(w('p'), w('tbl'))):
+                parent = elem.getparent()
+                if parent is None or parent.tag != w('body'):
+                    continue
+
+                yield ('p' if elem.tag == w('p') else 'tbl'), elem
+
+                # 释放已处理的节点
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+
+
+    def close(self):
+        self.zip.close()
@@ -1,11 +1,12 @@
 import os
 import re
 from .basic_parser import BasicParser
+from tools.downloader import get_downloader
 from PIL import Image
 import io
 import base64
-import requests
-from openai import OpenAI
+import hashlib
+import concurrent.futures
 
 img_parse_prompt = '''
 你是一个图像识别助手，识别图片中的内容，并返回详细描述，格式如下：
@@ -19,58 +20,93 @@ class MDParser(BasicParser):
     # reg = r'(?:.*\.md|.*\.markdown)$'
     suffix = ['md', 'markdown']
 
+    # 图片标记的正则和从中取出图片路径的正则：md 语法、html 语法，同一行有多张图片时分别匹配
+    img_regs = [
+        (r'!\[[^\]]*\]\([^)]*\)', r'!\[[^\]]*\]\(([^)\s]*)'),
+        (r'<img[^>]*src="[^"]*"[^>]*>', r'<img[^>]*src="([^"]*)"'),
+    ]
+
     def __init__(self, file_path, root_path, cfg={}, title_prefix='%parent', logger=None, output_dir=''):
         # 检查文件类型
         if not file_path.lower().endswith('.md') and not file_path.lower().endswith('.markdown'):
             raise ValueError("file type error, not a markdown file")
 
-        # 获取图像识别模型的相关算法配置
-        self.img_parse_url = cfg['IMG_RECONGNIZE_MODEL']['url']
-        self.img_parse_key = cfg['IMG_RECONGNIZE_MODEL']['api_key']
-        self.img_parse_model = cfg['IMG_RECONGNIZE_MODEL']['model_name']
-        self.openai_client = OpenAI(api_key=self.img_parse_key, base_url=self.img_parse_url)
-
         super().__init__(file_path, root_path, cfg, title_prefix, logger, output_dir)
 
+        # 图片在切分前统一预取：并发下载、保存并提交描述请求，全部内容处理完后再统一取回结果
+        self.downloader = get_downloader(cfg, self.logger)
+        self.images = {}
+        self.image_names = set()
+        self.placeholders = []
+
+
+    def submit_image_description(self, img_path):
+        # 提交图像识别请求，返回 future
+        prepared = self.image_prep.prepare(img_path)
+        self.image_prep.log(prepared, img_path)
+        return self.engine.submit('IMG_RECONGNIZE_MODEL', [
+            {"role": "system", "content": img_parse_prompt},
+            {"role": "user", "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": prepared.data_url}
+                },
+            ]}
+        ])
 
     def get_image_description(self, img_path):
         # 调用 OpenAI 的 API 进行图像识别
-        b64_img = base64.b64encode(open(img_path, 'rb').read()).decode()
-        response = self.openai_client.chat.completions.create(
-            model=self.img_parse_model,
-            messages=[
-                {"role": "system", "content": img_parse_prompt},
-                {"role": "user", "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"}
-                    },
-                ]}
-            ]
-        )
         try:
-            result = response.choices[0].message.content
-            return result
+            return self.submit_image_description(img_path).result()
         except Exception as e:
             self.logger.error(f'image path: {img_path} parse error')
             self.logger.error(f'error: {e}')
-            self.logger.error(f'response: {result}')
 
+    def resolve_image_descriptions(self, content):
+        """
+        把 content 中的图片占位符替换为带 @resource 标签的图片描述，图片无法读取时保留原来的图片链接
+        """
+        def replace(match):
+            comp, img_path = self.placeholders[int(match.group(1))]
+            try:
+                prepared = self.images[img_path].result()
+            except Exception as e:
+                self.logger.warning(f'图片读取失败: {img_path}，{e}')
+                prepared = None
+            if prepared is None:
+                return comp
+
+            img_saved, future = prepared
+            try:
+                description = future.result()
+            except Exception as e:
+                self.logger.error(f'image path: {img_saved} parse error')
+                self.logger.error(f'error: {e}')
+                description = None
+
+            position = os.path.basename(img_saved)
+            return self.add_resource_tag(description, position)
+
+        return re.sub(r'@=@image_desc:(\d+)@=@', replace, content)
 
-    def save_img(self, img_path):
 
+    def load_img(self, img_path):
+        """
+        读取图片，支持 base64、网址和本地文件
+        :return: PIL 图像，无法读取时返回 None
+        """
         # 检查 img_path 是否是 base64 编码
         if re.search(r'^data:image\/(.*);base64,', img_path):
             # 如果是 base64 编码，将其转换为图片
             img_data = re.sub(r'^data:image\/(.*);base64,', '', img_path)
-            img = Image.open(io.BytesIO(base64.b64decode(img_data)))
+            return Image.open(io.BytesIO(base64.b64decode(img_data)))
         # 检查 img_path 是否是网址
         elif re.search(r'^http[s]?://', img_path):
             # 如果是网址，下载图片
             try:
-                img = Image.open(requests.get(img_path, stream=True).raw)
-            except:
-                self.logger.warning(f'图片下载失败: {img_path}')
+                return Image.open(io.BytesIO(self.downloader.fetch(img_path)))
+            except Exception as e:
+                self.logger.warning(f'图片下载失败: {img_path}，{e}')
                 return None
 
         # 本地文件
@@ -85,147 +121,123 @@ class MDParser(BasicParser):
                 return None
 
             # 打开图片
-            img = Image.open(img_path)
+            return Image.open(img_path)
 
-        # 保存图片
-        img_fullname = os.path.basename(img_path)
-        img_basename, _ = os.path.splitext(img_fullname)
-        new_img_name = f'{img_basename}.jpg'
-        img_saved = os.path.join(self.image_output_dir, os.path.basename(new_img_name))
-        
-        # img 转成 jpg
-        if img.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', img.size, (240,240,240))
-            background.paste(img, mask=img.split()[-1])
-            img = background
 
+    def saved_img_name(self, img_path):
+        # 保存的文件名取原文件名，base64 图片取内容的 hash，重名时加序号
+        if img_path.startswith('data:'):
+            img_basename = 'image_' + hashlib.sha1(img_path.encode('utf8')).hexdigest()[:12]
+        else:
+            img_basename, _ = os.path.splitext(os.path.basename(img_path.split('?')[0]))
+        name = f'{img_basename}.jpg'
+        n = 1
+        while name in self.image_names:
+            n += 1
+            name = f'{img_basename}_{n}.jpg'
+        self.image_names.add(name)
+        return name
+
+
+    def prepare_img(self, img_path, img_saved):
+        """
+        在线程池中执行：读取并保存图片，然后提交图片描述请求
+        :return: (保存的图片路径, 图片描述的 future)，图片无法读取时返回 None
+        """
+        img = self.load_img(img_path)
+        if img is None:
+            return None
+
+        # img 转成 jpg
+        img = self.image_prep.to_rgb(img)
         img.save(img_saved, 'JPEG', quality=95)
 
-        return img_saved
+        return img_saved, self.submit_image_description(img_saved)
 
-    def handle_img_reg(self, reg, link_reg, line):
-        # 通过 reg 处理图片
-        # reg 需要有一个 group
-        for comp in re.findall(reg, line):
-            try:
-                img_path = re.search(link_reg, comp).group(1)
-            except:
-                self.logger.error('reg format error, no group included')
 
-            # 保存图片
-            img_saved = self.save_img(img_path)
+    def iter_img_paths(self, line):
+        # 逐个返回行中的图片标记和图片路径
+        for reg, link_reg in self.img_regs:
+            for comp in re.findall(reg, line):
+                try:
+                    img_path = re.search(link_reg, comp).group(1)
+                except:
+                    self.logger.error('reg format error, no group included')
+                    continue
+                yield comp, img_path
 
-            # 获取图片描述
-            description = self.get_image_description(img_saved)
-            # position = f'{self.knowledge_path}: {os.path.basename(img_saved)}'
-            position = os.path.basename(img_saved)
-            # description = self.add_tag(description, 'resource', position)
-            description = self.add_resource_tag(description, position)
-            # description = f'\n@resource: {position}\n\n' + description + '\n@endresource\n'
 
-            # 替换
-            # line = re.sub(comp, description, line)
-            line = line.replace(comp, description)
+    def prefetch_images(self):
+        """
+        切分前先扫描一遍文件，收集所有图片（md 语法、html 语法、base64），并发下载、保存并提交描述请求
+        """
+        # 创建图片输出目录
+        self.image_output_dir = os.path.join(self.output_dir, 'images')
+        if not os.path.exists(self.image_output_dir):
+            os.makedirs(self.image_output_dir)
 
-        return line
+        is_in_code = False
+        for line in self.read_lines():
+            # 代码块和标题中的图片不处理，与切分时一致
+            if line.startswith('```'):
+                is_in_code = not is_in_code
+                continue
+            if is_in_code or line.startswith('#'):
+                continue
 
+            for comp, img_path in self.iter_img_paths(line):
+                if img_path in self.images:
+                    continue
+                img_saved = os.path.join(self.image_output_dir, self.saved_img_name(img_path))
+                self.images[img_path] = self.executor.submit(self.prepare_img, img_path, img_saved)
 
+        if self.images != {}:
+            self.logger.info(f'共 {len(self.images)} 张图片，已提交下载和描述请求')
+
+
+    def handle_img_line(self, line):
+        # 图片先用占位符替换，最后统一填入描述
+        for comp, img_path in self.iter_img_paths(line):
+            if img_path not in self.images:
+                continue
+            self.placeholders.append((comp, img_path))
+            line = line.replace(comp, f'@=@image_desc:{len(self.placeholders) - 1}@=@')
+        return line
 
-    def split_md(self):
 
-        # 读取 Markdown 文件内容
+    def read_lines(self):
+        # 逐行读取 Markdown 文件，不一次读入整个文件
         with open(self.file_path, 'r', encoding='utf-8') as file:
-            self.md_content = file.read()
-        
-        # 若 md 开头不是一级标题，添加一级标题为文件名
-        if not self.md_content.startswith('#'):
-            self.md_content = f'# {self.file_basename}\n\n' + self.md_content
+            first_line = file.readline()
+
+            # 若 md 开头不是一级标题，添加一级标题为文件名
+            if not first_line.startswith('#'):
+                yield f'# {self.file_basename}'
+                yield ''
+
+            yield first_line
+            yield from file
+
+
+    def split_md(self):
 
         # # 如果 md 中含有多个一级标题，那么 self.title_prefix 保留文件名
         # if self.md_content.count('\n# ') > 1:
         #     if self.file_basename not in self.title_prefix:
         #         self.title_prefix += '-' + self.file_basename
 
-        result = {}
-        headers = []
-        current_header_path = ''
-        current_content = []
-
-        # 创建图片输出目录
-        self.image_output_dir = os.path.join(self.output_dir, 'images')
-        if not os.path.exists(self.image_output_dir):
-            os.makedirs(self.image_output_dir)
-
-        # 按行遍历 Markdown 内容
-        is_in_code = False
-        for line in self.md_content.splitlines():
-            # 处理代码
-            if line.startswith('```'):
-                is_in_code = not is_in_code
-                continue
-            if is_in_code:
-                current_content.append(line)
-                continue
-
-            # 处理标题
-            if line.startswith('#') and not is_in_code:
-                # 处理当前标题内容
-                if current_header_path and current_content and ''.join(current_content) != '':
-                    position = "-".join(headers)
-                    result[current_header_path] = self.add_section_tag('\n'.join(current_content).strip(), position)
-                    current_content = []
-
-                # 解析新标题级别和文本
-                level = line.count('#')
-                header_text = line.strip('#').strip()
-
-                # 标题级别错误处理
-                if level > len(headers) + 1:
-                    self.logger.warning(f'标题级别跳跃: 当前标题级别 {level}, 上一级标题级别 {len(headers)}。标题: {header_text}')
-                    # 尝试修正标题级别，设置为上一级标题级别加 1
-                    level = len(headers) + 1
-
-                # 调整标题层级
-                if level > len(headers):
-                    headers.append(header_text)
-                elif level == len(headers):
-                    headers[-1] = header_text
-                else:
-                    headers = headers[:level - 1]
-                    headers.append(header_text)
-
-                # current_header_path = '-'.join([self.title_prefix] + headers)
-                if self.title_prefix == '':
-                    current_header_path = '-'.join(headers)
-                else:
-                    current_header_path = '-'.join([self.title_prefix] + headers)
-            else:
-                # 处理 md 语法的图片
-                line = self.handle_img_reg(r'!\[.*\]\(.*\)', r'!\[.*\]\((.*)\)', line)
-                # 处理 html 语法的图片
-                line = self.handle_img_reg(r'<img.*src=".*"[^>]*>', r'<img.*src="(.*)"[^>]*>', line)
-
-                current_content.append(line)
-
-        # 处理最后一个标题内容
-        if current_header_path and current_content:
-            position = "-".join(headers)
-            result[current_header_path] = self.add_section_tag('\n'.join(current_content).strip(), position)
-        elif current_content:
-            position = self.file_basename
-            result[self.file_basename] = self.add_section_tag('\n'.join(current_content).strip(), position)
-
-        self.content_dict = result
+        self.sections = self.iter_sections(self.read_lines(), self.handle_img_line)
         
 
     def assemble_qa_info(self):
         qa_info = []
 
-        for title, content in self.content_dict.items():
+        # 图片请求在切分前都已提交，每切出一段就填入图片描述
+        for title, content in self.sections:
             qa_info.append({
                 'simple_title': title,
                 'full_title': title,
-                'content': content
+                'content': self.resolve_image_descriptions(content)
             })
         
         self.qa_info = qa_info
@@ -233,7 +245,14 @@ class MDParser(BasicParser):
 
     def parse(self):
         
-        self.split_md()
-        self.assemble_qa_info()
+        # 图片的下载和保存在线程池中进行，解析结束或出错时关闭
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.downloader.workers, thread_name_prefix='md_image')
+        try:
+            self.prefetch_images()
+            self.split_md()
+            self.assemble_qa_info()
+        finally:
+            # 正常结束时图片都已处理完；出错时取消还没有开始的任务，不留下后台线程
+            self.executor.shutdown(cancel_futures=True)
 
         return self.qa_info
\ No newline at end of file
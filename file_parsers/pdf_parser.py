@@ -2,22 +2,154 @@ import fitz
 import json
 import os
 import re
-import base64
-import io
-from openai import OpenAI
 from PIL import Image
-from transformers.models.align.modeling_align import correct_pad
 import uuid
+import threading
+import unicodedata
+import multiprocessing
+import concurrent.futures
 
 from .basic_parser import BasicParser
+from tools.layout_detector import get_layout_detector
+
+# 页面渲染成图片时的缩放比例，bbox 统一使用渲染后图片的像素坐标
+RENDER_ZOOM = 2
+
+# 渲染 worker 中打开的 fitz 文档和图片处理配置，每个进程（线程）一个
+_render_local = threading.local()
+
+
+def render_page_image(pg, zoom=RENDER_ZOOM):
+    """
+    把页面渲染为 PIL 图像
+    """
+    try:
+        return pg.get_pixmap(matrix=fitz.Matrix(zoom, zoom)).pil_image()
+    except Exception as e:
+        pixmap = pg.get_pixmap()
+        return Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
+
+
+def _open_render_doc(file_path, image_prep):
+    _render_local.doc = fitz.open(file_path)
+    _render_local.image_prep = image_prep
+
+
+def _render_page(page_number, zoom=RENDER_ZOOM):
+    """
+    在渲染 worker 中渲染页面，并压缩编码为 JPEG
+    :return: PreparedImage，box 为发送区域在渲染图片中的像素坐标
+    """
+    img_pil = render_page_image(_render_local.doc[page_number], zoom)
+    return _render_local.image_prep.prepare(img_pil, baseline=True)
+
+
+class PageRenderer:
+    """
+    在进程池中提前渲染需要图像识别的页面，渲染和编码与模型请求同时进行
+    同时最多有 queue_size 个页面在渲染或等待使用，内存占用不随页数增长
+    workers 为 1 时使用单个线程渲染
+    """
+
+    def __init__(self, file_path, pages, image_prep, workers=1, queue_size=4):
+        self.pages = list(pages)
+        self.queue_size = max(1, queue_size)
+        self.next = 0
+        self.futures = {}
+        self.executor = None
+        if self.pages == []:
+            return
+
+        if workers > 1:
+            # 当前进程中已经有请求引擎的事件循环线程和 SQLite 连接，fork 会继承其中处于任意状态的锁，所以使用 spawn
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_open_render_doc, initargs=(file_path, image_prep)
+            )
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='pdf_render', initializer=_open_render_doc, initargs=(file_path, image_prep)
+            )
+        self._fill()
+
+
+    def _fill(self):
+        while self.next < len(self.pages) and len(self.futures) < self.queue_size:
+            page_number = self.pages[self.next]
+            self.futures[page_number] = self.executor.submit(_render_page, page_number)
+            self.next += 1
+
+
+    def get(self, page_number):
+        """
+        按 pages 的顺序获取渲染结果（page_number 从 0 开始），返回 PreparedImage
+        """
+        future = self.futures.pop(page_number)
+        # 先提交后面的页面，再等待当前页面
+        self._fill()
+        return future.result()
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+
+class DocBlock:
+    """
+    assemble_doc_md 中的一个内容块（标题、正文、列表、表格、代码块等）
+    跨页延续的内容追加到 parts 中，最后生成 md 时才拼接，避免反复拼接整篇文档
+    """
+
+    __slots__ = ('type', 'parts')
+
+    def __init__(self, block_type, content):
+        self.type = block_type
+        self.parts = [content]
+
+
+    def text(self):
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+
+    def endswith(self, suffix):
+        # 只拼接末尾需要的部分
+        tail = ''
+        for part in reversed(self.parts):
+            tail = part + tail
+            if len(tail) >= len(suffix):
+                break
+        return tail.endswith(suffix)
+
+
+    def append(self, content):
+        self.parts.append(content)
+
+
+    def replace(self, old, new):
+        """
+        替换块中的内容，返回是否找到了 old
+        """
+        text = self.text()
+        if old not in text:
+            return False
+        self.parts = [text.replace(old, new)]
+        return True
+
+
+    def to_md(self):
+        # 标题后面空一行
+        if self.type == '标题':
+            return self.text() + '\n\n'
+        return self.text() + '\n'
 
 # bbox 识别还是有一堆问题，像素不准确，格式不准确
 doc_pdf_parse_prompt = '''
 你是一个图像识别助手，识别图片中文档的排版及内容，内容必须是完整、准确的，不能缺失任何内容，不能包含错误或编造的内容。
-
-## 前一段内容
-
-{former_content}
+用户消息中先给出“前一段内容”，即前一页最后一段有效内容，然后给出需要识别的图片。
 
 ## 识别文档的内容块
 
@@ -44,7 +176,7 @@ doc_pdf_parse_prompt = '''
         2. 其中图表简述为图表的简要描述，尽量不超过 20 个字
         3. 其中图表的详细描述如果较长，可采用列表的方式
 3. bbox 是一个列表，包含四个元素，分别是左上角和右下角的 x 和 y 坐标，坐标值为三位小数，代表相对于图片的比例
-4. continued 是一个布尔值，针对正文、表格或代码块，判断当前内容是否是上方给出“前一段内容”的延续，如果“前一段内容”为空，则为 false
+4. continued 是一个布尔值，针对正文、表格或代码块，判断当前内容是否是用户消息中给出的“前一段内容”的延续，如果“前一段内容”为空，则为 false
 
 同时为 block 生成 block_id，block_id 从 1 开始依次编号
 
@@ -130,6 +262,26 @@ doc_pdf_parse_prompt = '''
 }
 '''
 
+# 多页识别的补充说明，放在用户消息开头；系统提示词对所有请求保持不变，便于接口的前缀缓存
+doc_pdf_batch_prompt = '''
+## 多页识别
+
+下面依次给出连续的多页文档图片，每张图片前标注了页序号（从 1 开始）。
+按系统提示中的要求分别识别每一页的内容块，每一页的 block_id 都从 1 开始编号，bbox 是相对于该页图片的比例。
+第 1 页的 continued 判断是否为“前一段内容”的延续，之后每一页的 continued 判断是否为前一页最后一段有效内容的延续。
+
+请严格按照下列格式返回，pages 的数量和顺序必须与图片一致：
+
+{
+    "pages": [
+        {
+            "page": 页序号,
+            "blocks": [与单页识别的返回格式相同的 block 列表]
+        }
+    ]
+}
+'''
+
 img_pdf_parse_prompt = '''
 你是一个图像识别助手，识别图片中的文档的排版及内容，采用 md 格式返回文档内容，注意：
 '''
@@ -182,25 +334,51 @@ determine_heading_level_prompt = '''
 ]
 '''
 
+stitch_pdf_page_prompt = '''
+你是一个文档排版助手，判断下一页开头的内容是否是上一页末尾内容的延续，即同一个段落、表格或代码块因为分页被截断。
+
+## 上一页末尾的内容（{former_type}）
+
+{former_content}
+
+## 下一页开头的内容（{current_type}）
+
+{current_content}
+
+## 返回格式
+
+只返回 true 或 false，不要返回其他内容
+'''
+
+# 版面检测得到的区域单独识别，系统提示词对所有区域相同，区域类型在用户消息中给出
+region_parse_prompt = '''
+你是一个图像识别助手，识别从文档页面中裁剪出的区域图片，内容必须是完整、准确的，不能缺失任何内容，不能包含错误或编造的内容。
+用户消息中给出区域的类型，按照类型直接返回 md 格式的内容，不要返回其他说明：
+
+1. 图表
+    1. 第一行为图表简述，尽量不超过 20 个字
+    2. 之后为图表的详细描述，如果较长，可采用列表的方式
+2. 表格
+    1. 识别是否包含表头
+        1. 如果包含表头，正常返回 md 格式表格
+        2. 如果不包含表头，则返回内容增加不包含表头的内容
+    2. 出现跨行或跨列的单元格，使用 “@cross_row_n” 或 “@cross_col_n” 标记，其中 n 为跨的行数或列数
+    3. 单元格中的换行使用 <br/>
+3. 公式块：识别公式，使用 $$ 包裹
+'''
+
 class PDFParser(BasicParser):
     suffix = 'pdf'
+
+    # assemble_doc_md 生成的临时标题：# 标题内容@=@id，连同后面的空白一起替换
+    heading_reg = re.compile(r'^#+ (.*)@=@([0-9a-f]{8})\s+', re.M)
+    # 版面检测的类别与 block 类型的对应关系，其他类别的内容从文字层提取
+    layout_region_types = {'figure': '图表', 'table': '表格', 'formula': '公式块', 'equation': '公式块'}
     def __init__(self, file_path, root_path, cfg={}, title_prefix='%parent', logger=None, output_dir=''):
         # 检查文件类型
         if not file_path.lower().endswith('.pdf'):
             raise ValueError("file type error, not a pdf file")
 
-        # 获取图像识别模型的相关算法配置
-        self.img_parse_url = cfg['IMG_RECONGNIZE_MODEL']['url']
-        self.img_parse_key = cfg['IMG_RECONGNIZE_MODEL']['api_key']
-        self.img_parse_model = cfg['IMG_RECONGNIZE_MODEL']['model_name']
-        self.openai_client = OpenAI(api_key=self.img_parse_key, base_url=self.img_parse_url)
-
-        # 获取他llm 相关算法配置
-        self.llm_url = cfg['LLM']['url']
-        self.llm_key = cfg['LLM']['api_key']
-        self.llm_model = cfg['LLM']['model_name']
-        self.llm_client = OpenAI(api_key=self.llm_key, base_url=self.llm_url)
-
         super().__init__(file_path, root_path, cfg, title_prefix, logger, output_dir)
 
         self.pdf_doc = fitz.open(self.file_path)
@@ -224,6 +402,44 @@ class PDFParser(BasicParser):
         if not os.path.exists(self.table_output_dir):
             os.makedirs(self.table_output_dir)
 
+        # 页面解析结果的检查点，每页完成后追加一行，中断后可以从第一个缺失的页面继续
+        self.checkpoint_path = os.path.join(self.output_dir, 'checkpoint.jsonl')
+
+        # 有文字层的页面直接从文字层生成 block，auto：文字层可用时使用；off：所有页面都使用图像识别
+        pdf_cfg = self.cfg.get('PDF', {})
+        self.text_layer_mode = pdf_cfg.get('text_layer', 'auto').lower()
+        self.body_font_size = None
+
+        # 页面渲染的进程数，0 表示按 CPU 核数和 worker 数自动计算
+        self.render_workers = int(pdf_cfg.get('render_workers') or 0)
+        if self.render_workers <= 0:
+            workers = max(1, int(self.cfg.get('RUNTIME', {}).get('workers', 1)))
+            self.render_workers = max(1, min(4, (os.cpu_count() or 1) // workers))
+        self.render_queue_size = int(pdf_cfg.get('render_queue_size') or 4)
+
+        # sequential：逐页解析，每页带上前一页的内容；speculative：所有页面不带上下文同时解析，之后再判断跨页的延续
+        self.parse_mode = pdf_cfg.get('parse_mode', 'sequential').lower()
+        # speculative 模式下同时请求的页数，0 表示使用图像识别模型的 MAX_IN_FLIGHT
+        self.speculative_window = int(pdf_cfg.get('speculative_window') or 0)
+        if self.speculative_window <= 0:
+            self.speculative_window = int(self.cfg.get('IMG_RECONGNIZE_MODEL', {}).get('max_in_flight', 16))
+        # 本地无法判断的跨页延续是否交给 LLM 判断，否则按不延续处理
+        self.stitch_llm = str(pdf_cfg.get('stitch_llm', 'True')).lower() not in ['false', '0', 'no', 'off']
+        # 一次请求最多识别的连续页数，1 表示逐页请求；多页共用一份系统提示词
+        self.batch_pages = max(1, int(pdf_cfg.get('batch_pages') or 1))
+        # 一次请求中图片的总大小上限（KB），内容复杂的页面图片较大，一次请求的页数随之减少
+        self.batch_kb = int(pdf_cfg.get('batch_kb') or 600)
+
+        # 版面检测：有文字层但包含图表、表格的页面，在本地检测版面，文字从文字层提取，只把图表、表格、公式区域交给图像识别模型
+        self.layout_detector = None
+        self.layout_pages = set()
+        if pdf_cfg.get('layout_detection', 'off').lower() == 'on':
+            detector = get_layout_detector(self.cfg, self.logger)
+            if detector.load():
+                self.layout_detector = detector
+            else:
+                self.logger.warning(f'版面检测不可用，使用图像识别模型识别整页：{detector.error}')
+
         # # 创建 img_output_dir
         # self.img_output_dir = os.path.join(self.output_dir, 'img')
         # if not os.path.exists(self.img_output_dir):
@@ -233,41 +449,30 @@ class PDFParser(BasicParser):
     def __bbox_dict_to_list(self, bbox_dict):
         return [int(bbox_dict['x1']), int(bbox_dict['y1']), int(bbox_dict['x2']), int(bbox_dict['y2'])]
 
-    def _corrent_bbox(self, result_dict, img_pil):
-
-        width, height = img_pil.size
+    def _corrent_bbox(self, result_dict, page_img):
 
+        # 发送的图片可能裁掉了边距、缩小过，按发送区域映射回完整渲染图片的像素坐标
         for blk in result_dict['blocks']:
-            x1 = round(blk['bbox'][0] * width)
-            y1 = round(blk['bbox'][1] * height)
-            x2 = round(blk['bbox'][2] * width)
-            y2 = round(blk['bbox'][3] * height)
-
-            blk['bbox'] = [x1, y1, x2, y2]
+            blk['bbox'] = page_img.map_bbox(blk['bbox'])
 
         return result_dict
 
+
+    def page_image(self, page_number):
+        """
+        完整分辨率的页面图片，用于裁剪图表、表格，只缓存最近一页
+        """
+        if getattr(self, '_page_image', (None, None))[0] != page_number:
+            self._page_image = (page_number, render_page_image(self.pdf_doc[page_number-1]))
+        return self._page_image[1]
+
     
     def _get_md_headings(self):
-        # 遍历 md_content，获取所有的 heading
-        headings = []
-        is_in_code = False
-        for l in self.md_content.split('\n'):
-            if l.startswith('```'):
-                is_in_code = not is_in_code
-                continue
-            if is_in_code:
-                continue
-            if l.startswith('# '):
-                # 获取 heading 的级别
-                level = len(l.split(' ')[0])
-                # 获取 heading 的内容
-                content_with_id = ' '.join(l.split(' ')[1:])
-                content = content_with_id.split('@=@')[0]
-                heading_id = content_with_id.split('@=@')[1]
-                headings.append({'content': content, 'level': level, 'id': heading_id})
-
-        return headings
+        # assemble_doc_md 时已按顺序记录了所有的 heading
+        return [
+            {'content': content, 'level': 1, 'id': heading_id}
+            for heading_id, content in self.headings.items()
+        ]
 
     
     def _correct_heading_level(self, headings):
@@ -286,18 +491,16 @@ class PDFParser(BasicParser):
         prompt = determine_heading_level_prompt.replace('{toc_list}', json.dumps(doc_toc, ensure_ascii=False, indent=4))
         prompt = prompt.replace('{heading_list}', json.dumps(headings, ensure_ascii=False, indent=4))
 
-        # 调用 OpenAI 的 API 进行图像识别
+        # 调用 LLM 调整标题级别
+        messages = [
+            {"role": "system", "content": prompt}
+        ]
         try:
-            response = self.llm_client.chat.completions.create(
-                model=self.llm_model,
-                messages=[
-                    {"role": "system", "content": prompt}
-                ]
-            )
+            result_str = self.engine.chat('LLM', messages)
         except Exception as e:
             self.logger.error(f'调用 OpenAI API 失败，错误信息：{e}')
+            return []
         
-        result_str = response.choices[0].message.content
         # with open('PDFParser_correct_heading_level_response.json', 'r') as f:
         #     result_str = f.read()
         if self.cfg['LOG']['log_level'] in ['DEBUG']:
@@ -307,23 +510,61 @@ class PDFParser(BasicParser):
             result = json.loads(result_str)
         except json.JSONDecodeError:
             self.logger.warning(f'解析 OpenAI API 返回的 JSON 失败：{result_str}')
+            self.engine.discard('LLM', messages)
+            return []
         
         return result
 
     
     def _replace_heading(self, headings):
-        # 遍历 headings，获取所有的 heading
+        """
+        按 @=@ 后的 id 替换所有标题，逐块写入 full_text.md，同时记录开头是否为一级标题、一级标题的个数
+        :param headings: 模型返回的标题级别 [{'content', 'level', 'id'}]，level 为 0 时删除标题，没有返回的标题保持一级
+        """
+        levels = {}
         for heading in headings:
-            # 替换 md_content 中的 heading
-            # reg = re.compile('#+ ' + heading['content'] + '@=@' + heading['id'] + '[\s\n]+')
-            reg = r'#+ ' + heading['content'] + '@=@' + heading['id'] + r'[\s\n]+'
-            if heading['level'] == 0:
-                corret_heading = ''
-            else:
-                corret_heading = '#'*heading['level']+' '+heading['content'] + '\n\n'
-
-            # self.md_content = self.md_content.replace(reg, corret_heading)
-            self.md_content = re.sub(reg, corret_heading, self.md_content)
+            if isinstance(heading, dict) and 'id' in heading:
+                levels[str(heading['id'])] = heading.get('level', 1)
+
+        def replace(match):
+            content, heading_id = match.group(1), match.group(2)
+            if heading_id not in self.headings:
+                return match.group(0)
+            try:
+                level = int(levels.get(heading_id, 1))
+            except (TypeError, ValueError):
+                level = 1
+
+            if level == 0:
+                return ''
+            return '#'*level+' '+content + '\n\n'
+
+        self.output_md_path = os.path.join(self.output_dir, 'full_text.md')
+        self.starts_with_h1 = None
+        self.h1_count = 0
+        tail = ''
+        strip_leading = False
+        with open(self.output_md_path, 'w', encoding='utf-8') as f:
+            for blk in self.blocks:
+                md = blk.to_md()
+                # 标题的正则会连同后面所有的空白一起替换，包括后续块开头的空白
+                if strip_leading:
+                    md = md.lstrip()
+                    if md == '':
+                        continue
+                    strip_leading = False
+                # 只有标题块带有 id
+                if blk.type == '标题':
+                    replaced = self.heading_reg.sub(replace, md)
+                    strip_leading = replaced != md
+                    md = replaced
+
+                if self.starts_with_h1 is None and md.strip():
+                    self.starts_with_h1 = md.lstrip().startswith('# ')
+                # 一级标题可能跨两个块，带上前一块的末尾一起统计
+                self.h1_count += (tail + md).count('\n# ')
+                tail = (tail + md)[-2:]
+                f.write(md)
 
     
     def _correct_latex_formula(self, content):
@@ -342,6 +583,65 @@ class PDFParser(BasicParser):
 
         return content
 
+    def _source_signature(self):
+        # 源文件变化后检查点失效
+        st = os.stat(self.file_path)
+        return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+    def load_checkpoint(self):
+        """
+        读取检查点，恢复从第 1 页开始连续完成的页面
+        :return: (已完成的页数, 传给下一页的 former_content)
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return 0, ''
+
+        pages = {}
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 最后一行可能因为中断没有写完
+                    self.logger.warning(f'检查点第 {i+1} 行不完整，忽略之后的内容')
+                    break
+
+                if i == 0:
+                    if record.get('source') != self._source_signature():
+                        self.logger.info('源文件已变化，忽略之前的检查点')
+                        os.remove(self.checkpoint_path)
+                        return 0, ''
+                    continue
+                pages[record['page']] = record
+
+        page_count = 0
+        former_content = ''
+        while page_count + 1 in pages:
+            record = pages[page_count + 1]
+            self.doc_content.append(record['result'])
+            former_content = record['former_content']
+            page_count += 1
+
+        if page_count > 0:
+            self.logger.info(f'从检查点恢复 {page_count} 页，从第 {page_count+1} 页继续')
+        return page_count, former_content
+
+
+    def save_checkpoint(self, page_number, result, former_content):
+        """
+        追加一页的解析结果到检查点，并立即落盘
+        """
+        is_new = not os.path.exists(self.checkpoint_path)
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+            if is_new:
+                f.write(json.dumps({'source': self._source_signature()}) + '\n')
+            record = {'page': page_number, 'result': result, 'former_content': former_content}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
     def judge_pdf_type(self):
 
         # 根据文档是否有文字判断是否是纯图片
@@ -370,64 +670,408 @@ class PDFParser(BasicParser):
             return 'unknown', img
 
 
-    def parse_doc_page(self, pg_pil_img, page_number, former_content=''):
-        # 调用 OpenAI 的 API 进行图像识别
-        
-        # 确保 pg_pil_img 是 RBG 模式
-        if pg_pil_img.mode != 'RGB':
-            pg_pil_img = pg_pil_img.convert('RGB')
-        
-        # 将 PIL 图像转换为 base64 编码
-        byte_arr = io.BytesIO()
-        pg_pil_img.save(byte_arr, format='JPEG')
-        b64_img = base64.b64encode(byte_arr.getvalue()).decode('utf8')
+    # 列表项的开头：项目符号、1. 1) 1、 (1) （1）
+    list_item_reg = re.compile(r'^(?:[•●○▪■◆◇◦·]\s*|[\-\*–]\s+|\d{1,2}[\.\)]\s+|\d{1,2}、|[（(]\d{1,2}[）)]\s*)')
+    bullet_reg = re.compile(r'^(?:[•●○▪■◆◇◦·]\s*|[\-\*–]\s+)')
+    sentence_end_reg = re.compile(r'[。！？.!?；;：:]["”’)）]*$')
+    table_sep_reg = re.compile(r'^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$')
 
-        # 发起请求
-        prompt = doc_pdf_parse_prompt.replace( '{former_content}', former_content)
-        try:
-            response = self.openai_client.chat.completions.create(
-                model=self.img_parse_model,
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"}
-                        }
-                    ]}
-                ]
-            )
-        except Exception as e:
-            self.logger.error(f'调用 OpenAI API 失败，错误信息：{e}')
-            raise ValueError(f'调用 OpenAI API 失败，错误信息：{e}')
 
-        result_str = response.choices[0].message.content
-        # with open(f'PDFParser_parse_doc_page_response_{page_number}.json', 'r', encoding='utf-8') as f:
-        #     result_str = f.read()
+    def _body_font_size(self):
+        """
+        正文字号：整个文档中字符数最多的字号，用于判断标题
+        """
+        if self.body_font_size is None:
+            counter = {}
+            for pg in self.pdf_doc:
+                for blk in pg.get_text('dict', flags=fitz.TEXTFLAGS_TEXT)['blocks']:
+                    for line in blk['lines']:
+                        for span in line['spans']:
+                            size = round(span['size'], 1)
+                            counter[size] = counter.get(size, 0) + len(span['text'].strip())
+            self.body_font_size = max(counter, key=counter.get) if counter else 0
+        return self.body_font_size
+
+
+    def check_text_readable(self, page_dict):
+        """
+        判断文字层的文字是否可用，不考虑图片、图表
+        :return: None 表示可用，否则返回原因
+        """
+        text = ''.join(span['text'] for blk in page_dict['blocks'] for line in blk['lines'] for span in line['spans'])
+        chars = [c for c in text if not c.isspace()]
+        if len(chars) < 10:
+            return '文字层为空'
+
+        # 字体没有 unicode 映射时，会得到替换字符、私有区字符或控制字符
+        bad_chars = [c for c in chars if c == '\ufffd' or unicodedata.category(c) in ('Co', 'Cc', 'Cn')]
+        if len(bad_chars) > len(chars) * 0.02:
+            return f'文字层中有 {len(bad_chars)} 个无法识别的字符'
+
+        return None
+
+
+    def check_text_layer(self, pg, page_dict):
+        """
+        判断页面能否直接使用文字层
+        :return: None 表示可以使用，否则返回需要图像识别的原因
+        """
+        reason = self.check_text_readable(page_dict)
+        if reason is not None:
+            return reason
+
+        page_area = pg.rect.width * pg.rect.height
+
+        # 有插图的页面需要图像识别模型描述图片
+        for info in pg.get_image_info():
+            if fitz.Rect(info['bbox']).get_area() > page_area * 0.05:
+                return '包含图片'
+
+        # 矢量图表、表格由较多的图形组成，细线（分隔线、下划线）不计入
+        shapes = 0
+        for d in pg.get_drawings():
+            r = d['rect']
+            if r.get_area() > page_area * 0.9:
+                continue
+            if r.width > pg.rect.width * 0.1 and r.height > pg.rect.height * 0.05:
+                return '包含图表或表格'
+            shapes += 1
+        if shapes >= 20:
+            return '包含图表或表格'
+
+        return None
+
+
+    def _join_lines(self, lines):
+        # 英文按空格连接，行尾的连字符去掉；中文直接连接
+        text = lines[0]
+        for line in lines[1:]:
+            if text.endswith('-') and len(text) > 1 and text[-2].isalpha():
+                text = text[:-1] + line
+            elif text[-1].isascii() and line[0].isascii():
+                text += ' ' + line
+            else:
+                text += line
+        return text
+
+
+    def parse_text_page(self, pg, page_dict, page_number, former_content=''):
+        """
+        根据文字层生成页面的 block，格式与 parse_doc_page 的识别结果一致
+        标题按字号判断，级别统一由 _correct_heading_level 处理
+        """
+        body_size = self._body_font_size()
+        height = pg.rect.height
+
+        # 前一页最后一个有效 block，用于判断本页第一段是否为延续
+        former_block = None
+        if len(self.doc_content) > 0:
+            useful = [x for x in self.doc_content[-1]['blocks'] if x['type'] not in ['页眉', '页脚', '脚注']]
+            if useful != []:
+                former_block = useful[-1]
+
+        blocks = []
+        for blk in page_dict['blocks']:
+            lines = []
+            sizes = []
+            bold = True
+            for line in blk['lines']:
+                spans = [x for x in line['spans'] if x['text'].strip() != '']
+                if spans == []:
+                    continue
+                lines.append(''.join(x['text'] for x in line['spans']).strip())
+                sizes += [x['size'] for x in spans]
+                bold = bold and all(x['flags'] & fitz.TEXT_FONT_BOLD for x in spans)
+            if lines == []:
+                continue
+
+            x1, y1, x2, y2 = blk['bbox']
+            text_len = sum(len(x) for x in lines)
+
+            if y2 < height * 0.06:
+                blk_type, content = '页眉', self._join_lines(lines)
+            elif y1 > height * 0.94:
+                blk_type, content = '页脚', self._join_lines(lines)
+            elif len(lines) <= 3 and text_len <= 80 and (
+                max(sizes) >= body_size * 1.15
+                or (bold and len(lines) == 1 and text_len <= 40 and not self.sentence_end_reg.search(lines[0]))
+            ):
+                blk_type, content = '标题', self._join_lines(lines)
+            elif self.list_item_reg.match(lines[0]):
+                # 一个 block 中可能有多个列表项，不以列表符号开头的行属于上一项
+                items = []
+                for line in lines:
+                    if self.list_item_reg.match(line) or items == []:
+                        items.append([line])
+                    else:
+                        items[-1].append(line)
+                content = []
+                for item in items:
+                    item = self._join_lines(item)
+                    if self.bullet_reg.match(item):
+                        item = '- ' + self.bullet_reg.sub('', item)
+                    content.append(item)
+                blk_type, content = '列表', '\n'.join(content)
+            else:
+                blk_type, content = '正文', self._join_lines(lines)
+
+            # 避免正文被当作 md 标题
+            if blk_type != '标题' and content.startswith('#'):
+                content = '\\' + content
+
+            # 只有本页第一个有效 block 可能是前一页的延续
+            continued = False
+            if blk_type == '正文' and former_block is not None and former_block['type'] == '正文' and former_block not in blocks:
+                continued = not self.sentence_end_reg.search(former_block['content'].rstrip())
+
+            block = {
+                'id': len(blocks) + 1,
+                'type': blk_type,
+                'content': content,
+                'bbox': [round(v * RENDER_ZOOM) for v in blk['bbox']],
+                'continued': continued,
+            }
+            blocks.append(block)
+            if blk_type not in ['页眉', '页脚']:
+                former_block = block
+
+        result = {'blocks': blocks}
+        self.doc_content.append(result)
+
+        useful = [x for x in blocks if x['type'] not in ['页眉', '页脚', '脚注']]
+        if useful == []:
+            return former_content
+        return useful[-1]['content']
+
+
+    def region_messages(self, region_img, region_type):
+        return [
+            {"role": "system", "content": region_parse_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": f'区域类型：{region_type}'},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": region_img.data_url}
+                }
+            ]}
+        ]
+
+
+    def parse_region(self, region_img, region_type, page_number, future):
+        """
+        取回区域的识别结果，失败时重试 3 次
+        :return: 识别的内容，重试后仍失败时返回 None
+        """
+        messages = self.region_messages(region_img, region_type)
+        retried = 0
+        while True:
+            try:
+                content = future.result() if retried == 0 else self.engine.chat('IMG_RECONGNIZE_MODEL', messages)
+                content = content.strip()
+                if content == '':
+                    self.engine.discard('IMG_RECONGNIZE_MODEL', messages)
+                    raise ValueError('返回内容为空')
+                return content
+            except Exception as e:
+                retried += 1
+                if retried > 3:
+                    self.logger.error(f'页面 {page_number} 的{region_type}区域已重试 3 次，跳过该区域')
+                    return None
+
+                self.logger.warning(f'页面 {page_number} 的{region_type}区域识别失败（{e}），正在第 {retried} 次重试...')
+
+
+    def parse_layout_page(self, pg, page_dict, page_number, former_content=''):
+        """
+        在本地检测版面，文字从文字层提取，图表、表格、公式区域裁剪后交给图像识别模型
+        区域的 bbox 来自版面检测，保存的图表、表格图片与页面上的位置一致
+        """
+        page_img = self.page_image(page_number)
+        regions = []
+        for region in self.layout_detector.detect(page_img):
+            if region['type'] in self.layout_region_types:
+                regions.append(dict(region, type=self.layout_region_types[region['type']]))
+        regions.sort(key=lambda x: (x['bbox'][1], x['bbox'][0]))
+
+        # 先发出所有区域的请求，与文字层的处理同时进行
+        for region in regions:
+            region['img'] = self.image_prep.prepare(page_img.crop(region['bbox']))
+            region['future'] = self.engine.submit('IMG_RECONGNIZE_MODEL', self.region_messages(region['img'], region['type']))
+
+        # 中心点落在区域内的文字层 block（图表中的文字、表格、公式）不作为正文
+        def covered(blk):
+            cx = (blk['bbox'][0] + blk['bbox'][2]) / 2 * RENDER_ZOOM
+            cy = (blk['bbox'][1] + blk['bbox'][3]) / 2 * RENDER_ZOOM
+            return any(r['bbox'][0] <= cx <= r['bbox'][2] and r['bbox'][1] <= cy <= r['bbox'][3] for r in regions)
+
+        text_dict = dict(page_dict, blocks=[x for x in page_dict['blocks'] if not covered(x)])
+        self.parse_text_page(pg, text_dict, page_number, former_content)
+        result = self.doc_content[-1]
+
+        # 区域按位置插入到下方第一个文字 block 之前
+        blocks = result['blocks']
+        for region in regions:
+            content = self.parse_region(region['img'], region['type'], page_number, region['future'])
+            if content is None:
+                continue
+            block = {'id': 0, 'type': region['type'], 'content': content, 'bbox': region['bbox'], 'continued': False}
+            index = len(blocks)
+            for i, blk in enumerate(blocks):
+                if blk['type'] != '页眉' and blk['bbox'][1] >= region['bbox'][1]:
+                    index = i
+                    break
+            blocks.insert(index, block)
+
+        for i, blk in enumerate(blocks):
+            blk['id'] = i + 1
+
+        # 保存图表、表格的图片
+        for blk in blocks:
+            if blk['type'] == '图表':
+                img_name = f'page_{page_number}_chart_{blk["id"]}.jpg'
+                page_img.crop(blk['bbox']).save(os.path.join(self.chart_output_dir, img_name))
+                blk['content'] = f'\n@resource: {self.knowledge_path}: {img_name}\n\n{blk["content"]}\n@endresource\n'
+            elif blk['type'] == '表格':
+                img_name = f'page_{page_number}_table_{blk["id"]}.jpg'
+                page_img.crop(blk['bbox']).save(os.path.join(self.table_output_dir, img_name))
+
+        # 只有本页第一个有效 block 可能是前一页的延续
+        useful = [x for x in blocks if x['type'] not in ['页眉', '页脚', '脚注']]
+        for blk in useful[1:]:
+            blk['continued'] = False
+
+        if useful == []:
+            return former_content
+        return useful[-1]['content']
+
+
+    def page_messages(self, page_img, former_content=''):
+        # page_img 为渲染进程返回的 PreparedImage，已经压缩编码，使用 data_url 发送
+        # 系统提示词固定不变，前一段内容放在用户消息中
+        return [
+            {"role": "system", "content": doc_pdf_parse_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": f'## 前一段内容\n\n{former_content}'},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": page_img.data_url}
+                }
+            ]}
+        ]
+
+
+    def batch_messages(self, page_imgs, former_content=''):
+        # 多页一次请求，每张图片前标注页序号
+        content = [
+            {"type": "text", "text": doc_pdf_batch_prompt},
+            {"type": "text", "text": f'## 前一段内容\n\n{former_content}'},
+        ]
+        for i, page_img in enumerate(page_imgs):
+            content.append({"type": "text", "text": f'第 {i+1} 页'})
+            content.append({"type": "image_url", "image_url": {"url": page_img.data_url}})
+        return [
+            {"role": "system", "content": doc_pdf_parse_prompt},
+            {"role": "user", "content": content},
+        ]
+
+
+    def load_page_result(self, result_str, endpoint_messages, name):
+        """
+        解析模型返回的 JSON，失败时删除缓存，重试时重新请求
+        """
         result_str = self._correct_latex_formula(result_str)
 
         if self.cfg['LOG']['log_level'] in ['DEBUG']:
-            with open(f'PDFParser_parse_doc_page_response_{page_number}.json', 'w', encoding='utf-8') as f:
+            with open(f'PDFParser_parse_doc_page_response_{name}.json', 'w', encoding='utf-8') as f:
                     f.write(result_str)
 
-
         try:
-            result = json.loads(result_str)
+            return json.loads(result_str)
         except json.JSONDecodeError:
             self.logger.warning(f'解析 OpenAI API 返回的 JSON 失败：{result_str}')
+            # 删除缓存，重试时重新请求
+            self.engine.discard('IMG_RECONGNIZE_MODEL', endpoint_messages)
             raise ValueError(f'解析 OpenAI API 返回的 JSON 失败：{result_str}')
 
+
+    def parse_doc_batch(self, batch, former_content='', result_str=None):
+        """
+        一次请求识别连续的多页
+        :param batch: [(页面序号（从 0 开始）, PreparedImage)]
+        :param result_str: 已经提前请求到的结果（speculative 模式），为 None 时在这里请求
+        :return: 每一页解析后的 former_content 列表
+        """
+        first, last = batch[0][0] + 1, batch[-1][0] + 1
+        for page_index, page_img in batch:
+            self.image_prep.log(page_img, f'{self.knowledge_path} 第 {page_index+1} 页')
+
+        messages = self.batch_messages([page_img for _, page_img in batch], former_content)
+        if result_str is None:
+            result_str = self.engine.chat('IMG_RECONGNIZE_MODEL', messages)
+        result = self.load_page_result(result_str, messages, f'{first}-{last}')
+
+        pages = result.get('pages') if isinstance(result, dict) else None
+        if not isinstance(pages, list) or len(pages) != len(batch) or any(not isinstance(x, dict) or not isinstance(x.get('blocks'), list) for x in pages):
+            self.engine.discard('IMG_RECONGNIZE_MODEL', messages)
+            raise ValueError(f'返回的页数与图片数（{len(batch)}）不一致')
+        if all(isinstance(x.get('page'), int) for x in pages):
+            pages = sorted(pages, key=lambda x: x['page'])
+
+        # 任何一页处理失败时撤销整批的结果
+        doc_len = len(self.doc_content)
+        contents = []
+        try:
+            for (page_index, page_img), page in zip(batch, pages):
+                former_content = self.finish_doc_page({'blocks': page['blocks']}, page_img, page_index+1, former_content)
+                contents.append(former_content)
+        except Exception:
+            del self.doc_content[doc_len:]
+            raise
+        return contents
+
+
+    def parse_doc_page(self, page_img, page_number, former_content='', result_str=None):
+        # 调用 OpenAI 的 API 进行图像识别
+        # result_str 为已经提前请求到的结果（speculative 模式），为 None 时在这里请求
+        self.image_prep.log(page_img, f'{self.knowledge_path} 第 {page_number} 页')
+
+        # 发起请求
+        messages = self.page_messages(page_img, former_content)
+        if result_str is None:
+            try:
+                result_str = self.engine.chat('IMG_RECONGNIZE_MODEL', messages)
+            except Exception as e:
+                self.logger.error(f'调用 OpenAI API 失败，错误信息：{e}')
+                raise ValueError(f'调用 OpenAI API 失败，错误信息：{e}')
+
+        # with open(f'PDFParser_parse_doc_page_response_{page_number}.json', 'r', encoding='utf-8') as f:
+        #     result_str = f.read()
+        result = self.load_page_result(result_str, messages, page_number)
+
+        doc_len = len(self.doc_content)
+        try:
+            return self.finish_doc_page(result, page_img, page_number, former_content)
+        except Exception:
+            del self.doc_content[doc_len:]
+            raise
+
+
+    def finish_doc_page(self, result, page_img, page_number, former_content=''):
+        """
+        处理一页的识别结果：bbox 转换为像素值，保存图表、表格的图片
+        :return: 本页最后一个有效 block 的内容
+        """
         # 把百分比的 bbox 转换为像素值
-        result = self._corrent_bbox(result, pg_pil_img)
+        result = self._corrent_bbox(result, page_img)
 
         self.doc_content.append(result)
-        last_useful_block = [x for x in result['blocks'] if x['type'] not in ['页眉', '页脚', '脚注']][-1]
+        useful = [x for x in result['blocks'] if x['type'] not in ['页眉', '页脚', '脚注']]
 
         
         # 处理图表
         for blk in [x for x in result['blocks'] if x['type'] == '图表']:
             # 根据 bbox 获取图片
-            img = pg_pil_img.crop(blk['bbox'])
+            img = self.page_image(page_number).crop(blk['bbox'])
             img_path = os.path.join(self.chart_output_dir, f'page_{page_number}_chart_{blk["id"]}.jpg')
             img.save(img_path)
 
@@ -440,22 +1084,23 @@ class PDFParser(BasicParser):
         
         # 处理表格
         for blk in [x for x in result['blocks'] if x['type'] == '表格']:
-            print('@@@@@@')
-            print(blk['bbox'])
-            print(pg_pil_img.size)
+            self.logger.debug(f'页面 {page_number} 表格 {blk["id"]}：bbox {blk["bbox"]}，图片大小 {page_img.size}')
             # 根据 bbox 获取图片
-            img = pg_pil_img.crop(blk['bbox'])
+            img = self.page_image(page_number).crop(blk['bbox'])
             img_path = os.path.join(self.table_output_dir, f'page_{page_number}_table_{blk["id"]}.jpg')
             img.save(img_path)
 
-        return last_useful_block['content']
+        # 只有页眉、页脚的空白页，沿用前一页的内容
+        if useful == []:
+            return former_content
+        return useful[-1]['content']
 
         # # 处理页面，保存下来
         # img_list = [x for x in result['blocks'] if x['type'] == '图表']
         # if img_list != []:
         #     img_name = f'page_{page_number}.jpg'
         #     img_path = os.path.join(self.img_output_dir, img_name)
-        #     pg_pil_img.save(img_path)
+        #     self.page_image(page_number).save(img_path)
 
         #     for blk in img_list:
         #         former_info = f'@resource: {blk["id"]}'
@@ -464,12 +1109,144 @@ class PDFParser(BasicParser):
             
 
     
+    def _text_layer_edge(self, page_index):
+        """
+        文字层中正文区域（去掉页眉、页脚）的第一行和最后一行，用于判断跨页的延续
+        :return: {'first_line', 'last_line', 'indented'}，没有文字层或文字层不可用时返回 None
+        """
+        pg = self.pdf_doc[page_index]
+        height = pg.rect.height
+        page_dict = pg.get_text('dict', flags=fitz.TEXTFLAGS_TEXT, sort=True)
+        # 文字过少或乱码的文字层不能用来判断
+        if self.check_text_readable(page_dict) is not None:
+            return None
+        lines = []
+        for blk in page_dict['blocks']:
+            for line in blk['lines']:
+                spans = [x for x in line['spans'] if x['text'].strip() != '']
+                x1, y1, x2, y2 = line['bbox']
+                if spans == [] or y2 < height * 0.06 or y1 > height * 0.94:
+                    continue
+                lines.append((x1, spans[0]['size'], ''.join(x['text'] for x in spans).strip()))
+        if lines == []:
+            return None
+
+        # 第一行相对左边距缩进超过一个字，说明是新的段落
+        margin = min(x[0] for x in lines)
+        return {
+            'first_line': lines[0][2],
+            'last_line': lines[-1][2],
+            'indented': lines[0][0] - margin > lines[0][1] * 0.9,
+        }
+
+
+    @staticmethod
+    def _table_columns(content):
+        first_line = content.strip().split('\n')[0]
+        return len(first_line.strip().strip('|').split('|'))
+
+
+    def stitch_boundary(self, former, current, former_edge=None, current_edge=None):
+        """
+        本地判断 current（下一页第一个有效 block）是否是 former（上一页最后一个有效 block）的延续
+        :param former_edge: 上一页文字层的边缘信息，见 _text_layer_edge
+        :param current_edge: 下一页文字层的边缘信息
+        :return: True / False，无法判断时返回 None
+        """
+        if current['type'] not in ['正文', '表格', '代码块'] or former['type'] != current['type']:
+            return False
+
+        if current['type'] == '表格':
+            if self._table_columns(former['content']) != self._table_columns(current['content']):
+                return False
+            lines = current['content'].strip().split('\n')
+            # 没有表头，或者重复了上一页的表头
+            if len(lines) < 2 or not self.table_sep_reg.match(lines[1]):
+                return True
+            if lines[0].strip() == former['content'].strip().split('\n')[0].strip():
+                return True
+            return None
+
+        if current['type'] == '代码块':
+            # 被截断的代码块，下一页开头通常没有语言标记
+            first_line = current['content'].strip().split('\n')[0].strip()
+            if first_line == '```' and former['content'].strip().split('\n')[0].strip() != '```':
+                return True
+            return None
+
+        # 正文，优先使用文字层的原文判断
+        tail = (former_edge['last_line'] if former_edge else former['content']).rstrip()
+        head = (current_edge['first_line'] if current_edge else current['content']).lstrip()
+        if tail == '' or head == '':
+            return False
+        if current_edge is not None and current_edge['indented']:
+            return False
+        if (tail.endswith('-') and len(tail) > 1 and tail[-2].isalpha()) or tail[-1] in ',，、(（':
+            return True
+        if head[0].isascii() and head[0].islower():
+            return True
+        if self.sentence_end_reg.search(tail):
+            return False
+        # 没有句末标点，有文字层时可以确定，只有模型识别的结果时交给 LLM 判断
+        if former_edge is not None and current_edge is not None:
+            return True
+        return None
+
+
+    def submit_stitch(self, former, current):
+        """
+        提交 LLM 判断请求，只发送上一页末尾和下一页开头的一小段内容
+        """
+        prompt = stitch_pdf_page_prompt.replace('{former_type}', former['type'])
+        prompt = prompt.replace('{former_content}', former['content'][-300:])
+        prompt = prompt.replace('{current_type}', current['type'])
+        prompt = prompt.replace('{current_content}', current['content'][:300])
+        return self.engine.submit('LLM', [{"role": "user", "content": prompt}])
+
+
+    def stitch_page(self, former_result, former_page, result, page_number):
+        """
+        speculative 模式下页面没有上下文，重新判断本页第一个有效 block 是否为上一页的延续
+        :param former_page: 上一页的页码（从 1 开始），没有上一页时为 None
+        :return: 需要 LLM 判断时返回 (block, future)，否则返回 None
+        """
+        # 不带上下文时模型给出的 continued 没有意义，统一重新判断
+        for blk in result['blocks']:
+            blk['continued'] = False
+
+        if former_result is None:
+            return None
+        former = [x for x in former_result['blocks'] if x['type'] not in ['页眉', '页脚', '脚注']]
+        current = [x for x in result['blocks'] if x['type'] not in ['页眉', '页脚', '脚注']]
+        if former == [] or current == []:
+            return None
+        former, current = former[-1], current[0]
+
+        former_edge = current_edge = None
+        # 只有相邻页面才能使用文字层
+        if former_page == page_number - 1:
+            former_edge = self._text_layer_edge(former_page - 1)
+            current_edge = self._text_layer_edge(page_number - 1)
+            if former_edge is None or current_edge is None:
+                former_edge = current_edge = None
+
+        continued = self.stitch_boundary(former, current, former_edge, current_edge)
+        if continued is not None:
+            current['continued'] = continued
+            return None
+        if not self.stitch_llm:
+            return None
+        return current, self.submit_stitch(former, current)
+
+
     def assemble_doc_md(self):
         # 对 doc_content 进行处理，返回完整的 md 内容
+        # 内容先按块保存，延续块合并和脚注替换都在块上进行，最后一次生成 md
         # 标题先统一处理成一级标题，并添加唯一标识，后面再处理
         full_msg = {}
-        full_text = ''
+        blocks = []
         notes = []
+        self.headings = {}
         former_block = {
             'type': 'not_found',
             'content': ''
@@ -478,6 +1255,8 @@ class PDFParser(BasicParser):
             full_msg[page_number+1] = self.doc_content[page_number]['blocks']
 
             notes_for_one_page = []
+            # 本页新增或延续的块，用于替换脚注
+            page_blocks = []
             for b in self.doc_content[page_number]['blocks']:
                 
                 # 标题、正文、列表、脚注、图表、表格、公式块、代码块、页眉、页脚、其他
@@ -488,38 +1267,46 @@ class PDFParser(BasicParser):
                 elif b['type'] == '标题': # 统一先变成一级标题，后面再处理
                     # 生成一个唯一的 id
                     heading_id = str(uuid.uuid4())[:8]
-                    content = '# ' + b['content'] + f'@=@{heading_id}' + '\n'
-                    full_text += content + '\n'
+                    self.headings[heading_id] = b['content']
+                    blocks.append(DocBlock('标题', '# ' + b['content'] + f'@=@{heading_id}'))
+                    page_blocks.append(blocks[-1])
                 elif b['continued'] == True:
-                    # 处理代码
-                    if b['type'] == '代码块' and former_block['type'] == '代码块' and full_text.endswith('```\n'):
+                    last = blocks[-1] if blocks != [] else None
+                    # 处理代码，去掉前一块结尾和这一块开头的 ```
+                    if b['type'] == '代码块' and former_block['type'] == '代码块' and last.endswith('```'):
                         content_list = b['content'].split('\n')[1:]
                         content = '\n'.join(content_list)
-                        full_text = full_text[:-4] + '\n' + content + '\n'
-                    elif b['type'] == '表格' and former_block['type'] == '表格' and full_text.endswith('|\n'):
-                        full_text += b['content'] + '\n'
+                        last.parts = [last.text()[:-3] + '\n' + content]
+                    elif b['type'] == '表格' and former_block['type'] == '表格' and last.endswith('|'):
+                        last.append('\n' + b['content'])
                     elif b['type'] == '正文' and former_block['type'] == '正文':
-                        full_text = full_text[:-1] + b['content'] + '\n'
+                        last.append(b['content'])
                     # 不满足有效条件的，类型不对，或者 former_block 类型不对
                     else:
-                        full_text += b['content'] + '\n'
-                        self.logger.warning(f'页面 {page_number+1} 中 block {b["id"]} 类型为 {b["type"]} 是延续块，但前一个有效内容 {former_block} 不匹配，full_text 末尾为：{full_text[-20:]}')
+                        blocks.append(DocBlock(b['type'], b['content']))
+                        tail = blocks[-2].to_md()[-20:] if len(blocks) > 1 else ''
+                        self.logger.warning(f'页面 {page_number+1} 中 block {b["id"]} 类型为 {b["type"]} 是延续块，但前一个有效内容 {former_block} 不匹配，前一个块末尾为：{tail}')
+                    if blocks[-1] not in page_blocks:
+                        page_blocks.append(blocks[-1])
 
                 else:
-                    full_text += b['content'] + '\n'
+                    blocks.append(DocBlock(b['type'], b['content']))
+                    page_blocks.append(blocks[-1])
                 
                 # 设置为前一个 block
                 if b['type'] not in ['页眉', '页脚', '脚注']:
                     former_block = b
 
-            # 处理脚注
+            # 处理脚注，只在本页的内容中查找
             for nt in notes_for_one_page:
                 note_id = nt.split(': ')[0]
                 note_content = ': '.join(nt.split(': ')[1:])
-                if note_id in full_text:
-                    full_text = full_text.replace(note_id, f'(注：{note_content})')
-                else:
-                    self.logger.warning(f'页面 {n+1} 中未找到 {note_id}，注释内容为：{note_content}')
+                found = False
+                for blk in page_blocks:
+                    if blk.replace(note_id, f'(注：{note_content})'):
+                        found = True
+                if not found:
+                    self.logger.warning(f'页面 {page_number+1} 中未找到 {note_id}，注释内容为：{note_content}')
             notes += notes_for_one_page
 
         
@@ -532,11 +1319,20 @@ class PDFParser(BasicParser):
             for nt in notes:
                 f.write(nt + '\n')
         
-        # full_text 导出到 output_dir
+        # full_text 导出到 output_dir，标题处理完后会重新写入
         with open(os.path.join(self.output_dir, 'full_text.md'), 'w', encoding='utf-8') as f:
-            f.write(full_text)
+            for blk in blocks:
+                f.write(blk.to_md())
+
+        self.blocks = blocks
+
 
-        self.md_content = full_text
+    def read_lines(self):
+        # 逐行读取 full_text.md，若开头不是一级标题，添加一级标题为文件名
+        if not self.starts_with_h1:
+            yield f'# {self.file_basename}'
+        with open(self.output_md_path, 'r', encoding='utf-8') as f:
+            yield from f
 
 
     def split_doc_md(self):
@@ -545,119 +1341,288 @@ class PDFParser(BasicParser):
         headings = self._get_md_headings()
         corrected_headings = self._correct_heading_level(headings)
         self._replace_heading(corrected_headings)
-        with open(os.path.join(self.output_dir, 'full_text.md'), 'w', encoding='utf-8') as f:
-            f.write(self.md_content)
-        
-
-        # 若 md 开头不是一级标题，添加一级标题为文件名
-        if not self.md_content.lstrip().startswith('# '):
-            self.md_content = f'# {self.file_basename}\n{self.md_content}'
+        self.blocks = None
 
         # 如果 md 中含有多个一级标题，那么 self.title_prefix 保留文件名
-        if self.md_content.count('\n# ') > 1:
+        if self.h1_count > 1:
             if self.file_basename not in self.title_prefix:
                 self.title_prefix += '-' + self.file_basename
 
-        result = {}
-        headers = []
-        current_header_path = ''
-        current_content = []
+        self.sections = self.iter_sections(self.read_lines())
+
+
+    def parse_text_layer_page(self, pg, former_content, skipped_pages):
+        page_dict = pg.get_text('dict', flags=fitz.TEXTFLAGS_TEXT)
+        if pg.number in self.layout_pages:
+            doc_len = len(self.doc_content)
+            try:
+                former_content = self.parse_layout_page(pg, page_dict, pg.number+1, former_content)
+                self.logger.info(f'{pg.number+1} 已通过版面检测分析')
+            except Exception as e:
+                # 版面检测或区域识别出错时，整页交给图像识别模型，不丢失图表、表格的内容
+                del self.doc_content[doc_len:]
+                self.logger.error(f'页面 {pg.number+1} 版面检测失败，使用图像识别模型识别整页，错误信息：{e}')
+                page_img = self.image_prep.prepare(self.page_image(pg.number+1), baseline=True)
+                content = self.parse_single_page(page_img, pg.number+1, former_content)
+                if content is None:
+                    # 不写入检查点，下次运行时重新解析
+                    skipped_pages.append(pg.number+1)
+                    return former_content
+                former_content = content
+        else:
+            former_content = self.parse_text_page(pg, page_dict, pg.number+1, former_content)
+            self.logger.info(f'{pg.number+1} 已通过文字层分析')
+        self.save_checkpoint(pg.number+1, self.doc_content[-1], former_content)
+        return former_content
+
+
+    def iter_page_batches(self, vlm_pages, renderer):
+        """
+        按页码顺序取出渲染好的页面，组成一次请求的批次
+        批次内的页面必须连续（中间没有文字层页面），最多 batch_pages 页，图片总大小不超过 batch_kb
+        :return: 生成器，返回 (批次, 错误)，批次为 [(页面序号（从 0 开始）, PreparedImage)]；渲染失败的页面单独返回，PreparedImage 为 None
+        """
+        batch = []
+        batch_bytes = 0
+        for page_index in vlm_pages:
+            try:
+                page_img = renderer.get(page_index)
+            except Exception as e:
+                if batch != []:
+                    yield batch, None
+                    batch, batch_bytes = [], 0
+                yield [(page_index, None)], e
+                continue
 
-        # 按行遍历 Markdown 内容
-        is_in_code = False
-        for line in self.md_content.splitlines():
+            if batch != [] and (
+                page_index != batch[-1][0] + 1
+                or len(batch) >= self.batch_pages
+                or batch_bytes + page_img.sent_bytes > self.batch_kb * 1024
+            ):
+                yield batch, None
+                batch, batch_bytes = [], 0
+            batch.append((page_index, page_img))
+            batch_bytes += page_img.sent_bytes
+
+        if batch != []:
+            yield batch, None
+
+
+    def parse_single_page(self, page_img, page_number, former_content='', future=None):
+        """
+        识别单页，失败时重试 3 次
+        :param future: speculative 模式下提前发出的请求，第一次使用它的结果，失败后重新请求
+        :return: 本页最后一段有效内容，重试后仍失败时返回 None
+        """
+        retried = 0
+        while True:
+            try:
+                result_str = future.result() if future is not None and retried == 0 else None
+                return self.parse_doc_page(page_img, page_number, former_content, result_str)
+            except Exception as e:
+                retried += 1
+                if retried > 3:
+                    self.logger.error(f'{page_number} 已重试 3 次，跳过该页面')
+                    return None
+
+                self.logger.warning(f'页面 {page_number} 分析失败（{e}），正在第 {retried} 次重试...')
+
+
+    def parse_batch(self, batch, former_content='', future=None):
+        """
+        识别一个批次，多页的结果不符合要求时逐页重新识别
+        :return: [(页面序号（从 0 开始）, 本页最后一段有效内容, 本页的识别结果, 是否逐页识别)]，失败的页面内容和结果为 None
+        """
+        if len(batch) == 1:
+            page_index, page_img = batch[0]
+            content = self.parse_single_page(page_img, page_index+1, former_content, future)
+            return [(page_index, content, self.doc_content[-1] if content is not None else None, True)]
 
-            # 处理代码
-            if line.startswith('```'):
-                is_in_code = not is_in_code
+        try:
+            result_str = future.result() if future is not None else None
+            contents = self.parse_doc_batch(batch, former_content, result_str)
+            results = self.doc_content[-len(batch):]
+            return [(page_index, content, result, False) for (page_index, _), content, result in zip(batch, contents, results)]
+        except Exception as e:
+            self.logger.warning(f'页面 {batch[0][0]+1}-{batch[-1][0]+1} 一次识别失败（{e}），改为逐页识别')
+
+        # speculative 模式下逐页识别不带上下文，与提前请求的页面一致
+        results = []
+        for page_index, page_img in batch:
+            content = self.parse_single_page(page_img, page_index+1, former_content)
+            if content is None:
+                results.append((page_index, None, None, True))
                 continue
-            if is_in_code:
-                current_content.append(line)
+            if future is None:
+                former_content = content
+            results.append((page_index, content, self.doc_content[-1], True))
+        return results
+
+
+    def parse_pages_sequential(self, done_pages, former_content, text_layer_pages, vlm_pages, renderer, skipped_pages):
+        """
+        逐页（或逐批）解析，每次请求带上前一页最后一段内容，由模型判断是否为延续
+        """
+        batches = self.iter_page_batches(vlm_pages, renderer)
+        batch_end = done_pages
+        for pg in self.pdf_doc:
+            if pg.number < batch_end:
                 continue
 
-            # 处理标题
-            if line.startswith('#') and not is_in_code:
-
-                # 处理当前标题内容
-                if current_header_path and current_content and ''.join(current_content) != '':
-                    position = "-".join(headers)
-                    result[current_header_path] = self.add_section_tag('\n'.join(current_content).strip(), position)
-                    current_content = []
-
-                # 解析新标题级别和文本
-                level = line.count('#')
-                header_text = line.strip('#').strip()
-
-                # 标题级别错误处理
-                if level > len(headers) + 1:
-                    self.logger.warning(f'标题级别跳跃: 当前标题级别 {level}, 上一级标题级别 {len(headers)}。标题: {header_text}')
-                    # 尝试修正标题级别，设置为上一级标题级别加 1
-                    level = len(headers) + 1
-
-                # 调整标题层级
-                if level > len(headers):
-                    headers.append(header_text)
-                elif level == len(headers):
-                    headers[-1] = header_text
-                else:
-                    headers = headers[:level - 1]
-                    headers.append(header_text)
+            if pg.number in text_layer_pages:
+                former_content = self.parse_text_layer_page(pg, former_content, skipped_pages)
+                continue
 
-                # current_header_path = '-'.join([self.title_prefix] + headers)
-                if self.title_prefix == '':
-                    current_header_path = '-'.join(headers)
+            batch, error = next(batches)
+            batch_end = batch[-1][0] + 1
+            if error is not None:
+                self.logger.error(f'页面 {pg.number+1} 渲染失败，跳过该页面，错误信息：{error}')
+                skipped_pages.append(pg.number+1)
+                continue
+
+            for page_index, content, result, _ in self.parse_batch(batch, former_content):
+                if result is None:
+                    skipped_pages.append(page_index+1)
+                    continue
+                former_content = content
+                self.save_checkpoint(page_index+1, result, former_content)
+                self.logger.info(f'{page_index+1} 已分析')
+
+
+    def parse_pages_speculative(self, done_pages, former_content, text_layer_pages, vlm_pages, renderer, skipped_pages):
+        """
+        页面不带上下文同时请求，最多 speculative_window 页同时进行；结果按页码顺序处理
+        每个批次处理完后在本地判断第一页与上一页的延续关系，无法判断的交给 LLM，最后统一取回结果
+        批次内之后的页面由模型根据前一页判断延续
+        """
+        batches = self.iter_page_batches(vlm_pages, renderer)
+        in_flight = {}
+        in_flight_pages = 0
+
+        def fill():
+            nonlocal in_flight_pages
+            while in_flight_pages < self.speculative_window:
+                batch, error = next(batches, (None, None))
+                if batch is None:
+                    return
+                if error is not None:
+                    in_flight[batch[0][0]] = (batch, error)
+                    continue
+                if len(batch) == 1:
+                    messages = self.page_messages(batch[0][1])
                 else:
-                    current_header_path = '-'.join([self.title_prefix] + headers)
-            else:
-                current_content.append(line)
+                    messages = self.batch_messages([page_img for _, page_img in batch])
+                in_flight[batch[0][0]] = (batch, self.engine.submit('IMG_RECONGNIZE_MODEL', messages))
+                in_flight_pages += len(batch)
+
+        former_page = done_pages if done_pages > 0 else None
+        pending_stitches = []
+        batch_end = done_pages
+        for pg in self.pdf_doc:
+            if pg.number < batch_end:
+                continue
+            fill()
 
-        # 处理最后一个标题内容
-        if current_header_path and current_content:
-            position = "-".join(headers)
-            result[current_header_path] = self.add_section_tag('\n'.join(current_content).strip(), position)
-        elif current_content:
-            position = self.file_basename
-            result[self.file_basename] = self.add_section_tag('\n'.join(current_content).strip(), position)
+            if pg.number in text_layer_pages:
+                former_content = self.parse_text_layer_page(pg, former_content, skipped_pages)
+                former_page = pg.number+1
+                continue
 
-        self.content_dict = result
+            batch, future = in_flight.pop(pg.number)
+            batch_end = batch[-1][0] + 1
+            if batch[0][1] is None:
+                self.logger.error(f'页面 {pg.number+1} 渲染失败，跳过该页面，错误信息：{future}')
+                skipped_pages.append(pg.number+1)
+                continue
+            in_flight_pages -= len(batch)
+
+            former_result = self.doc_content[-1] if self.doc_content != [] else None
+            for i, (page_index, content, result, single) in enumerate(self.parse_batch(batch, '', future)):
+                if result is None:
+                    skipped_pages.append(page_index+1)
+                    continue
+
+                former_content = content or former_content
+                # 批次的第一页和逐页识别的页面没有上下文，需要重新判断延续
+                if i == 0 or single:
+                    stitch = self.stitch_page(former_result, former_page, result, page_index+1)
+                    if stitch is not None:
+                        pending_stitches.append((page_index+1, result, former_content, stitch))
+
+                former_page = page_index+1
+                former_result = result
+                self.save_checkpoint(page_index+1, result, former_content)
+                self.logger.info(f'{page_index+1} 已分析')
+
+        # 取回 LLM 的判断结果，更新后重新写入检查点
+        for page_number, result, page_former_content, (block, future) in pending_stitches:
+            try:
+                block['continued'] = future.result().strip().lower().startswith('true')
+            except Exception as e:
+                self.logger.warning(f'页面 {page_number} 的延续判断失败，按不延续处理：{e}')
+                continue
+            self.save_checkpoint(page_number, result, page_former_content)
+        if pending_stitches != []:
+            self.logger.info(f'{len(pending_stitches)} 处跨页延续由 LLM 判断')
 
 
     def parse(self):
         # 实现具体的解析逻辑
         pdf_type, is_img = self.judge_pdf_type()
         if pdf_type == 'doc' or 'ppt':
-            former_content = ''
+            self.doc_content = []
+            done_pages, former_content = self.load_checkpoint()
+            skipped_pages = []
+            use_text_layer = not is_img and self.text_layer_mode != 'off'
+
+            # 先确定每一页的处理方式，文字层可用的页面不需要调用图像识别模型
+            # 文字可用但包含图表、表格的页面，开启版面检测时只识别图表、表格区域
+            text_layer_pages = set()
             for pg in self.pdf_doc:
-                try:
-                    img_pil = pg.get_pixmap(matrix=fitz.Matrix(2, 2)).pil_image()
-                except Exception as e:
-                    pixmap = pg.get_pixmap()
-                    img_pil = Image.frombytes("RGB", [pixmap.width, pixmap.height], pixmap.samples)
-                retried = 0
-                # former_content = self.parse_doc_page(img_pil, pg.number+1, former_content)
-                while True:
-                    try:
-                        former_content = self.parse_doc_page(img_pil, pg.number+1, former_content)
-                        self.logger.debug(f'{pg.number+1} 已分析')
-                        break
-                    except Exception as e:
-                        retried += 1
-                        if retried > 3:
-                            self.logger.error(f'{pg.number+1} 已重试 3 次，跳过该页面')
-                            break
-
-                        self.logger.warning(f'页面 {pg.number+1} 分析失败，正在第 {retried} 次重试...')
-
-                self.logger.info(f'{pg.number+1} 已分析')
-            
+                if pg.number < done_pages or not use_text_layer:
+                    continue
+                page_dict = pg.get_text('dict', flags=fitz.TEXTFLAGS_TEXT)
+                reason = self.check_text_layer(pg, page_dict)
+                if reason is None:
+                    text_layer_pages.add(pg.number)
+                elif self.layout_detector is not None and self.check_text_readable(page_dict) is None:
+                    text_layer_pages.add(pg.number)
+                    self.layout_pages.add(pg.number)
+                    self.logger.debug(f'页面 {pg.number+1} {reason}，使用版面检测')
+                else:
+                    self.logger.debug(f'页面 {pg.number+1} {reason}，使用图像识别')
+
+            # 需要图像识别的页面在后台提前渲染
+            vlm_pages = [n for n in range(done_pages, len(self.pdf_doc)) if n not in text_layer_pages]
+            renderer = PageRenderer(self.file_path, vlm_pages, self.image_prep, self.render_workers, self.render_queue_size)
+            try:
+                if self.parse_mode == 'speculative':
+                    self.parse_pages_speculative(done_pages, former_content, text_layer_pages, vlm_pages, renderer, skipped_pages)
+                else:
+                    self.parse_pages_sequential(done_pages, former_content, text_layer_pages, vlm_pages, renderer, skipped_pages)
+            finally:
+                renderer.close()
+
+            if use_text_layer:
+                if self.layout_detector is not None:
+                    self.logger.info(f'共 {len(self.pdf_doc)} 页，{len(text_layer_pages)} 页通过文字层分析，其中 {len(self.layout_pages)} 页使用版面检测')
+                else:
+                    self.logger.info(f'共 {len(self.pdf_doc)} 页，{len(text_layer_pages)} 页通过文字层分析')
+
             self.assemble_doc_md()
             self.split_doc_md()
 
-            for k, v in self.content_dict.items():
+            for k, v in self.sections:
                 self.qa_info.append({
                     'simple_title': k.split(': ')[-1],
                     'full_title': k,
                     'content': v,
                 })
+
+            # 所有页面都解析成功后，检查点不再需要；有跳过的页面时保留，下次从第一个缺失的页面继续
+            if skipped_pages != []:
+                self.logger.warning(f'页面 {skipped_pages} 解析失败，保留检查点 {self.checkpoint_path}')
+            elif os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
             
             return self.qa_info
@@ -1,13 +1,20 @@
-import base64
 import os, sys, re
 import tempfile
 import json
+from collections import deque
 from PIL import Image
 import requests
 import fitz
-from openai import OpenAI
+
+# python-pptx 只有 hybrid 模式需要，未安装时使用 vlm 模式
+try:
+    from pptx import Presentation
+    from pptx.enum.shapes import MSO_SHAPE_TYPE, PP_PLACEHOLDER
+except ImportError:
+    Presentation = None
 
 from .basic_parser import BasicParser
+from tools.office_converter import get_converter
 
 if sys.platform.startswith('win'):
     import comtypes.client
@@ -65,23 +72,33 @@ ppt_parse_prompt = '''
 4. 图表标题、表格标题尽量以 PPt 中的内容为准，也可以根据内容自行总结。
 '''
 
+# SmartArt 在 graphicFrame 中的类型
+DIAGRAM_URI = 'http://schemas.openxmlformats.org/drawingml/2006/diagram'
+
 class PPTXParserViaPDF(BasicParser):
 
     suffix = 'pptx'
 
+    section_layout_reg = re.compile(r'section|节标题|章节', re.I)
+    toc_title_reg = re.compile(r'^(目\s*录|contents|table of contents|agenda|议程)$', re.I)
+
     def __init__(self, file_path, root_path, cfg={}, title_prefix='%parent', logger=None, output_dir=''):
         # 检查文件类型
         if not file_path.lower().endswith('.pptx'):
             raise ValueError("file type error, not a pptx file")
 
-        # 获取图像识别模型的相关算法配置
-        self.img_parse_url = cfg['IMG_RECONGNIZE_MODEL']['url']
-        self.img_parse_key = cfg['IMG_RECONGNIZE_MODEL']['api_key']
-        self.img_parse_model = cfg['IMG_RECONGNIZE_MODEL']['model_name']
-        self.openai_client = OpenAI(api_key=self.img_parse_key, base_url=self.img_parse_url)
-
         super().__init__(file_path, root_path, cfg, title_prefix, logger, output_dir)
 
+        # hybrid：文字直接从 pptx 中提取，只有包含图表、图片、SmartArt 的页面使用图像识别；vlm：所有页面都使用图像识别
+        self.mode = self.cfg.get('PPTX', {}).get('mode', 'hybrid').lower()
+        if self.mode != 'vlm' and Presentation is None:
+            self.logger.warning('未安装 python-pptx，PPTX 使用 vlm 模式解析')
+            self.mode = 'vlm'
+        # 同时进行图像识别的页数（vlm 和 hybrid 模式），0 表示使用图像识别模型的 MAX_IN_FLIGHT
+        self.vlm_window = int(self.cfg.get('PPTX', {}).get('vlm_window') or 0)
+        if self.vlm_window <= 0:
+            self.vlm_window = int(self.cfg.get('IMG_RECONGNIZE_MODEL', {}).get('max_in_flight', 16))
+
 
     def copy_ppt_with_format(self, src_presentation, output_ppt_path):
 
@@ -126,10 +143,16 @@ class PPTXParserViaPDF(BasicParser):
             # powerpoint.Quit()
     
 
-    def ppt_to_pdf(self, pdf_file_path, tmp_dir):
+    def ppt_to_pdf(self):
+        """
+        把 pptx 转换为 pdf，返回 pdf 文件的 bytes
+        """
 
         if sys.platform.startswith('win'):
 
+            # PowerPoint 只能保存到文件
+            pdf_file_path = os.path.join(self.temp_dir, self.file_basename + '.pdf')
+
             powerpoint = comtypes.client.CreateObject("Powerpoint.Application")
             powerpoint.Visible = 1
             
@@ -146,38 +169,35 @@ class PPTXParserViaPDF(BasicParser):
             ppt.Close()
             powerpoint.Quit()
 
-        ## 如果是 linux，使用 libreoffice 库
-        elif sys.platform.startswith('linux') or sys.platform.startswith('linux'):
-            import subprocess
-            try:
-                subprocess.run(['libreoffice', '--headless', '--convert-to', 'pdf', self.file_path, '--outdir', tmp_dir])
-            except FileNotFoundError:
-                raise FileNotFoundError("LibreOffice 未安装，请先安装 LibreOffice")
-        ## 如果是 mac系统，使用 libreoffice 库
-        elif sys.platform.startswith('darwin'):
-            libreoffice_path = self.cfg['RUNTIME']['libreoffice_path']
-            import subprocess
-            try:
-                subprocess.run([libreoffice_path, '--headless', '--convert-to', 'pdf', self.file_path, '--outdir', tmp_dir])
-            except FileNotFoundError:
-                raise FileNotFoundError("LibreOffice 未安装，请先安装 LibreOffice")
+            with open(pdf_file_path, 'rb') as f:
+                pdf_data = f.read()
+            os.remove(pdf_file_path)
+
+        ## 如果是 linux、mac 系统，使用常驻的 libreoffice 转换
+        else:
+            pdf_data = get_converter(self.cfg, self.logger).to_pdf(self.file_path)
         
-        self.logger.info(f'pdf file generated: {pdf_file_path}')
+        self.logger.info(f'pdf generated: {len(pdf_data)} bytes')
+        return pdf_data
 
 
-    def pdf_to_images(self, pdf_file_path, tmp_dir):
-        # 打开 PDF 文件
-        pdf_file = fitz.open(pdf_file_path)
-        # 逐页解析 PDF 文件
+    def pdf_to_images(self, pdf_data, pages=None):
+        """
+        逐页渲染 pdf，在内存中压缩编码，依次返回 (页码, PreparedImage)
+        :param pages: 只渲染指定的页面（从 0 开始），默认全部
+        """
+        pdf_file = fitz.open(stream=pdf_data, filetype='pdf')
         for pg in range(pdf_file.page_count):
+            if pages is not None and pg not in pages:
+                continue
             page = pdf_file[pg]
             pix = page.get_pixmap()
             img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
             # pg 转 4 位 str
             pg_str = str(pg+1).zfill(4)
-            img.save(os.path.join(tmp_dir, f"{pg_str}.jpg"))  # 保存截图为 jpg 文件
+            yield pg_str, self.image_prep.prepare(img, baseline=True)
 
-        self.logger.info(f'pdf file converted to images, {pdf_file.page_count+1} pictures in total: {tmp_dir}')
+        self.logger.info(f'pdf converted to images, {pdf_file.page_count} pictures in total')
     
 
     def _parse_llm_response(self, text, position_in_file):
@@ -216,64 +236,246 @@ class PPTXParserViaPDF(BasicParser):
         return result
 
     
-    def get_summary(self, img_path, position_in_file):
-        # 调用 OpenAI 的 API 进行图像识别
-       
-        b64_img = base64.b64encode(open(img_path, 'rb').read()).decode()
-        response = self.openai_client.chat.completions.create(
-            model=self.img_parse_model,
-            messages=[
-                {"role": "system", "content": ppt_parse_prompt},
-                {"role": "user", "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"}
-                    },
-                ]}
-            ]
-        )
-        
+    def _iter_shapes(self, shapes):
+        # 展开组合中的形状
+        for shape in shapes:
+            if shape.shape_type == MSO_SHAPE_TYPE.GROUP:
+                yield from self._iter_shapes(shape.shapes)
+            else:
+                yield shape
+
+
+    def is_visual_slide(self, slide, slide_area):
+        """
+        页面是否包含需要图像识别的内容：图表、SmartArt、面积超过 5% 的图片
+        """
+        for shape in self._iter_shapes(slide.shapes):
+            if shape.has_chart:
+                return True
+            if shape.shape_type == MSO_SHAPE_TYPE.EMBEDDED_OLE_OBJECT:
+                return True
+            if DIAGRAM_URI in shape._element.xpath('.//a:graphicData/@uri'):
+                return True
+            if shape.shape_type == MSO_SHAPE_TYPE.PICTURE or shape._element.tag.endswith('}pic'):
+                if shape.width is None or shape.height is None or shape.width * shape.height > slide_area * 0.05:
+                    return True
+        return False
+
+
+    def classify_slide(self, slide, slide_index, title):
+        """
+        根据版式的占位符判断页面类型，与 ppt_parse_prompt 中的页面类型一致
+        """
+        placeholder_types = set()
+        for shape in slide.placeholders:
+            placeholder_types.add(shape.placeholder_format.type)
+
+        if self.section_layout_reg.search(slide.slide_layout.name or ''):
+            return '章节标题'
+        if PP_PLACEHOLDER.CENTER_TITLE in placeholder_types:
+            return '标题' if slide_index == 0 else '章节标题'
+        if title != '' and self.toc_title_reg.match(title):
+            return '目录'
+        return '内容'
+
+
+    def _text_frame_to_md(self, text_frame, as_list):
+        lines = []
+        for p in text_frame.paragraphs:
+            # 段落内的换行为 \x0b
+            text = p.text.replace('\x0b', ' ').strip()
+            if text == '':
+                continue
+            if as_list:
+                lines.append('  ' * p.level + '- ' + text)
+            else:
+                lines.append(text)
+        return '\n'.join(lines)
+
+
+    def _table_to_md(self, table):
+        rows = []
+        for row in table.rows:
+            rows.append([cell.text.strip().replace('|', '\\|').replace('\n', '<br/>') for cell in row.cells])
+        if rows == []:
+            return ''
+        lines = ['| ' + ' | '.join(rows[0]) + ' |', '| ' + ' | '.join(['---'] * len(rows[0])) + ' |']
+        for row in rows[1:]:
+            lines.append('| ' + ' | '.join(row) + ' |')
+        return '\n'.join(lines)
+
+
+    def slide_notes(self, slide):
+        if not slide.has_notes_slide:
+            return ''
+        notes = slide.notes_slide.notes_text_frame
+        if notes is None or notes.text.strip() == '':
+            return ''
+        return '备注：\n' + notes.text.strip()
+
+
+    def _append_to_section(self, content, text):
+        # 在 @endsection 之前追加内容
+        if text == '':
+            return content
+        body, sep, tail = content.rpartition('\n@endsection\n')
+        if sep == '':
+            return content + '\n\n' + text
+        return body + '\n\n' + text + sep + tail
+
+
+    def extract_slide(self, slide, position_in_file, title):
+        """
+        直接从 pptx 中提取页面内容，返回格式与 _parse_llm_response 一致（不含 page_type）
+        """
+        parts = []
+        shapes = [x for x in self._iter_shapes(slide.shapes) if x.top is not None and x.left is not None]
+        shapes.sort(key=lambda x: (x.top, x.left))
+        for shape in shapes:
+            if shape.is_placeholder and shape.placeholder_format.type in (PP_PLACEHOLDER.TITLE, PP_PLACEHOLDER.CENTER_TITLE):
+                continue
+            if shape.has_table:
+                parts.append(self._table_to_md(shape.table))
+            elif shape.has_text_frame:
+                # 正文占位符中的多个段落按列表处理
+                as_list = shape.is_placeholder and shape.placeholder_format.type in (PP_PLACEHOLDER.BODY, PP_PLACEHOLDER.OBJECT) \
+                    and len([p for p in shape.text_frame.paragraphs if p.text.strip() != '']) > 1
+                parts.append(self._text_frame_to_md(shape.text_frame, as_list))
+        parts = [x for x in parts if x != '']
+
+        first_line = parts[0].split('\n')[0].lstrip('- ') if parts != [] else ''
+        result = {
+            'title': title,
+            'summary': first_line,
+            'simple_title': title if title != '' else first_line[:30],
+        }
+
+        position = f'{self.knowledge_path}: {position_in_file}'
+        if parts == []:
+            parts = [result['simple_title']]
+        result['content'] = f'\n@section: {position}\n\n' + '\n\n'.join(parts) + '\n@endsection\n'
+        return result
+
+
+    def iter_hybrid_results(self):
+        """
+        hybrid 模式：依次返回每一页的 (页码, 解析结果)
+        只有包含图表、图片、SmartArt 的页面才转换为 pdf 并使用图像识别，页面类型统一根据版式判断
+        """
+        prs = Presentation(self.file_path)
+        slide_area = prs.slide_width * prs.slide_height
+        # 隐藏的页面不会导出到 pdf
+        slides = [x for x in prs.slides if x._element.get('show') != '0']
+
+        visual_pages = [i for i, slide in enumerate(slides) if self.is_visual_slide(slide, slide_area)]
+        self.logger.info(f'{len(slides)} slides, {len(visual_pages)} need image recognition')
+
+        # 需要图像识别的页面按顺序渲染、提交，最多 vlm_window 页在请求中，取回一页后再提交后面的页面
+        images = iter(())
+        if visual_pages != []:
+            pdf_data = self.ppt_to_pdf()
+            images = self.pdf_to_images(pdf_data, set(visual_pages))
+        pending = deque()
+
+        def fill():
+            while len(pending) < self.vlm_window:
+                item = next(images, None)
+                if item is None:
+                    return
+                pg_str, page_img = item
+                pending.append((pg_str, self.submit_summary(page_img, f'page {pg_str}')))
+
+        for i, slide in enumerate(slides):
+            pg_str = str(i+1).zfill(4)
+            position_in_file = f'page {pg_str}'
+            title_shape = slide.shapes.title
+            title = title_shape.text.replace('\x0b', ' ').strip() if title_shape is not None else ''
+
+            fill()
+            if pending and pending[0][0] == pg_str:
+                _, future = pending.popleft()
+                result = self.get_summary(None, position_in_file, future)
+                if result is None:
+                    yield pg_str, None
+                    continue
+                if title != '':
+                    result['title'] = title
+                    result['simple_title'] = title
+            else:
+                result = self.extract_slide(slide, position_in_file, title)
+
+            result.setdefault('title', result['simple_title'])
+            result['page_type'] = self.classify_slide(slide, i, result['title'])
+            result['content'] = self._append_to_section(result['content'], self.slide_notes(slide))
+            yield pg_str, result
+
+
+    def iter_vlm_results(self):
+        """
+        vlm 模式：所有页面都使用图像识别，依次返回每一页的 (页码, 解析结果)
+        """
+        # 把 pptx 文件转换成 pdf，pdf 和页面图片都只保存在内存中
+        pdf_data = self.ppt_to_pdf()
+
+        # 每渲染完一页就提交请求，渲染和请求同时进行，再按页面顺序取回结果
+        # 最多 vlm_window 页在请求中，取回最早的一页后再渲染、提交后面的页面，内存占用不随页数增长
+        pending = deque()
+        for pg_str, page_img in self.pdf_to_images(pdf_data):
+            if len(pending) >= self.vlm_window:
+                done_pg_str, done_img, future = pending.popleft()
+                yield done_pg_str, self.get_summary(done_img, f'page {done_pg_str}', future)
+            pending.append((pg_str, page_img, self.submit_summary(page_img, f'page {pg_str}')))
+        while pending:
+            pg_str, page_img, future = pending.popleft()
+            yield pg_str, self.get_summary(page_img, f'page {pg_str}', future)
+
+
+    def submit_summary(self, page_img, page_name=''):
+        # 提交图像识别请求，返回 future，page_img 为 PreparedImage
+        self.image_prep.log(page_img, f'{self.knowledge_path} {page_name}')
+        return self.engine.submit('IMG_RECONGNIZE_MODEL', [
+            {"role": "system", "content": ppt_parse_prompt},
+            {"role": "user", "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {"url": page_img.data_url}
+                },
+            ]}
+        ])
+
+
+    def get_summary(self, page_img, position_in_file, future=None):
+        # 调用 OpenAI 的 API 进行图像识别，future 为已提交的请求
+        if future is None:
+            future = self.submit_summary(page_img, position_in_file)
+
+        result = None
         try:
-            result = response.choices[0].message.content
+            result = future.result()
             result_dict = self._parse_llm_response(result, position_in_file)
             return result_dict
         except Exception as e:
-            self.logger.error(f'image path: {img_path} parse error')
+            self.logger.error(f'{position_in_file} parse error')
             self.logger.error(f'error: {e}')
             self.logger.error(f'response: {result}')
     
         
     def parse(self):
 
-        # 生成临时文件夹
-        tmp_dir = self.temp_dir
-        
-        file_basename = os.path.basename(self.file_path)
-        file_rootname = os.path.splitext(file_basename)[0]
-        # 把 pptx 文件转换成 pdf 文件
-        pdf_file_path = os.path.join(tmp_dir, file_rootname + '.pdf')
-        self.ppt_to_pdf(pdf_file_path, tmp_dir)
-        
-        # 把 pdf 文件转换成图片文件
-        self.pdf_to_images(pdf_file_path, tmp_dir)
-
-        # 解析 tmp_dir 下 png 结尾的文件
-        img_files = [x  for x in os.listdir(tmp_dir) if x.endswith('.jpg')]
-        # 按照文件名排序
-        img_files.sort()
-
         # 设置标题前缀
         file_title = ''
         chapter_title = ''
         content_title = ''
 
-        for img_file in img_files:
+        if self.mode == 'vlm':
+            results = self.iter_vlm_results()
+        else:
+            results = self.iter_hybrid_results()
 
-            img_path = os.path.join(tmp_dir, img_file)
-            result = self.get_summary(img_path, f'page {img_file.split(".")[0]}')
+        for pg_str, result in results:
 
             if result is None:
-                self.logger.warning(f'page {img_file.split(".")[0]}: parse error, skip')
+                self.logger.warning(f'page {pg_str}: parse error, skip')
                 continue
 
             if result['page_type'] == '标题':
@@ -296,10 +498,10 @@ class PPTXParserViaPDF(BasicParser):
                     result['full_title'] = '-'.join(title_list)
                     self.qa_info.append(result)
             else:
-                self.logger.warning(f'page {img_file.split(".")[0]}: {result["page_type"]} not included in qa result')
+                self.logger.warning(f'page {pg_str}: {result["page_type"]} not included in qa result')
 
 
-            self.logger.info(f'page {img_file.split(".")[0]}: {result}')
+            self.logger.info(f'page {pg_str}: {result}')
 
 
         return self.qa_info
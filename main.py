@@ -3,6 +3,9 @@ from configparser import ConfigParser
 from tools import parser_manage, qa_manage, info_maintenance
 import logging
 import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 config = ConfigParser(interpolation=None)
 config.read('config.ini')
@@ -46,6 +49,24 @@ if sys.platform.startswith('darwin'):
         config_dict['RUNTIME']['libreoffice_path'] = 'libreoffice'
 
 
+def parse_file(parser_class, file_path, docs_root_dir, config_dict, output_docs_dir):
+    """
+    解析单个文件，可以在 worker 进程中运行
+    异常不会向外抛出，而是以 traceback 字符串的形式返回，避免一个文件失败影响其他文件
+    :return: (file_path, result, error)
+    """
+    try:
+        parser = parser_class(file_path, docs_root_dir, config_dict, title_prefix='%parent', logger=logger, output_dir=output_docs_dir)
+        before = parser.engine.cache_stats()
+        result = parser.parse()
+        after = parser.engine.cache_stats()
+        if after is not None:
+            logger.info(f'{file_path} 模型缓存命中 {after["hits"] - before["hits"]} 次，未命中 {after["misses"] - before["misses"]} 次')
+        return file_path, result, None
+    except Exception:
+        return file_path, None, traceback.format_exc()
+
+
 if __name__ == '__main__':
 
     # 对 argv 进行解析
@@ -54,6 +75,10 @@ if __name__ == '__main__':
     parser.add_argument('-i', '--input', type=str, help='要解析的文档根目录')
     # parser.add_argument('--input', type=str, help='要解析的文档根目录')
     parser.add_argument('-o', '--output', type=str, help='输出位置', default=os.path.join('.', 'output'))
+    parser.add_argument('--no-cache', action='store_true', help='不使用模型结果缓存')
+    parser.add_argument('--refresh-cache', action='store_true', help='不读取模型结果缓存，重新请求并更新缓存')
+    parser.add_argument('-w', '--workers', type=int, help='并行解析文件的进程数，1 表示在当前进程中依次解析', default=1)
+    parser.add_argument('--export', action='store_true', help='解析完成后导出 qa.csv 和 kb_info.json（需要遍历整个知识库）')
     # parser.add_argument('-o', type=str, help='输出位置', default=os.path.join('.', 'output'))
     # parser.add_argument('-h', '--help', action='help', help='显示帮助信息')
 
@@ -83,35 +108,77 @@ if __name__ == '__main__':
     if not os.path.exists(output_docs_dir):
         os.makedirs(output_docs_dir)
 
+    # 模型结果缓存，默认保存在输出目录下
+    if args.no_cache:
+        config_dict['RUNTIME']['cache_mode'] = 'off'
+    elif args.refresh_cache:
+        config_dict['RUNTIME']['cache_mode'] = 'refresh'
+    else:
+        config_dict['RUNTIME']['cache_mode'] = 'on'
+    config_dict['RUNTIME']['cache_file'] = os.path.join(output_dir, 'model_cache.sqlite')
+    config_dict['RUNTIME']['workers'] = args.workers
+
 
     parser_chooser = parser_manage.Parser_Chooser(config_dict, logger)
-    qa_manager = qa_manage.QA_Manager(config_dict, docs_root_dir, output_dir)
+    qa_manager = qa_manage.QA_Manager(config_dict, docs_root_dir, output_dir, logger)
     info_maintenance = info_maintenance.InfoMaintenancer(docs_root_dir, output_dir, config_dict, logger)
 
-    for dir, children, files in os.walk(docs_root_dir):
-        for file in files:
-            file_path = os.path.join(dir, file)
-            parser_class = parser_chooser.choose_parser(file_path)
-            if parser_class == 'ignored':
-                logger.info('======')
-                logger.info(f'跳过 {file_path}')
-            elif parser_class is not None:
-
-                is_new = info_maintenance.is_new(file_path)
-                if is_new:
-                    try:
-                        parser = parser_class(file_path, docs_root_dir, config_dict, title_prefix='%parent', logger=logger, output_dir=output_docs_dir)
-                        result = parser.parse()
-                        qa_manager.merge_qa(result, file_path)
-                        info_maintenance.updated(file_path)
-                    except Exception as e:
-                        raise(e)
-
-                else:
-                    logger.info('======')
-                    logger.info(f'{file_path} 无更新，跳过')
+    # 遍历目录，收集需要解析的文件（按遍历顺序）
+    tasks = []
+    for file_path, parser_class in parser_chooser.walk(docs_root_dir):
+        if parser_class == 'ignored':
+            logger.info('======')
+            logger.info(f'跳过 {file_path}')
+        elif parser_class is not None:
+
+            is_new = info_maintenance.is_new(file_path)
+            if is_new:
+                tasks.append((parser_class, file_path))
             else:
-                logger.warning('======')
-                logger.warning(f'{file_path} 无法解析')
-    
-    # qa_manager.export_csv('qa.csv')
\ No newline at end of file
+                logger.info('======')
+                logger.info(f'{file_path} 无更新，跳过')
+        else:
+            logger.warning('======')
+            logger.warning(f'{file_path} 无法解析')
+    parser_chooser.log_skip_stats()
+
+    # 由当前进程统一合并结果，qa_manager 和 info_maintenance 只在这里被修改
+    failed = []
+    def handle_result(file_path, result, error):
+        if error is not None:
+            logger.error('======')
+            logger.error(f'{file_path} 解析失败：\n{error}')
+            failed.append(file_path)
+            return
+        qa_manager.merge_qa(result, file_path)
+        info_maintenance.updated(file_path)
+
+    if args.workers > 1 and len(tasks) > 1:
+        # 使用 spawn 启动 worker，不继承当前进程中请求引擎的线程和 SQLite 连接
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(parse_file, parser_class, file_path, docs_root_dir, config_dict, output_docs_dir)
+                for parser_class, file_path in tasks
+            ]
+            # 按提交顺序收集结果，保证合并顺序与遍历顺序一致
+            for (parser_class, file_path), future in zip(tasks, futures):
+                try:
+                    handle_result(*future.result())
+                except Exception:
+                    # worker 进程异常退出等情况
+                    handle_result(file_path, None, traceback.format_exc())
+    else:
+        for parser_class, file_path in tasks:
+            handle_result(*parse_file(parser_class, file_path, docs_root_dir, config_dict, output_docs_dir))
+
+    logger.info('======')
+    logger.info(f'共解析 {len(tasks)} 个文件，失败 {len(failed)} 个')
+    for file_path in failed:
+        logger.info(f'解析失败: {file_path}')
+
+    # QA 已经在每个文件解析完成后写入 qa_store，只在需要时导出完整的 qa.csv 和 kb_info.json
+    qa_manager.close()
+    if args.export:
+        qa_manager.export_csv(os.path.join(output_dir, 'qa.csv'))
+        info_maintenance.export_kb_info()
+        logger.info(f'已导出 qa.csv 和 kb_info.json 到 {output_dir}')
@@ -0,0 +1,105 @@
+import os
+import logging
+import tempfile
+import unittest
+
+from file_parsers.basic_parser import BasicParser
+
+
+class IterSectionsTest(unittest.TestCase):
+    """
+    BasicParser.iter_sections 的切分规则：标题层级、代码块、没有标题时的处理、title_prefix
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.logger = logging.getLogger('test_iter_sections')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_parser(self, rel_path='guide/note.md', title_prefix='%parent'):
+        file_path = os.path.join(self.temp_dir.name, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        open(file_path, 'w').close()
+        return BasicParser(file_path, self.temp_dir.name, {}, title_prefix, self.logger, self.temp_dir.name)
+
+    def sections(self, parser, text, line_handler=None):
+        return list(parser.iter_sections(text.splitlines(), line_handler))
+
+    def test_heading_levels(self):
+        parser = self.make_parser(title_prefix='')
+        result = self.sections(parser, '# A\na\n## B\nb\n### C\nc\n## D\nd\n# E\ne')
+        self.assertEqual([title for title, _ in result], ['A', 'A-B', 'A-B-C', 'A-D', 'E'])
+        self.assertEqual(result[2][1], parser.add_section_tag('c', 'A-B-C'))
+
+    def test_heading_level_jump(self):
+        parser = self.make_parser(title_prefix='')
+        with self.assertLogs(self.logger, logging.WARNING) as logs:
+            result = self.sections(parser, '# A\na\n### B\nb\n## C\nc')
+        # 跳级的标题按上一级加 1 处理
+        self.assertEqual([title for title, _ in result], ['A', 'A-B', 'A-C'])
+        self.assertIn('标题级别跳跃', logs.output[0])
+
+    def test_code_fence(self):
+        parser = self.make_parser(title_prefix='')
+        result = self.sections(parser, '# A\nbefore\n```python\n# comment\nx = 1\n```\nafter\n## B\nb')
+        self.assertEqual([title for title, _ in result], ['A', 'A-B'])
+        # 代码块中的 # 不作为标题，``` 所在的行不保留
+        self.assertEqual(result[0][1], parser.add_section_tag('before\n# comment\nx = 1\nafter', 'A'))
+
+    def test_line_handler_skips_headings_and_code(self):
+        parser = self.make_parser(title_prefix='')
+        result = self.sections(parser, '# a\nb\n```\nc\n```', line_handler=str.upper)
+        self.assertEqual(result, [('a', parser.add_section_tag('B\nc', 'a'))])
+
+    def test_no_heading(self):
+        parser = self.make_parser()
+        result = self.sections(parser, 'first line\nsecond line')
+        # 没有标题时以文件名作为标题，不加 title_prefix
+        self.assertEqual(result, [('note', parser.add_section_tag('first line\nsecond line', 'note'))])
+
+    def test_empty_sections_skipped(self):
+        parser = self.make_parser(title_prefix='')
+        result = self.sections(parser, '# A\n\n## B\nb\n## C\n\n')
+        self.assertEqual([title for title, _ in result], ['A-B'])
+        self.assertEqual(self.sections(parser, ''), [])
+
+    def test_repeated_heading(self):
+        parser = self.make_parser(title_prefix='')
+        result = self.sections(parser, '# A\nfirst\n# A\nsecond')
+        # 标题路径重复时分别返回
+        self.assertEqual(result, [
+            ('A', parser.add_section_tag('first', 'A')),
+            ('A', parser.add_section_tag('second', 'A')),
+        ])
+
+    def test_title_prefix(self):
+        parser = self.make_parser('guide/v1/note.md')
+        self.assertEqual(parser.title_prefix, 'guide-v1')
+        result = self.sections(parser, '# A\na\n## B\nb')
+        # title_prefix 只加在标题路径上，@section 中的位置不包含
+        self.assertEqual(result, [
+            ('guide-v1-A', parser.add_section_tag('a', 'A')),
+            ('guide-v1-A-B', parser.add_section_tag('b', 'A-B')),
+        ])
+
+        parser = self.make_parser(title_prefix='%file')
+        self.assertEqual(self.sections(parser, '# A\na')[0][0], 'note-A')
+
+    def test_file_lines(self):
+        parser = self.make_parser(title_prefix='')
+        md_path = os.path.join(self.temp_dir.name, 'doc.md')
+        with open(md_path, 'w', encoding='utf-8') as f:
+            f.write('# A\r\na\n## B\nb\n')
+        # 文件对象的行带有换行符
+        with open(md_path, 'r', encoding='utf-8', newline='') as f:
+            result = list(parser.iter_sections(f))
+        self.assertEqual(result, [
+            ('A', parser.add_section_tag('a', 'A')),
+            ('A-B', parser.add_section_tag('b', 'A-B')),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import json
+import logging
+import hashlib
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class Downloader:
+    """
+    下载远程文件（图片等）
+    所有请求共用一个带连接池的 requests.Session，连接和读取都有超时
+    下载结果按 URL 缓存在磁盘上，再次下载时带上 ETag / Last-Modified 做条件请求，未变化（304）时直接使用缓存
+    """
+
+    def __init__(self, cfg, logger=None):
+
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        dl_cfg = cfg.get('DOWNLOAD', {})
+        self.workers = max(1, int(dl_cfg.get('workers') or 8))
+        self.timeout = (float(dl_cfg.get('connect_timeout') or 10), float(dl_cfg.get('read_timeout') or 30))
+
+        # 缓存目录为空时，放在模型结果缓存文件旁边；都没有时不缓存
+        self.cache_dir = dl_cfg.get('cache_dir') or None
+        cache_file = cfg.get('CACHE', {}).get('cache_file') or cfg.get('RUNTIME', {}).get('cache_file')
+        if self.cache_dir is None and cache_file:
+            self.cache_dir = os.path.join(os.path.dirname(cache_file), 'download_cache')
+        if self.cache_dir is not None and not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def _cache_paths(self, url):
+        key = hashlib.sha256(url.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key), os.path.join(self.cache_dir, key + '.json')
+
+
+    def _read_cache(self, url):
+        if self.cache_dir is None:
+            return None, None
+        data_path, meta_path = self._cache_paths(url)
+        if not os.path.exists(data_path) or not os.path.exists(meta_path):
+            return None, None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(data_path, 'rb') as f:
+                return f.read(), meta
+        except (OSError, ValueError):
+            return None, None
+
+
+    def _write_cache(self, url, data, response):
+        if self.cache_dir is None:
+            return
+        meta = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+        data_path, meta_path = self._cache_paths(url)
+        # 先写临时文件再替换，多个进程同时下载同一个 URL 时不会读到写了一半的文件
+        for path, content, mode in [(data_path, data, 'wb'), (meta_path, json.dumps(meta), 'w')]:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, mode) as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+
+
+    def fetch(self, url):
+        """
+        下载 url，可以在多个线程中同时调用
+        :return: 文件内容的 bytes
+        """
+        cached, meta = self._read_cache(url)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            # 网络错误时使用旧的缓存
+            if cached is not None:
+                self.logger.warning(f'下载失败，使用缓存：{url}，{e}')
+                return cached
+            raise
+
+        if response.status_code == 304 and cached is not None:
+            return cached
+        response.raise_for_status()
+
+        data = response.content
+        if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+            self._write_cache(url, data, response)
+        return data
+
+
+_downloader = None
+_downloader_pid = None
+_downloader_lock = threading.Lock()
+
+
+def get_downloader(cfg, logger=None):
+    """
+    获取当前进程共享的 Downloader，连接池在整个运行期间复用
+    """
+    global _downloader, _downloader_pid
+    with _downloader_lock:
+        if _downloader is None or _downloader_pid != os.getpid():
+            _downloader = Downloader(cfg, logger)
+            _downloader_pid = os.getpid()
+        return _downloader
@@ -0,0 +1,212 @@
+import io
+import os
+import base64
+import logging
+
+from PIL import Image
+
+
+class PreparedImage:
+    """
+    压缩后发送给模型的图片
+    box 为发送的区域在原图中的像素坐标 [x1, y1, x2, y2]，用于把模型返回的比例坐标映射回原图
+    """
+
+    __slots__ = ('b64', 'mime', 'size', 'box', 'sent_size', 'quality', 'original_bytes', 'sent_bytes')
+
+    def __init__(self, b64, mime, size, box, sent_size, quality, original_bytes, sent_bytes):
+        self.b64 = b64
+        self.mime = mime
+        self.size = size
+        self.box = box
+        self.sent_size = sent_size
+        self.quality = quality
+        self.original_bytes = original_bytes
+        self.sent_bytes = sent_bytes
+
+
+    @property
+    def data_url(self):
+        return f'data:{self.mime};base64,{self.b64}'
+
+
+    def map_bbox(self, bbox):
+        """
+        把相对于发送图片的比例坐标转换为原图的像素坐标
+        """
+        x1, y1, x2, y2 = self.box
+        w = x2 - x1
+        h = y2 - y1
+        return [
+            round(x1 + bbox[0] * w),
+            round(y1 + bbox[1] * h),
+            round(x1 + bbox[2] * w),
+            round(y1 + bbox[3] * h),
+        ]
+
+
+class ImagePrep:
+    """
+    发送给模型前统一处理图片：裁掉空白边距、限制最长边、自适应调整 JPEG 质量，使图片不超过目标大小
+    只保存配置，可以传给 PDF 的渲染进程使用
+    """
+
+    # 可以直接发送的原图格式
+    keep_formats = {'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+    def __init__(self, cfg, logger=None):
+
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        img_cfg = cfg.get('IMAGE', {})
+        self.max_long_edge = int(img_cfg.get('max_long_edge') or 2048)
+        self.target_bytes = int(float(img_cfg.get('target_kb') or 400) * 1024)
+        self.trim = str(img_cfg.get('trim_margin', 'True')).lower() not in ['false', '0', 'no', 'off']
+        self.max_quality = int(img_cfg.get('max_quality') or 85)
+        self.min_quality = int(img_cfg.get('min_quality') or 50)
+
+
+    @staticmethod
+    def to_rgb(image):
+        # JPG 不支持透明通道，透明部分用浅灰色填充
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (240, 240, 240))
+            background.paste(image, mask=image.split()[-1])
+            return background
+        if image.mode != 'RGB':
+            return image.convert('RGB')
+        return image
+
+
+    @staticmethod
+    def content_box(image, threshold=245, padding=0.01):
+        """
+        去掉接近白色的边距后的内容区域，没有内容时返回整张图片
+        """
+        width, height = image.size
+        mask = image.convert('L').point(lambda p: 255 if p < threshold else 0)
+        bbox = mask.getbbox()
+        if bbox is None:
+            return (0, 0, width, height)
+
+        pad = round(max(width, height) * padding)
+        return (
+            max(0, bbox[0] - pad),
+            max(0, bbox[1] - pad),
+            min(width, bbox[2] + pad),
+            min(height, bbox[3] + pad),
+        )
+
+
+    def _encode(self, image):
+        """
+        从 max_quality 开始逐步降低质量，直到不超过目标大小；最低质量仍然超过时按比例缩小
+        """
+        while True:
+            quality = self.max_quality
+            while True:
+                byte_arr = io.BytesIO()
+                image.save(byte_arr, format='JPEG', quality=quality)
+                data = byte_arr.getvalue()
+                if len(data) <= self.target_bytes or quality <= self.min_quality:
+                    break
+                quality = max(self.min_quality, quality - 10)
+
+            if len(data) <= self.target_bytes or min(image.size) <= 256:
+                return data, quality, image
+
+            scale = (self.target_bytes / len(data)) ** 0.5 * 0.95
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+
+    def baseline_bytes(self, image):
+        """
+        渲染得到的图片没有原始文件，以原尺寸、max_quality 编码的 JPEG 大小作为压缩前的大小
+        """
+        byte_arr = io.BytesIO()
+        self.to_rgb(image).save(byte_arr, format='JPEG', quality=self.max_quality)
+        return byte_arr.tell()
+
+
+    def prepare(self, source, trim=None, baseline=False):
+        """
+        :param source: PIL 图像、图片的 bytes 或图片路径
+        :param trim: 是否裁掉空白边距，默认按配置
+        :param baseline: source 为 PIL 图像时，是否计算压缩前的大小（多一次编码），用于记录节省的字节数
+        :return: PreparedImage
+        """
+        original = None
+        if isinstance(source, Image.Image):
+            image = source
+        elif isinstance(source, (bytes, bytearray)):
+            original = bytes(source)
+            image = Image.open(io.BytesIO(original))
+        else:
+            with open(source, 'rb') as f:
+                original = f.read()
+            image = Image.open(io.BytesIO(original))
+        original_bytes = len(original) if original is not None else None
+        if original is None and baseline:
+            original_bytes = self.baseline_bytes(image)
+        source_format = image.format
+
+        image = self.to_rgb(image)
+        size = image.size
+
+        box = (0, 0, size[0], size[1])
+        if (self.trim if trim is None else trim):
+            box = self.content_box(image)
+            if box != (0, 0, size[0], size[1]):
+                image = image.crop(box)
+
+        long_edge = max(image.size)
+        if long_edge > self.max_long_edge:
+            scale = self.max_long_edge / long_edge
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+
+        # 尺寸没有变化、原图已经足够小时，直接发送原图
+        if original is not None and source_format in self.keep_formats and image.size == size and original_bytes <= self.target_bytes:
+            return PreparedImage(
+                base64.b64encode(original).decode('utf8'), self.keep_formats[source_format],
+                size, list(box), size, None, original_bytes, original_bytes
+            )
+
+        data, quality, image = self._encode(image)
+        mime = 'image/jpeg'
+
+        # 截图、图表等 PNG 图片用 PNG 压缩往往更小
+        if source_format == 'PNG':
+            byte_arr = io.BytesIO()
+            image.save(byte_arr, format='PNG', optimize=True)
+            if byte_arr.tell() < len(data):
+                data, quality, mime = byte_arr.getvalue(), None, 'image/png'
+
+        return PreparedImage(
+            base64.b64encode(data).decode('utf8'), mime, size, list(box), image.size, quality, original_bytes, len(data)
+        )
+
+
+    @staticmethod
+    def describe(prepared):
+        if prepared.quality is None:
+            return prepared.mime
+        return f'{prepared.mime}，质量 {prepared.quality}'
+
+
+    def log(self, prepared, name):
+        if prepared.original_bytes:
+            saved = prepared.original_bytes - prepared.sent_bytes
+            self.logger.info(
+                f'{name}: {prepared.size[0]}x{prepared.size[1]} {prepared.original_bytes/1024:.0f} KB -> '
+                f'{prepared.sent_size[0]}x{prepared.sent_size[1]} {prepared.sent_bytes/1024:.0f} KB（{self.describe(prepared)}），'
+                f'节省 {saved/1024:.0f} KB'
+            )
+        else:
+            self.logger.info(
+                f'{name}: {prepared.size[0]}x{prepared.size[1]} -> '
+                f'{prepared.sent_size[0]}x{prepared.sent_size[1]} {prepared.sent_bytes/1024:.0f} KB（{self.describe(prepared)}）'
+            )
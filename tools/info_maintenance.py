@@ -1,10 +1,16 @@
 import os
 import json
+import sqlite3
+import hashlib
 from datetime import datetime
-import atexit
 
 
 class InfoMaintenancer:
+    """
+    维护知识库中已解析文件的信息
+    信息保存在 knowledge_base_dir/kb_info.sqlite 中（WAL 模式），每次 updated 都会立即提交，进程被强制结束也不会丢失之前的记录
+    kb_info.json 只在调用 export_kb_info 时导出
+    """
 
     def __init__(self, docs_root_dir, knowledge_base_dir, config, logger):
 
@@ -13,24 +19,18 @@ class InfoMaintenancer:
         self.config = config
         self.logger = logger
 
+        # is_new 中计算过的 hash，updated 时如果文件没有变化可以直接使用
+        self.pending_hashes = {}
+
         self.get_kb_info()
-        # 注册退出时的回调函数
-        atexit.register(self.save_kb_info)
 
     
     def new_kb_info(self):
         """
-        新建一个 kb_info.json 文件
+        新建 kb_info
         """
-        doc_root_name = os.path.basename(self.docs_root_dir)
         return {
-            'doc_tree': {
-                doc_root_name: {
-                    'dir_path': self.docs_root_dir,
-                    'children': {},
-                    'files': {}
-                }
-            },
+            'file_index': {},
             'create_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
             'name': os.path.basename(self.knowledge_base_dir)
         }
@@ -41,104 +41,209 @@ class InfoMaintenancer:
         if not os.path.exists(self.knowledge_base_dir):
             self.logger.warning('知识库目录不存在，将创建一个')
             os.makedirs(self.knowledge_base_dir)
-            self.kb_info = self.new_kb_info()
-            # 保存 kb_info.json
-            with open(os.path.join(self.knowledge_base_dir, 'kb_info.json'), 'w') as f:
-                json.dump(self.kb_info, f, indent=4, ensure_ascii=False)
-
-
-        # 读取 knowledge_base_dir 下的 kb_info.json
-        elif not os.path.exists(os.path.join(self.knowledge_base_dir, 'kb_info.json')):
-            self.logger.warning('知识库目录下没有 kb_info.json 文件，将创建一个空的')
-            self.kb_info = self.new_kb_info()
-            # 保存 kb_info.json
-            with open(os.path.join(self.knowledge_base_dir, 'kb_info.json'), 'w') as f:
-                json.dump(self.kb_info, f, indent=4, ensure_ascii=False)
-            
-        # 读取 kb_info.json
-        else:
-            with open(os.path.join(self.knowledge_base_dir, 'kb_info.json'), 'r') as f:
-                self.kb_info = json.load(f)
 
+        db_path = os.path.join(self.knowledge_base_dir, 'kb_info.sqlite')
+        json_path = os.path.join(self.knowledge_base_dir, 'kb_info.json')
+        is_new_db = not os.path.exists(db_path)
+
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 可以保证进程崩溃时已提交的记录不丢失
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS file_index (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                mtime REAL,
+                hash TEXT
+            )
+        ''')
+
+        if is_new_db:
+            # 兼容旧版本：从 kb_info.json 导入
+            if os.path.exists(json_path):
+                with open(json_path, 'r') as f:
+                    kb_info = json.load(f)
+                if 'file_index' not in kb_info:
+                    kb_info['file_index'] = self.doc_tree_to_file_index(kb_info['doc_tree'])
+                self.logger.info(f'从 {json_path} 导入 {len(kb_info["file_index"])} 条文件记录')
+            else:
+                self.logger.warning('知识库目录下没有 kb_info，将创建一个空的')
+                kb_info = self.new_kb_info()
+
+            with self.conn:
+                for k in ['create_time', 'name', 'mod_time']:
+                    if k in kb_info:
+                        self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (k, kb_info[k]))
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO file_index (path, size, mtime_ns, mtime, hash) VALUES (?, ?, ?, ?, ?)',
+                    [(k, v['size'], v['mtime_ns'], v['mtime'], v['hash']) for k, v in kb_info['file_index'].items()]
+                )
+
+        self.kb_info = dict(self.conn.execute('SELECT key, value FROM meta').fetchall())
+        self.file_index = {}
+        for path, size, mtime_ns, mtime, file_hash in self.conn.execute('SELECT path, size, mtime_ns, mtime, hash FROM file_index'):
+            self.file_index[path] = {'mtime': mtime, 'size': size, 'mtime_ns': mtime_ns, 'hash': file_hash}
 
 
-    def save_kb_info(self):
+    def commit_entry(self, key):
         """
-        保存 kb_info.json
+        把 file_index 中的一条记录写入数据库并提交
         """
-        self.kb_info['mod_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        entry = self.file_index[key]
+        mod_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO file_index (path, size, mtime_ns, mtime, hash) VALUES (?, ?, ?, ?, ?)',
+                (key, entry['size'], entry['mtime_ns'], entry['mtime'], entry['hash'])
+            )
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('mod_time', mod_time))
+        self.kb_info['mod_time'] = mod_time
+
+
+    def export_kb_info(self):
+        """
+        导出 kb_info.json
+        """
+        kb_info = dict(self.kb_info)
+        kb_info['doc_tree'] = self.build_doc_tree()
+        kb_info['file_index'] = self.file_index
 
         with open(os.path.join(self.knowledge_base_dir, 'kb_info.json'), 'w') as f:
-            json.dump(self.kb_info, f, indent=4, ensure_ascii=False)
+            json.dump(kb_info, f, indent=4, ensure_ascii=False)
+
+
+    def rel_key(self, file_path):
+        """
+        文件在 docs_root_dir 中的相对路径，作为 file_index 的 key
+        """
+        prefix = os.path.join(self.docs_root_dir, '')
+        if file_path.startswith(prefix):
+            return file_path[len(prefix):]
+        return os.path.relpath(file_path, self.docs_root_dir)
+
+
+    def file_hash(self, file_path):
+        sha256 = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+
+    def doc_tree_to_file_index(self, doc_tree):
+        """
+        把旧版本的 doc_tree 转换为 file_index，旧版本没有 hash，只保留 mtime
+        """
+        file_index = {}
+        root_name = os.path.basename(self.docs_root_dir)
+        nodes = [([], doc_tree[root_name])]
+        while nodes:
+            parents, node = nodes.pop()
+            for file_name, file_info in node['files'].items():
+                key = os.path.join(*parents, file_name)
+                file_index[key] = {'mtime': file_info['mtime'], 'size': None, 'mtime_ns': None, 'hash': None}
+            for dir_name, child in node['children'].items():
+                nodes.append((parents + [dir_name], child))
+        return file_index
+
+
+    def build_doc_tree(self):
+        """
+        从 file_index 生成嵌套的 doc_tree，格式和旧版本一致
+        """
+        root_name = os.path.basename(self.docs_root_dir)
+        root = {
+            'dir_path': self.docs_root_dir,
+            'children': {},
+            'files': {}
+        }
+        for key in sorted(self.file_index.keys()):
+            path_in_root_list = key.split(os.path.sep)
+            current_doc_tree = root
+            for i, dir_name in enumerate(path_in_root_list[:-1]):
+                if dir_name not in current_doc_tree['children']:
+                    current_doc_tree['children'][dir_name] = {
+                        'dir_path': os.path.join(self.docs_root_dir, *path_in_root_list[:i+1]),
+                        'children': {},
+                        'files': {}
+                    }
+                current_doc_tree = current_doc_tree['children'][dir_name]
+
+            current_doc_tree['files'][path_in_root_list[-1]] = {
+                'dir_path': os.path.join(self.docs_root_dir, key),
+                'mtime': self.file_index[key]['mtime']
+            }
+        return {root_name: root}
 
     
 
     def is_new(self, file_path):
         """
-        判断文件是否为新文件
+        判断文件是否为新文件或内容有变化
+        size 和 mtime 都没变时直接认为没有变化，否则计算内容 hash 再比较
         """
 
         # 判断 file_path 是不是 file
         if not os.path.isfile(file_path):
-            rasie(ValueError(f'{file_path} 不是一个文件'))
+            raise(ValueError(f'{file_path} 不是一个文件'))
 
-        path_in_root = os.path.relpath(file_path, self.docs_root_dir)
-        root_name = os.path.basename(self.docs_root_dir)
-        sep = os.path.sep
-        path_in_root_list = path_in_root.split(os.path.sep)
-        current_doc_tree = self.kb_info['doc_tree'][root_name]
-        for key in path_in_root_list[:-1]:
-            if key not in current_doc_tree['children']:
-                return True
-            else:
-                current_doc_tree = current_doc_tree['children'][key]
-        
-        
-        
-        file_name = path_in_root_list[-1]
-        if file_name not in current_doc_tree['files']:
+        key = self.rel_key(file_path)
+        entry = self.file_index.get(key)
+        if entry is None:
             return True
-        else:
-            file_mtime = os.path.getmtime(file_path)
-            if file_mtime > current_doc_tree['files'][file_name]['mtime']:
-                return True
-        
-        return False
+
+        st = os.stat(file_path)
+
+        # 旧版本的记录没有 hash，只比较 mtime
+        if entry['hash'] is None:
+            return st.st_mtime > entry['mtime']
+
+        if st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime_ns']:
+            return False
+
+        file_hash = self.file_hash(file_path)
+        self.pending_hashes[key] = (st.st_size, st.st_mtime_ns, file_hash)
+        if file_hash == entry['hash']:
+            # 内容没有变化（touch、rsync、git checkout 等），只更新 stat 信息
+            entry['size'] = st.st_size
+            entry['mtime_ns'] = st.st_mtime_ns
+            entry['mtime'] = st.st_mtime
+            self.commit_entry(key)
+            return False
+
+        return True
 
     
     def updated(self, file_path):
         """
-        更新 doc_tree
+        更新 file_index
         """
         # 判断 file_path 是不是 file
         if not os.path.isfile(file_path):
-            rasie(ValueError(f'{file_path} 不是一个文件'))
+            raise(ValueError(f'{file_path} 不是一个文件'))
 
         # 判断 file_path 是否在 docs_root_dir 下
         if not file_path.startswith(self.docs_root_dir):
-            rasie(ValueError(f'{file_path} 不是在 {self.docs_root_dir} 下'))
-        
-        # 找到 file_path 在 doc_tree 中的位置
-        path_in_root = os.path.relpath(file_path, self.docs_root_dir)
-        sep = os.path.sep
-        path_in_root_list = path_in_root.split(os.path.sep)
-        root_name = os.path.basename(self.docs_root_dir)
-        current_doc_tree = self.kb_info['doc_tree'][root_name]
-        for key in path_in_root_list[:-1]:
-            if key not in current_doc_tree['children']:
-                current_doc_tree['children'][key] = {
-                    "dir_path": os.path.join(self.docs_root_dir, *path_in_root_list[:path_in_root_list.index(key)+1]),
-                    "children": {},
-                    "files": {}
-                }
-            current_doc_tree = current_doc_tree['children'][key]
-        
-        # 更新 file_path 对应的 doc_tree 中的信息
-        file_name = path_in_root_list[-1]
-        current_doc_tree['files'][file_name] = {
-            "dir_path": os.path.join(self.docs_root_dir, *path_in_root_list),
-            "mtime": os.path.getmtime(file_path)
+            raise(ValueError(f'{file_path} 不是在 {self.docs_root_dir} 下'))
+
+        key = self.rel_key(file_path)
+        st = os.stat(file_path)
+        pending = self.pending_hashes.pop(key, None)
+        if pending is not None and pending[:2] == (st.st_size, st.st_mtime_ns):
+            file_hash = pending[2]
+        else:
+            file_hash = self.file_hash(file_path)
+
+        self.file_index[key] = {
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'hash': file_hash
         }
+        self.commit_entry(key)
         
 
 
@@ -183,4 +288,4 @@ class InfoMaintenancer:
 
     # def __del__(self):
 
-    #     self.save_kb_info()
\ No newline at end of file
+    #     self.export_kb_info()
\ No newline at end of file
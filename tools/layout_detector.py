@@ -0,0 +1,112 @@
+import os
+import logging
+import threading
+
+
+# PubLayNet 模型的类别
+DEFAULT_LABEL_MAP = '0:text,1:title,2:list,3:table,4:figure'
+
+
+class LayoutDetector:
+    """
+    使用 layoutparser 的 Detectron2 模型在本地（CPU）检测页面版面，返回文字、表格、图表、公式等区域
+    layoutparser 和 detectron2 为可选依赖，未安装或模型文件不存在时不可用，由调用方退回图像识别模型
+    模型在第一次使用时加载，同一进程共用一个模型
+    """
+
+    def __init__(self, cfg, logger=None):
+
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        model_cfg = cfg.get('MODEL', {})
+        self.model_path = model_cfg.get('layout_model_path') or ''
+        self.config_path = model_cfg.get('layout_model_config') or ''
+        self.score_threshold = float(model_cfg.get('layout_score_threshold') or 0.5)
+
+        # 类别编号与名称的对应关系，格式为 编号:名称,编号:名称
+        self.label_map = {}
+        for item in (model_cfg.get('layout_label_map') or DEFAULT_LABEL_MAP).split(','):
+            if ':' not in item:
+                continue
+            k, v = item.split(':', 1)
+            self.label_map[int(k.strip())] = v.strip().lower()
+
+        self.model = None
+        self.error = None
+        self._lock = threading.Lock()
+
+
+    def load(self):
+        """
+        加载模型
+        :return: 是否可用，不可用的原因记录在 self.error 中
+        """
+        with self._lock:
+            if self.model is not None or self.error is not None:
+                return self.model is not None
+
+            try:
+                import layoutparser as lp
+            except ImportError as e:
+                self.error = f'未安装 layoutparser：{e}'
+                return False
+
+            for path in [self.config_path, self.model_path]:
+                if not os.path.exists(path):
+                    self.error = f'版面检测模型文件不存在：{path}'
+                    return False
+
+            try:
+                self.model = lp.Detectron2LayoutModel(
+                    self.config_path,
+                    model_path=self.model_path,
+                    extra_config=['MODEL.ROI_HEADS.SCORE_THRESH_TEST', self.score_threshold, 'MODEL.DEVICE', 'cpu'],
+                    label_map=self.label_map,
+                )
+            except Exception as e:
+                self.error = f'加载版面检测模型失败：{e}'
+                return False
+
+            self.logger.info(f'已加载版面检测模型 {self.model_path}')
+            return True
+
+
+    def detect(self, image):
+        """
+        检测图片中的版面区域
+        :param image: PIL 图像
+        :return: [{'type': 类别名称, 'bbox': [x1, y1, x2, y2] 像素坐标, 'score': 置信度}]
+        """
+        # 模型不能在多个线程中同时推理
+        with self._lock:
+            layout = self.model.detect(image.convert('RGB'))
+
+        regions = []
+        for blk in layout:
+            x1, y1, x2, y2 = blk.coordinates
+            regions.append({
+                'type': str(blk.type).lower(),
+                'bbox': [round(x1), round(y1), round(x2), round(y2)],
+                'score': float(blk.score) if blk.score is not None else None,
+            })
+        return regions
+
+
+_detector = None
+_detector_pid = None
+_detector_lock = threading.Lock()
+
+
+def get_layout_detector(cfg, logger=None):
+    """
+    获取当前进程共享的 LayoutDetector，模型只加载一次
+    """
+    global _detector, _detector_pid
+    with _detector_lock:
+        if _detector is None or _detector_pid != os.getpid():
+            _detector = LayoutDetector(cfg, logger)
+            _detector_pid = os.getpid()
+        return _detector
@@ -0,0 +1,310 @@
+import io
+import os
+import queue
+import shutil
+import socket
+import logging
+import tempfile
+import threading
+import subprocess
+import time
+import multiprocessing.util
+
+
+_OutputStream = None
+
+
+def _output_stream_class():
+    """
+    实现 XOutputStream 的内存输出流，需要先导入 uno，所以在第一次使用时定义
+    """
+    global _OutputStream
+    if _OutputStream is None:
+        import unohelper
+        from com.sun.star.io import XOutputStream
+
+        class OutputStream(unohelper.Base, XOutputStream):
+
+            def __init__(self):
+                self.buffer = io.BytesIO()
+
+            def writeBytes(self, seq):
+                self.buffer.write(seq.value)
+
+            def flush(self):
+                pass
+
+            def closeOutput(self):
+                pass
+
+            def getvalue(self):
+                return self.buffer.getvalue()
+
+        _OutputStream = OutputStream
+    return _OutputStream
+
+
+class SofficeWorker:
+    """
+    一个常驻的 soffice 进程，使用独立的 profile 目录，通过本地 socket（UNO）接收转换任务
+    """
+
+    def __init__(self, soffice_path, start_timeout=30, logger=None):
+        self.soffice_path = soffice_path
+        self.start_timeout = start_timeout
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        self.proc = None
+        self.desktop = None
+        self.profile_dir = None
+        self.port = None
+
+
+    @staticmethod
+    def free_port():
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('127.0.0.1', 0))
+            return s.getsockname()[1]
+
+
+    def start(self):
+        import uno
+
+        self.profile_dir = tempfile.mkdtemp(prefix='soffice_profile_')
+        self.port = self.free_port()
+        self.proc = subprocess.Popen([
+            self.soffice_path, '--headless', '--invisible', '--nologo', '--norestore', '--nodefault', '--nolockcheck',
+            f'-env:UserInstallation={uno.systemPathToFileUrl(self.profile_dir)}',
+            f'--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext',
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # soffice 启动需要几秒，连接成功前反复重试
+        local_ctx = uno.getComponentContext()
+        resolver = local_ctx.ServiceManager.createInstanceWithContext('com.sun.star.bridge.UnoUrlResolver', local_ctx)
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            try:
+                ctx = resolver.resolve(f'uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext')
+                break
+            except Exception as e:
+                if self.proc.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f'soffice 启动失败：{e}')
+                time.sleep(0.3)
+        self.desktop = ctx.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', ctx)
+        self.logger.info(f'soffice 已启动，pid {self.proc.pid}，端口 {self.port}')
+
+
+    def convert(self, src_path, filter_name):
+        """
+        转换文件，导出结果通过 OutputStream 直接写入内存，不经过磁盘
+        :return: 导出文件的 bytes
+        """
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def prop(name, value):
+            p = PropertyValue()
+            p.Name = name
+            p.Value = value
+            return p
+
+        doc = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(src_path)), '_blank', 0, (prop('Hidden', True), prop('ReadOnly', True))
+        )
+        if doc is None:
+            raise RuntimeError(f'soffice 无法打开文件：{src_path}')
+        try:
+            stream = _output_stream_class()()
+            doc.storeToURL('private:stream', (prop('FilterName', filter_name), prop('OutputStream', stream)))
+            return stream.getvalue()
+        finally:
+            doc.close(True)
+
+
+    def stop(self):
+        self.desktop = None
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        if self.profile_dir is not None:
+            shutil.rmtree(self.profile_dir, ignore_errors=True)
+            self.profile_dir = None
+
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+
+class OfficeConverter:
+    """
+    LibreOffice 转换服务，维护一组常驻的 soffice 进程，避免每个文件都重新启动 soffice
+    每个任务有超时时间，超时或出错的 soffice 会被杀掉并重启
+    没有 uno 模块或 soffice 无法常驻时，退回到命令行转换（同样使用独立的 profile 目录和超时）
+    """
+
+    # 目标格式对应的导出过滤器
+    pdf_filters = {
+        'pptx': 'impress_pdf_Export',
+        'ppt': 'impress_pdf_Export',
+        'docx': 'writer_pdf_Export',
+        'doc': 'writer_pdf_Export',
+        'xlsx': 'calc_pdf_Export',
+        'xls': 'calc_pdf_Export',
+    }
+
+    def __init__(self, cfg, logger=None):
+
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        lo_cfg = cfg.get('LIBREOFFICE', {})
+        self.soffice_path = lo_cfg.get('path') or cfg.get('RUNTIME', {}).get('libreoffice_path') or 'libreoffice'
+        self.pool_size = max(1, int(lo_cfg.get('pool_size') or 1))
+        self.timeout = float(lo_cfg.get('timeout') or 120)
+        self.start_timeout = float(lo_cfg.get('start_timeout') or 30)
+
+        self.workers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = False
+        self.use_cli = False
+        self.cli_profile_dir = None
+
+        # worker 进程退出时不会执行 atexit，使用 multiprocessing 的 Finalize 保证 soffice 被关闭
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+
+    def _start_pool(self):
+        # 第一次转换时才启动 soffice
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            try:
+                import uno
+            except ImportError:
+                self.logger.warning('未找到 uno 模块，使用 LibreOffice 命令行转换')
+                self.use_cli = True
+                return
+
+            for i in range(self.pool_size):
+                worker = SofficeWorker(self.soffice_path, self.start_timeout, self.logger)
+                try:
+                    worker.start()
+                except Exception as e:
+                    self.logger.warning(f'{e}，使用 LibreOffice 命令行转换')
+                    for w in self.workers:
+                        w.stop()
+                    self.workers = []
+                    self.use_cli = True
+                    return
+                self.workers.append(worker)
+                self.idle.put(worker)
+
+
+    def _run_with_timeout(self, worker, src_path, filter_name):
+        result = {}
+
+        def run():
+            try:
+                result['data'] = worker.convert(src_path, filter_name)
+            except Exception as e:
+                result['error'] = e
+
+        t = threading.Thread(target=run, name='soffice_convert', daemon=True)
+        t.start()
+        t.join(self.timeout)
+        if t.is_alive():
+            raise TimeoutError(f'转换超过 {self.timeout:.0f} 秒：{src_path}')
+        if 'error' in result:
+            raise result['error']
+        return result['data']
+
+
+    def _convert_cli(self, src_path):
+        # 每个进程使用独立的 profile 目录，避免多个进程同时使用默认 profile
+        if self.cli_profile_dir is None:
+            self.cli_profile_dir = tempfile.mkdtemp(prefix='soffice_profile_')
+        out_dir = tempfile.mkdtemp(prefix='soffice_out_')
+        try:
+            cmd = [
+                self.soffice_path, '--headless', '--norestore',
+                f'-env:UserInstallation=file://{os.path.abspath(self.cli_profile_dir)}',
+                '--convert-to', 'pdf', src_path, '--outdir', out_dir,
+            ]
+            try:
+                subprocess.run(cmd, timeout=self.timeout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except FileNotFoundError:
+                raise FileNotFoundError("LibreOffice 未安装，请先安装 LibreOffice")
+            except subprocess.TimeoutExpired:
+                raise TimeoutError(f'转换超过 {self.timeout:.0f} 秒：{src_path}')
+
+            out_path = os.path.join(out_dir, os.path.splitext(os.path.basename(src_path))[0] + '.pdf')
+            if not os.path.exists(out_path):
+                raise RuntimeError(f'LibreOffice 转换失败：{src_path}')
+            # 命令行只能输出到文件，读入内存后删除
+            with open(out_path, 'rb') as f:
+                return f.read()
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+    def to_pdf(self, src_path):
+        """
+        把 office 文件转换为 pdf
+        :return: pdf 文件的 bytes
+        """
+        self._start_pool()
+        if self.use_cli:
+            return self._convert_cli(src_path)
+
+        suffix = os.path.splitext(src_path)[1].lower().lstrip('.')
+        filter_name = self.pdf_filters.get(suffix, 'writer_pdf_Export')
+
+        worker = self.idle.get()
+        try:
+            return self._run_with_timeout(worker, src_path, filter_name)
+        except Exception as e:
+            # 超时或出错后 soffice 的状态不确定，直接重启
+            self.logger.error(f'soffice（pid {worker.proc.pid if worker.proc else None}）转换失败，正在重启：{e}')
+            try:
+                worker.restart()
+            except Exception as restart_error:
+                self.logger.error(f'soffice 重启失败：{restart_error}')
+            raise
+        finally:
+            self.idle.put(worker)
+
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+        if self.cli_profile_dir is not None:
+            shutil.rmtree(self.cli_profile_dir, ignore_errors=True)
+            self.cli_profile_dir = None
+
+
+_converter = None
+_converter_pid = None
+_converter_lock = threading.Lock()
+
+
+def get_converter(cfg, logger=None):
+    """
+    获取当前进程共享的 OfficeConverter，soffice 进程在整个运行期间复用
+    """
+    global _converter, _converter_pid
+    with _converter_lock:
+        if _converter is None or _converter_pid != os.getpid():
+            _converter = OfficeConverter(cfg, logger)
+            _converter_pid = os.getpid()
+        return _converter
@@ -1,63 +1,220 @@
 import os
+import ast
 import importlib
-from file_parsers.basic_parser import BasicParser
+import importlib.util
 import re
 
+# 解析器所在的目录
+PARSER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'file_parsers')
+
+
+class ParserRef:
+    """
+    解析器的延迟引用，第一次使用时才导入对应的模块
+    """
+
+    def __init__(self, lib_name, class_name):
+        self.lib_name = lib_name
+        self.__name__ = class_name
+        self.parser_class = None
+
+    def load(self):
+        if self.parser_class is None:
+            self.parser_class = getattr(importlib.import_module(self.lib_name), self.__name__)
+        return self.parser_class
+
+
+def read_parser_declarations(tree):
+    """
+    不导入模块，通过 ast 读取模块中 BasicParser 子类声明的 suffix 和 reg
+    :param tree: 模块的 ast
+    :return: [(class_name, suffix, reg)]
+    """
+    parser_names = {'BasicParser'}
+    declarations = []
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        base_names = [b.id if isinstance(b, ast.Name) else getattr(b, 'attr', None) for b in node.bases]
+        if not any(b in parser_names for b in base_names):
+            continue
+        parser_names.add(node.name)
+
+        suffix = None
+        reg = None
+        for stmt in node.body:
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and isinstance(stmt.targets[0], ast.Name):
+                if stmt.targets[0].id == 'suffix':
+                    suffix = ast.literal_eval(stmt.value)
+                elif stmt.targets[0].id == 'reg':
+                    reg = ast.literal_eval(stmt.value)
+        declarations.append((node.name, suffix, reg))
+
+    return declarations
+
+
+def find_missing_imports(tree):
+    """
+    检查模块顶层 import 的依赖是否存在，只查找不导入
+    try 中的 import 是可选依赖，相对导入是包内的模块，都不检查
+    :param tree: 模块的 ast
+    :return: 找不到的顶层模块名
+    """
+    missing = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            top_name = name.split('.')[0]
+            if top_name not in missing and importlib.util.find_spec(top_name) is None:
+                missing.append(top_name)
+    return missing
+
 
 class Parser_Chooser:
 
     def __init__(self, config, logger):
+        self.logger = logger
         # self.parser = {}
         # for k, v in config['PARSER'].items():
         #     lib_name = 'file_parsers.' + v
         #     self.parser[k] = importlib.import_module(v)
-        # 获取 file_parsers 目录下的所有文件
+        # 获取 file_parsers 目录下的所有文件，只读取声明，不导入模块
         self.parser = {
             'reg': {},
             'suffix': {},
         }
-        for file in os.listdir('file_parsers'):
+        for file in sorted(os.listdir(PARSER_DIR)):
             if file.endswith('.py') and not file.startswith('__'):
                 lib_name = 'file_parsers.' + file.split('.')[0]
-                # 获取 lib_name 下所有 BaseParser 的子类
-                for name, obj in importlib.import_module(lib_name).__dict__.items():
-                    if isinstance(obj, type) and issubclass(obj, BasicParser) and obj is not BasicParser:
-                        # 如果 suffix 在 obj 中
-                        if hasattr(obj, 'suffix'):
-                            # self.parser['suffix'][obj.suffix] = obj
-                            if type(obj.suffix) is str:
-                                if obj.suffix in self.parser['suffix'].keys():
-                                    self.logger.warning(f'后缀 {obj.suffix} 已有处理器 {self.parser['suffix'][obj.suffix].__name__}， {obj.__name__} 会被忽略')
-                                else:
-                                    self.parser['suffix'][obj.suffix] = obj
-                            elif type(obj.suffix) is list:
-                                for r in obj.suffix:
-                                    if r in self.parser['suffix'].keys():
-                                        self.logger.warning(f'后缀 {r} 已有处理器 {self.parser['suffix'][r].__name__}， {obj.__name__} 会被忽略')
-                                    else:
-                                        self.parser['suffix'][r] = obj
-                        if hasattr(obj,'reg'):
-                            self.parser['reg'][obj.reg] = obj
+                file_path = os.path.join(PARSER_DIR, file)
+                try:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        tree = ast.parse(f.read(), filename=file_path)
+                except SyntaxError as e:
+                    self.logger.error(f'解析器模块 {lib_name} 无法读取，已跳过：{e}')
+                    continue
+
+                declarations = read_parser_declarations(tree)
+                # 模块在第一次使用时才导入，缺少依赖时在这里提示，不注册其中的解析器
+                missing = find_missing_imports(tree) if declarations != [] else []
+                if missing != []:
+                    class_names = ', '.join(d[0] for d in declarations)
+                    self.logger.error(f'解析器模块 {lib_name} 缺少依赖 {", ".join(missing)}，{class_names} 不可用')
+                    continue
+
+                for class_name, suffix, reg in declarations:
+                    ref = ParserRef(lib_name, class_name)
+                    if type(suffix) is str:
+                        suffix = [suffix]
+                    if type(suffix) is list:
+                        for r in suffix:
+                            if r in self.parser['suffix'].keys():
+                                self.logger.warning(f'后缀 {r} 已有处理器 {self.parser["suffix"][r].__name__}， {class_name} 会被忽略')
+                            else:
+                                self.parser['suffix'][r] = ref
+                    if reg is not None:
+                        self.parser['reg'][reg] = ref
         
         self.path_ignore = self.read_path_ignore(config['GENERAL']['path_ignore'])
+        self.compile_patterns()
+
+        # 本次运行中每一层目录跳过的文件数和目录数
+        self.skip_stats = {}
+
+
+    def compile_patterns(self):
+        """
+        把 path_ignore 和 reg 解析器编译为合并后的正则，每个路径只匹配一次
+        """
+        def combine(patterns):
+            if patterns == []:
+                return None
+            return re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+        self.ignore_reg = combine(self.path_ignore)
+
+        # 目录剪枝只使用匹配目录前缀后，对其下所有路径都一定匹配的规则，即不含结尾锚点和前后断言的规则
+        prunable = [p for p in self.path_ignore if not re.search(r'\$|\\Z|\(\?[=!<]', p)]
+        self.ignore_dir_reg = combine(prunable)
+
+        # reg 解析器用命名分组合并，通过 lastgroup 找到对应的解析器
+        self.reg_parsers = {}
+        reg_list = []
+        for i, (reg, parser) in enumerate(self.parser['reg'].items()):
+            self.reg_parsers[f'parser_{i}'] = parser
+            reg_list.append(f'(?P<parser_{i}>{reg})')
+        self.reg_parser_reg = re.compile('|'.join(reg_list)) if reg_list != [] else None
+
+
+    def count_skip(self, depth, kind):
+        if depth not in self.skip_stats:
+            self.skip_stats[depth] = {'dirs': 0, 'files': 0}
+        self.skip_stats[depth][kind] += 1
+
+
+    def is_ignored_dir(self, dir_path):
+        if self.ignore_dir_reg is None:
+            return False
+        # 加上结尾的分隔符，和目录下文件路径的前缀一致
+        return self.ignore_dir_reg.search(os.path.join(dir_path, '')) is not None
+
+
+    def walk(self, docs_root_dir):
+        """
+        遍历 docs_root_dir，返回 (file_path, parser)，parser 的含义同 choose_parser
+        被忽略的目录在进入之前剪掉，不再列出其中的内容
+        """
+        root_depth = docs_root_dir.rstrip(os.sep).count(os.sep)
+        for dir, children, files in os.walk(docs_root_dir):
+            depth = dir.rstrip(os.sep).count(os.sep) - root_depth + 1
+
+            kept = []
+            for child in children:
+                child_path = os.path.join(dir, child)
+                if self.is_ignored_dir(child_path):
+                    self.count_skip(depth, 'dirs')
+                    self.logger.info('======')
+                    self.logger.info(f'跳过目录 {child_path}')
+                else:
+                    kept.append(child)
+            # 原地修改 children，os.walk 不会进入被剪掉的目录
+            children[:] = kept
+
+            for file in files:
+                file_path = os.path.join(dir, file)
+                parser = self.choose_parser(file_path)
+                if parser == 'ignored':
+                    self.count_skip(depth, 'files')
+                yield file_path, parser
+
+
+    def log_skip_stats(self):
+        for depth in sorted(self.skip_stats.keys()):
+            stats = self.skip_stats[depth]
+            self.logger.info(f'第 {depth} 层：跳过目录 {stats["dirs"]} 个，跳过文件 {stats["files"]} 个')
 
         
     def choose_parser(self, file_path):
 
         # 根据 path_ignore 过滤
-        for p in self.path_ignore:
-            if re.search(p, file_path):
-                return 'ignored'
+        if self.ignore_reg is not None and self.ignore_reg.search(file_path):
+            return 'ignored'
 
         # 根据 reg 匹配
-        for reg, parser in self.parser['reg'].items():
-            if re.search(reg, file_path):
-                return parser
+        if self.reg_parser_reg is not None:
+            m = self.reg_parser_reg.search(file_path)
+            if m:
+                return self.reg_parsers[m.lastgroup].load()
 
         # 根据 suffix 匹配
         file_ext = file_path.split('.')[-1].lower()
         if file_ext in self.parser['suffix'].keys():
-            return self.parser['suffix'][file_ext]
+            return self.parser['suffix'][file_ext].load()
 
         # 如果都没有匹配到，返回 None
         return None
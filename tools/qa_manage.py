@@ -1,23 +1,246 @@
-import pandas as pd
 import os
-import atexit
+import re
+import csv
+import json
+import logging
+import threading
+
+class QATable:
+    """
+    列式存储的 QA 表，每一列是一个 list，knowledge_path 索引到行区间 [start, stop)
+    替换一个文件的 QA 只涉及这个文件的行：行数不超过原区间时原地覆盖，否则追加到末尾，旧区间作为无效行
+    无效行超过一半时整体重排一次，均摊后仍然是 O(该文件的行数)
+    """
+
+    __slots__ = ('columns', 'index', 'size', 'dead')
+
+    def __init__(self):
+        self.columns = {}
+        self.index = {}
+        self.size = 0
+        self.dead = 0
+
+
+    def __len__(self):
+        return self.size - self.dead
+
+
+    def _add_column(self, name):
+        self.columns[name] = [None] * self.size
+
+
+    def _write_row(self, row, qa):
+        for k in qa.keys():
+            if k not in self.columns:
+                self._add_column(k)
+        for k, col in self.columns.items():
+            col[row] = qa.get(k)
+
+
+    def replace(self, knowledge_path, qa_list):
+        """
+        用 qa_list 替换 knowledge_path 对应的所有行
+        """
+        old = self.index.pop(knowledge_path, None)
+        n = len(qa_list)
+
+        if old is not None and n <= old[1] - old[0]:
+            # 原地覆盖，多出来的行作为无效行
+            start = old[0]
+            self.dead += (old[1] - old[0]) - n
+        else:
+            if old is not None:
+                self.dead += old[1] - old[0]
+            start = self.size
+            for col in self.columns.values():
+                col.extend([None] * n)
+            self.size += n
+
+        for i, qa in enumerate(qa_list):
+            self._write_row(start + i, qa)
+        if n > 0:
+            self.index[knowledge_path] = (start, start + n)
+
+        if self.dead > 1024 and self.dead * 2 > self.size:
+            self.vacuum()
+
+
+    def vacuum(self):
+        """
+        去掉无效行，按区间顺序重排
+        """
+        ranges = sorted(self.index.items(), key=lambda x: x[1][0])
+        columns = {k: [] for k in self.columns.keys()}
+        index = {}
+        size = 0
+        for knowledge_path, (start, stop) in ranges:
+            for k, col in self.columns.items():
+                columns[k].extend(col[start:stop])
+            index[knowledge_path] = (size, size + stop - start)
+            size += stop - start
+
+        self.columns = columns
+        self.index = index
+        self.size = size
+        self.dead = 0
+
+
+    def rows(self, knowledge_path=None):
+        """
+        按行区间顺序返回 QA（dict），指定 knowledge_path 时只返回该文件的 QA
+        """
+        if knowledge_path is not None:
+            ranges = [self.index[knowledge_path]] if knowledge_path in self.index else []
+        else:
+            ranges = sorted(self.index.values())
+
+        names = list(self.columns.keys())
+        cols = [self.columns[k] for k in names]
+        for start, stop in ranges:
+            for row in range(start, stop):
+                yield {k: col[row] for k, col in zip(names, cols) if col[row] is not None}
+
 
 class QA_Manager:
+    """
+    QA 记录保存在 knowledge_base_dir/qa_store 下的 jsonl 分段文件中
+    每解析完一个文件追加一行 {"knowledge_path": ..., "qa": [...]}，同一个 knowledge_path 以最后写入的一行为准
+    内存中只保存 knowledge_path 到记录位置的索引，qa.csv 通过 export_csv 按需导出
+    """
 
-    def __init__(self, cfg, docs_root_dir, knowledge_base_dir):
+    segment_reg = re.compile(r'^segment_(\d+)\.jsonl$')
+
+    def __init__(self, cfg, docs_root_dir, knowledge_base_dir, logger=None):
         self.cfg = cfg
         self.docs_root_dir = docs_root_dir
         self.knowledge_base_dir = knowledge_base_dir
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        self.store_dir = os.path.join(knowledge_base_dir, 'qa_store')
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+        # knowledge_path -> (segment 序号, 行的偏移量)
+        self.index = {}
+        # 已被新记录替换的记录数，用于判断是否需要压缩
+        self.dead_records = 0
+        self.lock = threading.Lock()
+        self.compact_thread = None
+        # 内存中的 QA 表，按需通过 load_table 加载
+        self.table = None
 
-        # 加载 qa
+        self.load_index()
+
+        # 兼容旧版本：只有 qa.csv 时导入到 qa_store
         qa_file_path = os.path.join(knowledge_base_dir, 'qa.csv')
-        if os.path.exists(qa_file_path):
-            self.qa = pd.read_csv(qa_file_path).to_dict('records')
-        else:
-            self.qa = []
+        if self.index == {} and os.path.exists(qa_file_path):
+            self.import_csv(qa_file_path)
+
+        # 本次运行写入新的 segment，之前的 segment 不再修改，可以在后台压缩
+        self.current_segment = self.max_segment() + 1
+        self.current_file = None
+
+        # 无效记录比有效记录多，或者 segment 过多时，在后台压缩
+        if self.dead_records > len(self.index) or len(self.closed_segments()) > 8:
+            self.start_compaction()
+
+
+    def segment_path(self, seq):
+        return os.path.join(self.store_dir, f'segment_{seq:06d}.jsonl')
+
+
+    def list_segments(self):
+        segments = []
+        for f in os.listdir(self.store_dir):
+            m = self.segment_reg.match(f)
+            if m:
+                segments.append(int(m.group(1)))
+        return sorted(segments)
+
+
+    def max_segment(self):
+        segments = self.list_segments()
+        return segments[-1] if segments else 0
+
+
+    def closed_segments(self):
+        return [seq for seq in self.list_segments() if seq < self.current_segment]
+
+
+    def load_index(self):
+        """
+        按顺序读取所有 segment，建立 knowledge_path 的索引
+        """
+        for seq in self.list_segments():
+            seg_path = self.segment_path(seq)
+            with open(seg_path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 中断时写了一半的行，截断掉
+                        self.logger.warning(f'{seg_path} 偏移 {offset} 处的记录不完整，已截断')
+                        f.close()
+                        os.truncate(seg_path, offset)
+                        break
+                    if record['knowledge_path'] in self.index:
+                        self.dead_records += 1
+                    self.index[record['knowledge_path']] = (seq, offset)
+                    offset += len(line)
+
+
+    def import_csv(self, qa_file_path):
+        """
+        把旧版本的 qa.csv 导入到 qa_store
+        """
+        # pandas 导入较慢，只在导入旧数据时使用
+        import pandas as pd
+        df = pd.read_csv(qa_file_path)
+        grouped = {}
+        for qa in df.to_dict('records'):
+            # pandas 读取的空值为 nan，去掉
+            qa = {k: v for k, v in qa.items() if not (isinstance(v, float) and v != v)}
+            grouped.setdefault(qa.get('knowledge_path', ''), []).append(qa)
+
+        self.current_segment = self.max_segment() + 1
+        self.current_file = None
+        for knowledge_path, qa_list in grouped.items():
+            self.append_record(knowledge_path, qa_list)
+        self.close_segment()
+        self.logger.info(f'已从 {qa_file_path} 导入 {len(grouped)} 个文件的 QA')
+
+
+    def append_record(self, knowledge_path, qa_list):
+        """
+        追加一条记录到当前 segment，写入后立即落盘
+        """
+        line = (json.dumps({'knowledge_path': knowledge_path, 'qa': qa_list}, ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            if self.current_file is None:
+                self.current_file = open(self.segment_path(self.current_segment), 'ab')
+            offset = self.current_file.tell()
+            self.current_file.write(line)
+            self.current_file.flush()
+            os.fsync(self.current_file.fileno())
+
+            if knowledge_path in self.index:
+                self.dead_records += 1
+            self.index[knowledge_path] = (self.current_segment, offset)
+
+            if self.table is not None:
+                self.table.replace(knowledge_path, qa_list)
+
+
+    def close_segment(self):
+        with self.lock:
+            if self.current_file is not None:
+                self.current_file.close()
+                self.current_file = None
 
-        # 注册退出时的清理函数
-        atexit.register(self.export_csv, qa_file_path)
 
     def merge_qa(self, qa_to_merge, file_path=None):
 
@@ -26,18 +249,117 @@ class QA_Manager:
             rel_path = os.path.relpath(file_path, self.docs_root_dir)
             for qa in qa_to_merge:
                 qa['knowledge_path'] = rel_path
-        
-        # 删除 qa 中 knowledge_path 为 rel_path 的 qa
-        self.qa = [qa for qa in self.qa if qa['knowledge_path'] != rel_path]
+            self.append_record(rel_path, qa_to_merge)
+        # 否则按照 qa 中的 knowledge_path 分组替换
+        else:
+            grouped = {}
+            for qa in qa_to_merge:
+                grouped.setdefault(qa['knowledge_path'], []).append(qa)
+            for knowledge_path, qa_list in grouped.items():
+                self.append_record(knowledge_path, qa_list)
+
+
+    def iter_records(self, segments=None):
+        """
+        按 segment 和偏移量顺序遍历当前有效的记录
+        :param segments: 只遍历指定的 segment，默认全部
+        """
+        with self.lock:
+            if self.current_file is not None:
+                self.current_file.flush()
+            locations = {}
+            for knowledge_path, (seq, offset) in self.index.items():
+                if segments is None or seq in segments:
+                    locations.setdefault(seq, []).append(offset)
+
+        for seq in sorted(locations.keys()):
+            with open(self.segment_path(seq), 'rb') as f:
+                for offset in sorted(locations[seq]):
+                    f.seek(offset)
+                    yield seq, offset, json.loads(f.readline())
+
+
+    def load_table(self):
+        """
+        把当前有效的 QA 加载为 QATable，加载后 merge_qa 会同步更新
+        """
+        if self.table is None:
+            table = QATable()
+            for _, _, record in self.iter_records():
+                table.replace(record['knowledge_path'], record['qa'])
+            self.table = table
+        return self.table
+
+
+    def start_compaction(self):
+        """
+        在后台线程中压缩已关闭的 segment
+        """
+        if self.compact_thread is not None and self.compact_thread.is_alive():
+            return
+        self.compact_thread = threading.Thread(target=self.compact, name='qa_compaction')
+        self.compact_thread.start()
+
+
+    def compact(self):
+        """
+        把已关闭的 segment 中仍然有效的记录写入一个新文件，替换掉最后一个已关闭的 segment，再删除其余的
+        中途中断时，旧的 segment 仍然存在，其中的记录都会被序号更大的记录覆盖，不影响正确性
+        """
+        closed = self.closed_segments()
+        if len(closed) == 0:
+            return
+        target_seq = closed[-1]
+        target_path = self.segment_path(target_seq)
+        tmp_path = target_path + '.compacting'
+
+        moved = {}
+        with open(tmp_path, 'wb') as f:
+            for seq, offset, record in self.iter_records(set(closed)):
+                new_offset = f.tell()
+                f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+                moved[record['knowledge_path']] = ((seq, offset), (target_seq, new_offset))
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self.lock:
+            os.replace(tmp_path, target_path)
+            # 压缩期间被替换的记录保持新的位置
+            for knowledge_path, (old_location, new_location) in moved.items():
+                if self.index.get(knowledge_path) == old_location:
+                    self.index[knowledge_path] = new_location
+            self.dead_records = 0
+
+        for seq in closed[:-1]:
+            os.remove(self.segment_path(seq))
+
+        self.logger.info(f'qa_store 压缩完成，{len(closed)} 个 segment 合并为 1 个，保留 {len(moved)} 条记录')
+
 
-        # 合并 qa
-        self.qa.extend(qa_to_merge)
-    
     def export_csv(self, file_path):
-        df = pd.DataFrame(self.qa)
-        df.to_csv(file_path, index=False)
-    
+        """
+        导出当前有效的 QA 到 csv，逐个 segment 读取，不加载整个 QATable
+        第一遍收集列名，第二遍写入，列和行的顺序与 QATable 一致
+        """
+        fieldnames = {}
+        for _, _, record in self.iter_records():
+            for qa in record['qa']:
+                fieldnames.update(dict.fromkeys(qa.keys()))
+
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=list(fieldnames.keys()), restval='', lineterminator='\n')
+            writer.writeheader()
+            for _, _, record in self.iter_records():
+                for qa in record['qa']:
+                    writer.writerow({k: v for k, v in qa.items() if v is not None})
+
+
+    def close(self):
+        self.close_segment()
+        if self.compact_thread is not None:
+            self.compact_thread.join()
+
 
     # def __del__(self):
 
-    #     self.export_csv(os.path.join(self.knowledge_base_dir, 'qa.csv'))
\ No newline at end of file
+    #     self.export_csv(os.path.join(self.knowledge_base_dir, 'qa.csv'))
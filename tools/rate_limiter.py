@@ -0,0 +1,85 @@
+import time
+import asyncio
+
+
+class TokenBucket:
+    """
+    令牌桶，按每分钟的额度匀速补充，用于限制每分钟的请求数或 token 数
+    只在 engine 的事件循环中使用，不需要加锁
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.rate = self.capacity / 60
+        self.updated = time.monotonic()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+    async def acquire(self, amount=1):
+        # 单次请求超过桶容量时，按容量计算，避免永远等待
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+    def adjust(self, amount):
+        """
+        请求完成后按实际用量修正，amount 为实际用量与预估用量的差，可以为负
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发控制（AIMD）
+    请求成功时并发上限加性增长（每轮约 +1），遇到 429 或 5xx 时减半，并在 Retry-After 期间暂停发出新请求
+    """
+
+    def __init__(self, max_limit, initial_limit=4):
+        self.max_limit = max_limit
+        self.limit = float(min(initial_limit, max_limit))
+        self.in_flight = 0
+        self.pause_until = 0
+        self.last_decrease = 0
+        self.condition = asyncio.Condition()
+
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        delay = self.pause_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+
+    def on_overload(self, retry_after=None):
+        now = time.monotonic()
+        # 同一批并发请求同时失败时只减半一次
+        if now - self.last_decrease > 1:
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+        if retry_after:
+            self.pause_until = max(self.pause_until, now + retry_after)
@@ -0,0 +1,245 @@
+import os
+import random
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+from tools.response_cache import ResponseCache
+from tools.rate_limiter import TokenBucket, AdaptiveLimiter
+
+# 配置中对应模型接口的 section
+ENDPOINTS = ['IMG_RECONGNIZE_MODEL', 'LLM']
+
+
+class RequestEngine:
+    """
+    所有解析器共享的模型请求引擎
+    事件循环运行在后台线程中，每个接口的并发数由 AdaptiveLimiter 自适应调整（不超过 max_in_flight），
+    每分钟请求数和 token 数由令牌桶限制，遇到 429、5xx 时按 Retry-After 或指数退避重试
+    调用方通过 submit 获得 concurrent.futures.Future，可以一次提交多个请求后再依次取结果
+    """
+
+    def __init__(self, cfg, logger=None):
+
+        self.cfg = cfg
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        # 多个 worker 进程共用同一个接口时，每个进程只使用 1/workers 的速率额度
+        workers = max(1, int(cfg.get('RUNTIME', {}).get('workers', 1)))
+
+        self.endpoints = {}
+        for name in ENDPOINTS:
+            if name not in cfg:
+                continue
+            section = cfg[name]
+            self.endpoints[name] = {
+                'url': section.get('url') or None,
+                'api_key': section.get('api_key'),
+                'model_name': section.get('model_name'),
+                'max_in_flight': int(section.get('max_in_flight', 16)),
+                'requests_per_minute': float(section.get('requests_per_minute') or 0) / workers,
+                'tokens_per_minute': float(section.get('tokens_per_minute') or 0) / workers,
+                'max_retries': int(section.get('max_retries', 8)),
+            }
+
+        # 模型结果缓存，cache_mode: on 正常读写；refresh 不读只写；off 不使用
+        runtime = cfg.get('RUNTIME', {})
+        cache_cfg = cfg.get('CACHE', {})
+        self.cache_mode = runtime.get('cache_mode', 'on')
+        cache_file = cache_cfg.get('cache_file') or runtime.get('cache_file')
+        self.cache = None
+        if self.cache_mode != 'off' and cache_file:
+            self.cache = ResponseCache(cache_file, cache_cfg.get('max_size_mb', 1024), self.logger)
+
+        # client 和限流器需要绑定到事件循环，在第一次请求时创建
+        self.clients = {}
+        self.limiters = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name='request_engine', daemon=True)
+        self.thread.start()
+
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+    def model_name(self, endpoint):
+        return self.endpoints[endpoint]['model_name']
+
+
+    def _get_client(self, endpoint):
+        if endpoint not in self.clients:
+            # openai 导入较慢，第一次请求时才导入
+            from openai import AsyncOpenAI
+            ep = self.endpoints[endpoint]
+            # 重试由 engine 统一处理
+            self.clients[endpoint] = AsyncOpenAI(api_key=ep['api_key'], base_url=ep['url'], max_retries=0)
+            self.limiters[endpoint] = {
+                'concurrency': AdaptiveLimiter(ep['max_in_flight']),
+                'requests': TokenBucket(ep['requests_per_minute']) if ep['requests_per_minute'] > 0 else None,
+                'tokens': TokenBucket(ep['tokens_per_minute']) if ep['tokens_per_minute'] > 0 else None,
+            }
+        return self.clients[endpoint], self.limiters[endpoint]
+
+
+    @staticmethod
+    def estimate_tokens(messages):
+        """
+        粗略估计请求的 token 数，请求完成后按 usage 修正
+        """
+        tokens = 0
+        for m in messages:
+            content = m['content']
+            if isinstance(content, str):
+                content = [{'type': 'text', 'text': content}]
+            for part in content:
+                if part.get('type') == 'text':
+                    tokens += len(part['text']) // 2
+                elif part.get('type') == 'image_url':
+                    tokens += 1000
+        return max(tokens, 1)
+
+
+    @staticmethod
+    def retry_after(e):
+        """
+        从异常的响应头中读取 Retry-After（秒）
+        """
+        response = getattr(e, 'response', None)
+        if response is None:
+            return None
+        value = response.headers.get('retry-after')
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+
+    async def _request(self, endpoint, messages, kwargs):
+        from openai import APIStatusError, APIConnectionError
+        client, limiters = self._get_client(endpoint)
+        concurrency = limiters['concurrency']
+        max_retries = self.endpoints[endpoint]['max_retries']
+        estimated = self.estimate_tokens(messages)
+
+        retried = 0
+        while True:
+            await concurrency.acquire()
+            try:
+                if limiters['requests'] is not None:
+                    await limiters['requests'].acquire(1)
+                if limiters['tokens'] is not None:
+                    await limiters['tokens'].acquire(estimated)
+
+                response = await client.chat.completions.create(
+                    model=self.model_name(endpoint),
+                    messages=messages,
+                    **kwargs
+                )
+            except (APIStatusError, APIConnectionError) as e:
+                # APIConnectionError 是连接错误或超时，没有状态码，只退避不降低并发
+                status = getattr(e, 'status_code', None)
+                overloaded = status == 429 or (status is not None and status >= 500)
+                if not overloaded and status is not None:
+                    raise
+                retried += 1
+                if retried > max_retries:
+                    raise
+
+                retry_after = self.retry_after(e)
+                if overloaded:
+                    concurrency.on_overload(retry_after)
+                delay = retry_after or min(60, 2 ** retried) * (0.5 + random.random() / 2)
+                self.logger.warning(f'{endpoint} 请求失败（{status or type(e).__name__}），{delay:.1f} 秒后第 {retried} 次重试，当前并发上限 {int(concurrency.limit)}')
+            else:
+                concurrency.on_success()
+                if limiters['tokens'] is not None and response.usage is not None:
+                    limiters['tokens'].adjust(response.usage.total_tokens - estimated)
+                return response.choices[0].message.content
+            finally:
+                await concurrency.release()
+
+            await asyncio.sleep(delay)
+
+
+    def submit(self, endpoint, messages, **kwargs):
+        """
+        提交一个请求，立即返回
+        :param endpoint: 配置中的接口 section，如 IMG_RECONGNIZE_MODEL、LLM
+        :param messages: chat.completions 的 messages
+        :return: concurrent.futures.Future，结果为模型返回的文本
+        """
+        if endpoint not in self.endpoints:
+            raise KeyError(f'配置中没有接口 {endpoint}')
+
+        if self.cache is None:
+            return asyncio.run_coroutine_threadsafe(self._request(endpoint, messages, kwargs), self.loop)
+
+        model = self.model_name(endpoint)
+        key = ResponseCache.make_key(model, messages, kwargs)
+        if self.cache_mode != 'refresh':
+            cached = self.cache.get(key)
+            if cached is not None:
+                future = concurrent.futures.Future()
+                future.set_result(cached)
+                return future
+
+        future = asyncio.run_coroutine_threadsafe(self._request(endpoint, messages, kwargs), self.loop)
+        future.add_done_callback(lambda f: self._save_to_cache(f, key, model))
+        return future
+
+
+    def _save_to_cache(self, future, key, model):
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            self.cache.put(key, model, future.result())
+        except Exception as e:
+            self.logger.warning(f'写入模型缓存失败：{e}')
+
+
+    def discard(self, endpoint, messages, **kwargs):
+        """
+        删除某个请求的缓存结果，返回结果无法使用时调用，重试时会重新请求模型
+        """
+        if self.cache is None:
+            return
+        key = ResponseCache.make_key(self.model_name(endpoint), messages, kwargs)
+        self.cache.delete(key)
+
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+
+    def chat(self, endpoint, messages, **kwargs):
+        """
+        提交一个请求并等待结果
+        """
+        return self.submit(endpoint, messages, **kwargs).result()
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def get_engine(cfg, logger=None):
+    """
+    获取当前进程共享的 RequestEngine
+    fork 出来的子进程不会继承后台线程，所以按 pid 重新创建
+    """
+    global _engine, _engine_pid
+    with _engine_lock:
+        if _engine is None or _engine_pid != os.getpid():
+            _engine = RequestEngine(cfg, logger)
+            _engine_pid = os.getpid()
+        return _engine
@@ -0,0 +1,164 @@
+import os
+import re
+import json
+import time
+import base64
+import hashlib
+import logging
+import sqlite3
+import threading
+
+
+class ResponseCache:
+    """
+    模型返回结果的本地缓存，保存在单个 SQLite 文件中
+    key 由模型名称、完整的 prompt 文本和图片内容的 sha256 生成，超过大小上限时按最近访问时间淘汰
+    """
+
+    def __init__(self, cache_file, max_size_mb=1024, logger=None):
+
+        if logger is None:
+            self.logger = logging.getLogger()
+        else:
+            self.logger = logger
+
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir != '' and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.cache_file = cache_file
+        self.max_size = int(float(max_size_mb) * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+
+        # engine 的回调在后台线程中执行，连接需要跨线程使用
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                size INTEGER,
+                last_access REAL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)')
+        self.conn.commit()
+
+        self.size = self._total_size()
+
+
+    @staticmethod
+    def make_key(model, messages, kwargs=None):
+        """
+        生成缓存 key
+        base64 图片先解码，使用图片内容的 sha256 参与计算，其余文本原样参与计算
+        """
+        def normalize(obj):
+            if isinstance(obj, dict):
+                return {k: normalize(v) for k, v in obj.items()}
+            if isinstance(obj, list):
+                return [normalize(v) for v in obj]
+            if isinstance(obj, str):
+                match = re.match(r'^data:image/[^;]+;base64,', obj)
+                if match:
+                    img_bytes = base64.b64decode(obj[match.end():])
+                    return 'sha256:' + hashlib.sha256(img_bytes).hexdigest()
+            return obj
+
+        key_info = {
+            'model': model,
+            'messages': normalize(messages),
+            'kwargs': kwargs or {},
+        }
+        key_str = json.dumps(key_info, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+
+    def _total_size(self):
+        with self.lock:
+            row = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return row[0]
+
+
+    def get(self, key):
+        """
+        读取缓存，未命中返回 None
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return row[0]
+
+
+    def put(self, key, model, response):
+        """
+        写入缓存，超过大小上限时淘汰最久未访问的结果
+        """
+        if response is None:
+            return
+
+        size = len(response.encode('utf-8'))
+        with self.lock:
+            # 同一个 key 再次写入时替换原来的结果，只统计大小的变化
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, size, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, model, response, size, time.time())
+            )
+            self.conn.commit()
+            self.size += size - (row[0] if row is not None else 0)
+
+        if self.size > self.max_size:
+            self._evict()
+
+
+    def delete(self, key):
+        """
+        删除一条缓存，用于结果无法解析等情况，避免重试时再次读到同样的结果
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.conn.commit()
+            self.size -= row[0]
+
+
+    def _evict(self):
+        # 其他进程也会写入同一个文件，淘汰前重新统计实际大小
+        self.size = self._total_size()
+        evicted = 0
+        with self.lock:
+            while self.size > self.max_size:
+                rows = self.conn.execute('SELECT key, size FROM responses ORDER BY last_access LIMIT 100').fetchall()
+                if rows == []:
+                    break
+                for key, size in rows:
+                    if self.size <= self.max_size:
+                        break
+                    self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                    self.size -= size
+                    evicted += 1
+            self.conn.commit()
+
+        self.logger.info(f'模型缓存超过上限，淘汰 {evicted} 条结果')
+
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': self.size}
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()